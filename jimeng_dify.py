@@ -1,10 +1,16 @@
 import json
+import os
 import uuid
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from http.cookiejar import DefaultCookiePolicy
 from typing import Dict
+from collections import OrderedDict
 import hashlib
 import datetime
+import threading
 
 # 移除logging相关导入和配置
 def get_current_time():
@@ -16,6 +22,19 @@ DEFAULT_MODEL = "high_aes_general_v30l:general_v3.0_18b"
 VERSION_CODE = "5.8.0"
 PLATFORM_CODE = "7"
 DEFAULT_WEB_ID = str(int(time.time() * 1000) % 100000000 + 2500000000)
+BASE_URL = os.getenv("JIMENG_BASE_URL", "https://jimeng.jianying.com").rstrip("/")  # 可指向区域节点或反向代理
+POOL_MAXSIZE = 16
+MAX_RETRIES = int(os.getenv("JIMENG_MAX_RETRIES", "3"))  # 建立连接失败时的重试次数
+REQUEST_DEADLINE = float(os.getenv("JIMENG_REQUEST_DEADLINE", "300"))  # 一次生成任务的总时限(秒)，0为不限制
+# 各接口的超时: 总超时秒数或(连接超时, 读取超时)，与src/api/lib/upstream_config.py的默认值一致
+TIMEOUTS = {
+    "/commerce/v1/benefits/user_credit": 15,
+    "/mweb/v1/aigc_draft/generate": (5, 30),
+    "/mweb/v1/get_history_by_ids": (5, 15),
+}
+CREDIT_CACHE_TTL = 300  # 积分缓存有效期(秒)
+CREDIT_CACHE_SIZE = 256  # 最多缓存的token数量
+CREDIT_LOW_THRESHOLD = 5  # 余额不高于该值时同步查询
 
 # 伪装headers
 FAKE_HEADERS = {
@@ -39,6 +58,36 @@ FAKE_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
 }
 
+def create_session():
+    # 本文件需保持独立可运行(Dify代码节点)，因此不依赖src/api中的共享客户端
+    session = requests.Session()
+    # 本文件的请求都是POST，urllib3只在建立连接失败时重试，不会因5xx或读取失败重试，避免重复提交生成
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.1
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # 不保存响应Cookie，避免不同refresh_token之间串号
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+# 进程内共享的长连接会话
+SESSION = create_session()
+
+def bounded_timeout(uri, deadline):
+    # 有总时限时，读取超时不超过剩余时间
+    timeout = TIMEOUTS[uri]
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise Exception("请求总时限已到")
+    if isinstance(timeout, tuple):
+        return (min(timeout[0], remaining), min(timeout[1], remaining))
+    return min(timeout, remaining)
+
 def get_device_time():
     return int(time.time())
 
@@ -98,12 +147,12 @@ def get_credit(refresh_token):
     print(f"[{get_current_time()}] [INFO] 开始请求用户信用额度: GET {uri}")
     print(f"[{get_current_time()}] [INFO] 请求参数: {params}")
     
-    response = requests.post(
-        f"https://jimeng.jianying.com{uri}",
+    response = SESSION.post(
+        f"{BASE_URL}{uri}",
         headers=headers,
         params=params,
         json={},
-        timeout=15
+        timeout=TIMEOUTS[uri]
     )
     
     if response.status_code != 200:
@@ -133,10 +182,69 @@ def get_credit(refresh_token):
         "total_credit": total_credit
     }
 
+# 积分缓存: refresh_token -> (积分信息, 获取时间)
+CREDIT_CACHE = OrderedDict()
+CREDIT_CACHE_LOCK = threading.Lock()
+CREDIT_REFRESHING = set()
+
+def refresh_credit(refresh_token):
+    credit_info = get_credit(refresh_token)
+    with CREDIT_CACHE_LOCK:
+        CREDIT_CACHE[refresh_token] = (dict(credit_info), time.monotonic())
+        CREDIT_CACHE.move_to_end(refresh_token)
+        while len(CREDIT_CACHE) > CREDIT_CACHE_SIZE:
+            CREDIT_CACHE.popitem(last=False)
+    return credit_info
+
+def refresh_credit_in_background(refresh_token):
+    with CREDIT_CACHE_LOCK:
+        if refresh_token in CREDIT_REFRESHING:
+            return
+        CREDIT_REFRESHING.add(refresh_token)
+
+    def run():
+        try:
+            refresh_credit(refresh_token)
+        except Exception as e:
+            print(f"[{get_current_time()}] [WARNING] 后台刷新信用额度失败: {str(e)}")
+        finally:
+            with CREDIT_CACHE_LOCK:
+                CREDIT_REFRESHING.discard(refresh_token)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def get_cached_credit(refresh_token):
+    # 缓存有效且余额充足时直接返回，接近过期时后台刷新，已过期或余额接近0时同步查询
+    now = time.monotonic()
+    with CREDIT_CACHE_LOCK:
+        cached = CREDIT_CACHE.get(refresh_token)
+        if cached is not None:
+            CREDIT_CACHE.move_to_end(refresh_token)
+    if cached is None:
+        return refresh_credit(refresh_token)
+    credit_info, fetched_at = cached
+    if now - fetched_at >= CREDIT_CACHE_TTL or credit_info["total_credit"] <= CREDIT_LOW_THRESHOLD:
+        return refresh_credit(refresh_token)
+    if now - fetched_at >= CREDIT_CACHE_TTL / 2:
+        refresh_credit_in_background(refresh_token)
+    print(f"[{get_current_time()}] [INFO] 使用缓存的用户信用额度: 总额度={credit_info['total_credit']}")
+    return dict(credit_info)
+
+def consume_cached_credit(refresh_token, amount=1):
+    # 提交生成成功后在本地预扣积分，实际余额以下次刷新为准
+    with CREDIT_CACHE_LOCK:
+        cached = CREDIT_CACHE.get(refresh_token)
+        if cached is not None:
+            cached[0]["total_credit"] = max(cached[0]["total_credit"] - amount, 0)
+
+def invalidate_cached_credit(refresh_token):
+    with CREDIT_CACHE_LOCK:
+        CREDIT_CACHE.pop(refresh_token, None)
+
 def generate_images(prompt, refresh_token, sample_strength, width, height, seed):
     # 获取信用额度
     print(f"[{get_current_time()}] [INFO] 开始获取用户信用额度")
-    credit_info = get_credit(refresh_token)
+    credit_info = get_cached_credit(refresh_token)
     total_credit = credit_info.get("total_credit", 0)
     if total_credit < 1:
         print(f"[{get_current_time()}] [ERROR] 用户信用额度不足: {total_credit}")
@@ -235,15 +343,17 @@ def generate_images(prompt, refresh_token, sample_strength, width, height, seed)
     
     print(f"[{get_current_time()}] [INFO] 请求参数: {params}")
     
-    response = requests.post(
-        f"https://jimeng.jianying.com{uri}",
+    response = SESSION.post(
+        f"{BASE_URL}{uri}",
         headers=headers,
         params=params,
-        json=data
+        json=data,
+        timeout=TIMEOUTS[uri]
     )
     
     if response.status_code != 200:
         print(f"[{get_current_time()}] [ERROR] 生成图片请求失败: 状态码 {response.status_code}, 响应: {response.text}")
+        invalidate_cached_credit(refresh_token)
         return {"status": "error", "message": f"生成图片失败: {response.status_code}"}
         
     result = response.json()
@@ -251,12 +361,14 @@ def generate_images(prompt, refresh_token, sample_strength, width, height, seed)
     
     if result.get("ret") != "0":
         print(f"[{get_current_time()}] [ERROR] 生成图片失败: {result.get('errmsg')}")
+        invalidate_cached_credit(refresh_token)
         return {"status": "error", "message": f"生成图片失败: {result.get('errmsg')}"}
         
     print(f"[{get_current_time()}] [INFO] 生成图片请求成功，开始获取history_record_id")
+    consume_cached_credit(refresh_token)
     return {"status": "success", "data": result.get("data", {})}
 
-def get_history_by_ids(refresh_token, history_record_ids, max_retries=30, retry_interval=2):
+def get_history_by_ids(refresh_token, history_record_ids, max_retries=30, retry_interval=2, deadline=None):
     uri = "/mweb/v1/get_history_by_ids"
     headers, params = get_common_params(refresh_token, uri)
     
@@ -290,11 +402,12 @@ def get_history_by_ids(refresh_token, history_record_ids, max_retries=30, retry_
     for attempt in range(max_retries):
         print(f"[{get_current_time()}] [INFO] 尝试获取历史记录，第 {attempt+1}/{max_retries} 次")
         
-        response = requests.post(
-            f"https://jimeng.jianying.com{uri}",
+        response = SESSION.post(
+            f"{BASE_URL}{uri}",
             headers=headers,
             params=params,
-            json=data
+            json=data,
+            timeout=bounded_timeout(uri, deadline)
         )
         
         if response.status_code != 200:
@@ -374,6 +487,9 @@ def main(prompt: str, refresh_token: str, width: int = 1664, height: int = 936,
     print(f"[{get_current_time()}] [INFO] 提示词: {prompt}")
     print(f"[{get_current_time()}] [INFO] 参数: 宽度={width}, 高度={height}, 采样强度={sample_strength}")
     try:
+        # 总时限从任务开始时计算，轮询结果时不超过剩余时间
+        deadline = time.monotonic() + REQUEST_DEADLINE if REQUEST_DEADLINE > 0 else None
+        
         # 设置随机种子
         seed = int(time.time() * 1000) % 2147483647
         print(f"[{get_current_time()}] [INFO] 随机种子: {seed}")
@@ -402,7 +518,7 @@ def main(prompt: str, refresh_token: str, width: int = 1664, height: int = 936,
             
         # 获取图片结果
         print(f"[{get_current_time()}] [INFO] 调用get_history_by_ids接口获取图片结果")
-        result = get_history_by_ids(refresh_token, [history_record_id])
+        result = get_history_by_ids(refresh_token, [history_record_id], deadline=deadline)
         
         # 提取图片URL列表
         print(f"[{get_current_time()}] [INFO] 开始提取图片URL")
@@ -1,7 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from dotenv import load_dotenv
 import os
-from controllers.images import generate_images
+from controllers.admission import AdmissionRejected, client_key
+from controllers.files import content_type, image_store
+from controllers.images import coalescing_stats, generate_images_stream, generate_images_with_tokens, history_poller_stats, result_cache, scheduler, token_pool
+from controllers.jobs import job_store, submit_job
+from controllers.tokens import token_split
+from lib.aio import run_sync
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext
+from lib.http_client import breaker_stats, pool_stats
+from lib.metrics import CONTENT_TYPE, registry
+from lib.tracing import start_trace
+from lib.upstream_config import REQUEST_DEADLINE
+import json
 import time
 
 # 加载环境变量
@@ -9,6 +21,73 @@ load_dotenv()
 
 app = Flask(__name__)
 
+# 单次请求最多生成的图片数量
+MAX_IMAGES_PER_REQUEST = int(os.getenv('JIMENG_MAX_IMAGES_PER_REQUEST', '16'))
+
+def get_generation_params(data):
+    # 将请求体转换为生成参数
+    return {
+        'model': data.get('model', 'jimeng-3.0'),
+        'prompt': data.get('prompt'),
+        'width': data.get('width', 1024),
+        'height': data.get('height', 1024),
+        'sample_strength': data.get('sample_strength', 0.5),
+        'negative_prompt': data.get('negativePrompt', '')
+    }
+
+def get_image_count(data):
+    # OpenAI风格的n参数，不传则返回一次生成的全部图片
+    n = data.get('n')
+    if n is None:
+        return None
+    if isinstance(n, bool) or not isinstance(n, int) or not 1 <= n <= MAX_IMAGES_PER_REQUEST:
+        raise ValueError(f'n must be an integer between 1 and {MAX_IMAGES_PER_REQUEST}')
+    return n
+
+def get_request_timeout(timeout_header, data):
+    # 调用方愿意等待的秒数，X-Request-Timeout请求头优先于请求体的timeout字段，未传时返回None
+    timeout = data.get('timeout') if not timeout_header else timeout_header
+    if timeout is None:
+        return None
+    try:
+        if isinstance(timeout, bool):
+            raise ValueError
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise ValueError('timeout must be a positive number of seconds')
+    if not 0 < timeout < float('inf'):
+        raise ValueError('timeout must be a positive number of seconds')
+    return timeout
+
+def get_request_context(auth_header, data, timeout_header=''):
+    # 调用方按Authorization区分，用于在调用方之间公平分配并发；priority越大越先被调度
+    priority = data.get('priority', 0)
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ValueError('priority must be an integer')
+    # 请求的总时限从进入接口时开始计算，取调用方的timeout与服务端上限中较小的一个，
+    # 排队、领积分、提交和等待结果各阶段都不超过剩余时间，调用方放弃后不再继续占用并发
+    budgets = [budget for budget in (get_request_timeout(timeout_header, data), REQUEST_DEADLINE) if budget]
+    deadline = time.monotonic() + min(budgets) if budgets else None
+    return RequestContext(client_key(auth_header), priority, deadline)
+
+def rejected_response(e, status=429):
+    # 排队已满或预计等待过久时返回429，上游熔断时返回503，并建议重试时间
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, status
+
+# SSE响应头，禁止代理缓冲以便进度事件及时送达
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+def format_sse(event):
+    # 与chat.ts的流式输出一致，每个事件一行data，结束时发送[DONE]
+    if event is None:
+        return 'data: [DONE]\n\n'
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
 @app.route('/v1/images/generations', methods=['POST'])
 def generate_image():
     try:
@@ -20,26 +99,152 @@ def generate_image():
         if not auth_header or not auth_header.startswith('Bearer '):
             return jsonify({'error': 'Missing or invalid Authorization header'}), 401
             
-        sessionid = auth_header.split(' ')[1]
-        
-        # 调用生成函数
-        result = generate_images(
-            model=data.get('model', 'jimeng-3.0'),
-            prompt=data.get('prompt'),
-            width=data.get('width', 1024),
-            height=data.get('height', 1024),
-            sample_strength=data.get('sample_strength', 0.5),
-            negative_prompt=data.get('negativePrompt', ''),
-            refresh_token=sessionid
-        )
+        # 支持多个sessionid，以逗号分隔
+        sessionids = token_split(auth_header)
+        if not sessionids:
+            return jsonify({'error': 'Missing or invalid Authorization header'}), 401
+        
+        try:
+            n = get_image_count(data)
+            context = get_request_context(auth_header, data, request.headers.get('X-Request-Timeout', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 按采样比例记录链路，上游调用方可通过traceparent请求头传入链路
+        traceparent = request.headers.get('traceparent', '')
+        
+        # 流式返回生成进度，开始响应前先确认能够排上队
+        if data.get('stream'):
+            scheduler.check(sessionids, context)
+            def stream():
+                # 生成在响应体迭代期间进行，链路也在此时记录
+                with start_trace('POST /v1/images/generations', traceparent, stream=True, n=n or 0):
+                    for event in generate_images_stream(sessionids, n=n, context=context, **get_generation_params(data)):
+                        yield format_sse(event)
+                yield format_sse(None)
+            return Response(stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
+        
+        with start_trace('POST /v1/images/generations', traceparent, stream=False, n=n or 0) as root:
+            # 调用生成函数
+            result = generate_images_with_tokens(sessionids, n=n, context=context, **get_generation_params(data))
+            if result.get('status') != 'success':
+                if root is not None:
+                    root.set_error(str(result.get('message')))
+                return jsonify({'error': result.get('message')}), 500
+            
+            # 配置了本地存储时保存图片，返回本地图片URL
+            image_urls = result['image_urls']
+            if image_store.enabled:
+                image_urls = run_sync(image_store.localize(image_urls, request.host_url))
         
         return jsonify({
             'created': int(time.time()),
-            'data': [{'url': url} for url in result]
+            'data': [{'url': url} for url in image_urls]
         })
         
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except CircuitOpenError as e:
+        return rejected_response(e, 503)
+    except DeadlineExceeded as e:
+        # 请求的总时限已到，调用方不会再等待结果
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/v1/images/files/<file_hash>', methods=['GET'])
+def get_image_file(file_hash):
+    # 返回本地保存的图片，支持Range请求；gunicorn等服务器会使用sendfile发送
+    path = image_store.path_of(file_hash)
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    # 文件名即内容哈希，内容不会变化
+    return send_file(path, mimetype=content_type(path), conditional=True, etag=file_hash, max_age=31536000)
+
+@app.route('/v1/images/jobs', methods=['POST'])
+def create_image_job():
+    try:
+        data = request.get_json()
+        
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({'error': 'Missing or invalid Authorization header'}), 401
+        sessionids = token_split(auth_header)
+        if not sessionids:
+            return jsonify({'error': 'Missing or invalid Authorization header'}), 401
+        
+        try:
+            context = get_request_context(auth_header, data, request.headers.get('X-Request-Timeout', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 提交后立即返回任务ID，结果通过查询接口或callback_url获取
+        with start_trace('POST /v1/images/jobs', request.headers.get('traceparent', '')) as root:
+            result = submit_job(sessionids, callback_url=data.get('callback_url'), context=context, **get_generation_params(data))
+            if result.get('status') != 'success':
+                if root is not None:
+                    root.set_error(str(result.get('message')))
+                return jsonify({'error': result.get('message')}), 500
+        
+        return jsonify(result['job']), 202
+        
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except CircuitOpenError as e:
+        return rejected_response(e, 503)
+    except DeadlineExceeded as e:
+        # 请求的总时限已到，调用方不会再等待结果
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/v1/images/jobs/<job_id>', methods=['GET'])
+def get_image_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/v1/upstream/pool', methods=['GET'])
+def upstream_pool():
+    # 上游连接池统计，用于确认长连接复用情况
+    return jsonify(pool_stats())
+
+@app.route('/v1/upstream/poller', methods=['GET'])
+def upstream_poller():
+    # 结果轮询统计，用于确认每张图片的上游调用次数和完成耗时
+    return jsonify(history_poller_stats())
+
+@app.route('/v1/upstream/tokens', methods=['GET'])
+def upstream_tokens():
+    # 多账号调度状态: 进行中请求数、错误率、积分
+    return jsonify(token_pool.stats())
+
+@app.route('/v1/upstream/cache', methods=['GET'])
+def upstream_cache():
+    # 生成结果缓存的命中次数
+    return jsonify(result_cache.stats())
+
+@app.route('/v1/upstream/coalescing', methods=['GET'])
+def upstream_coalescing():
+    # 相同参数的并发生成和同一token的并发积分查询被合并的次数
+    return jsonify(coalescing_stats())
+
+@app.route('/v1/upstream/admission', methods=['GET'])
+def upstream_admission():
+    # 准入控制状态: 进行中和排队的生成数、拒绝次数、各调用方进行中的生成数
+    return jsonify(scheduler.stats())
+
+@app.route('/v1/upstream/breakers', methods=['GET'])
+def upstream_breakers():
+    # 各上游接口和各账号的熔断器状态: closed / open / half_open
+    return jsonify({'endpoints': breaker_stats(), 'tokens': token_pool.breaker_stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus文本格式的指标: 各阶段耗时分布、失败原因、各账号进行中的生成数、连接池状态
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
+    # 开发调试用的单进程服务器，生产环境在src/api目录下运行gunicorn(配置见gunicorn.conf.py)
     app.run(host='0.0.0.0', port=8000, debug=True) 
\ No newline at end of file
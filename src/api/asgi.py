@@ -0,0 +1,269 @@
+import asyncio
+import json
+import os
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app, SSE_HEADERS, format_sse, get_generation_params, get_image_count, get_request_context
+from controllers.admission import AdmissionRejected
+from controllers.files import FILE_ROUTE, content_type, image_store, parse_range
+from controllers.images import generate_images_stream_async, generate_images_with_tokens_async, scheduler
+from controllers.jobs import submit_job_async, wait_background_jobs
+from controllers.tokens import token_split
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, run_with_context, stream_with_context
+from lib.http_client import DOWNLOAD_CHUNK_SIZE, get_upstream_client
+from lib.tracing import start_trace
+
+# 非生成类接口沿用Flask应用，在线程池中执行
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, data, status: int = 200, headers=None):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode())
+        ] + (headers or [])
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_rejected(send, e, status: int = 429):
+    # 排队已满或预计等待过久时返回429，上游熔断时返回503，并建议重试时间
+    await send_json(send, {'error': str(e)}, status, [(b'retry-after', str(e.retry_after).encode())])
+
+
+async def send_stream(send, events):
+    """以SSE格式逐个发送事件，客户端断开时停止生成器"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + [
+            (key.lower().encode(), value.encode()) for key, value in SSE_HEADERS.items()
+        ]
+    })
+    try:
+        async for event in events:
+            await send({'type': 'http.response.body', 'body': format_sse(event).encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': format_sse(None).encode('utf-8')})
+    finally:
+        await events.aclose()
+
+
+def get_header(scope, name: str) -> str:
+    name = name.lower().encode()
+    for key, value in scope.get('headers', []):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def get_base_url(scope) -> str:
+    host = get_header(scope, 'Host')
+    if not host:
+        server = scope.get('server') or ('localhost', 80)
+        host = f"{server[0]}:{server[1]}"
+    return f"{scope.get('scheme', 'http')}://{host}"
+
+
+async def generate_image(scope, receive, send):
+    """与app.py中的/v1/images/generations一致，等待上游期间只占用一个事件循环任务"""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+
+        # 获取sessionid
+        auth_header = get_header(scope, 'Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return await send_json(send, {'error': 'Missing or invalid Authorization header'}, 401)
+
+        # 支持多个sessionid，以逗号分隔
+        sessionids = token_split(auth_header)
+        if not sessionids:
+            return await send_json(send, {'error': 'Missing or invalid Authorization header'}, 401)
+
+        try:
+            n = get_image_count(data)
+            context = get_request_context(auth_header, data, get_header(scope, 'X-Request-Timeout'))
+        except ValueError as e:
+            return await send_json(send, {'error': str(e)}, 400)
+
+        # 按采样比例记录链路，上游调用方可通过traceparent请求头传入链路
+        traceparent = get_header(scope, 'traceparent')
+
+        # 流式返回生成进度，开始响应前先确认能够排上队
+        if data.get('stream'):
+            scheduler.check(sessionids, context)
+            with start_trace('POST /v1/images/generations', traceparent, stream=True, n=n or 0):
+                return await send_stream(send, stream_with_context(generate_images_stream_async(sessionids, n=n, **get_generation_params(data)), context))
+
+        with start_trace('POST /v1/images/generations', traceparent, stream=False, n=n or 0) as root:
+            # 调用生成函数
+            result = await run_with_context(generate_images_with_tokens_async(sessionids, n=n, **get_generation_params(data)), context)
+            if result.get('status') != 'success':
+                if root is not None:
+                    root.set_error(str(result.get('message')))
+                return await send_json(send, {'error': result.get('message')}, 500)
+
+            # 配置了本地存储时保存图片，返回本地图片URL
+            image_urls = result['image_urls']
+            if image_store.enabled:
+                image_urls = await image_store.localize(image_urls, get_base_url(scope))
+
+        await send_json(send, {
+            'created': int(time.time()),
+            'data': [{'url': url} for url in image_urls]
+        })
+
+    except AdmissionRejected as e:
+        await send_rejected(send, e)
+    except CircuitOpenError as e:
+        await send_rejected(send, e, 503)
+    except DeadlineExceeded as e:
+        await send_json(send, {'error': str(e)}, 504)
+    except Exception as e:
+        await send_json(send, {'error': str(e)}, 500)
+
+
+async def create_image_job(scope, receive, send):
+    """与app.py中的POST /v1/images/jobs一致"""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+
+        auth_header = get_header(scope, 'Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return await send_json(send, {'error': 'Missing or invalid Authorization header'}, 401)
+        sessionids = token_split(auth_header)
+        if not sessionids:
+            return await send_json(send, {'error': 'Missing or invalid Authorization header'}, 401)
+
+        try:
+            context = get_request_context(auth_header, data, get_header(scope, 'X-Request-Timeout'))
+        except ValueError as e:
+            return await send_json(send, {'error': str(e)}, 400)
+
+        # 提交后立即返回任务ID，结果通过查询接口或callback_url获取
+        with start_trace('POST /v1/images/jobs', get_header(scope, 'traceparent')) as root:
+            result = await run_with_context(submit_job_async(sessionids, callback_url=data.get('callback_url'), **get_generation_params(data)), context)
+            if result.get('status') != 'success':
+                if root is not None:
+                    root.set_error(str(result.get('message')))
+                return await send_json(send, {'error': result.get('message')}, 500)
+
+        await send_json(send, result['job'], 202)
+
+    except AdmissionRejected as e:
+        await send_rejected(send, e)
+    except CircuitOpenError as e:
+        await send_rejected(send, e, 503)
+    except DeadlineExceeded as e:
+        await send_json(send, {'error': str(e)}, 504)
+    except Exception as e:
+        await send_json(send, {'error': str(e)}, 500)
+
+
+async def serve_image_file(scope, receive, send):
+    """与app.py中的GET /v1/images/files/<hash>一致，支持Range请求，服务器支持时使用零拷贝发送"""
+    file_hash = scope['path'][len(FILE_ROUTE):]
+    path = image_store.path_of(file_hash)
+    if path is None:
+        return await send_json(send, {'error': 'File not found'}, 404)
+
+    size = os.path.getsize(path)
+    etag = f'"{file_hash}"'
+    headers = [
+        (b'accept-ranges', b'bytes'),
+        (b'etag', etag.encode()),
+        # 文件名即内容哈希，内容不会变化
+        (b'cache-control', b'public, max-age=31536000, immutable')
+    ]
+    if get_header(scope, 'If-None-Match') == etag:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    try:
+        byte_range = parse_range(get_header(scope, 'Range'), size)
+    except ValueError:
+        headers.append((b'content-range', f"bytes */{size}".encode()))
+        await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    status, start, end = 200, 0, size - 1
+    if byte_range is not None:
+        status, (start, end) = 206, byte_range
+        headers.append((b'content-range', f"bytes {start}-{end}/{size}".encode()))
+    length = end - start + 1
+    headers += [
+        (b'content-type', content_type(path).encode()),
+        (b'content-length', str(length).encode())
+    ]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if scope['method'] == 'HEAD' or length == 0:
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    with open(path, 'rb') as f:
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            return await send({'type': 'http.response.zerocopysend', 'file': f, 'offset': start, 'count': length})
+        # 服务器不支持零拷贝时分块读取，读文件在线程池中进行
+        loop = asyncio.get_running_loop()
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await loop.run_in_executor(None, f.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # 已返回任务ID的任务完成后再关闭上游连接
+            await wait_background_jobs()
+            await get_upstream_client().close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# 需要原生异步处理的接口: (方法, 路径) -> 处理函数
+ASYNC_ROUTES = {
+    ('POST', '/v1/images/generations'): generate_image,
+    ('POST', '/v1/images/jobs'): create_image_job,
+}
+
+
+async def app(scope, receive, send):
+    """
+    ASGI入口，例如: uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+    生成接口直接在事件循环中执行异步流水线，其余接口转交Flask应用处理
+    """
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is not None:
+            return await handler(scope, receive, send)
+        if scope['method'] in ('GET', 'HEAD') and scope['path'].startswith(FILE_ROUTE):
+            return await serve_image_file(scope, receive, send)
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,219 @@
+"""
+批量生成图片
+
+从JSONL文件或标准输入逐行读取提示词，每个token保持固定数量的生成同时进行，
+结果逐行追加写入JSONL文件，已完成的ID记入日志文件，中断后重新运行会跳过已完成的提示词
+
+输入每行一个JSON对象，除prompt外均可省略:
+    {"id": "cat-1", "prompt": "一只可爱的猫", "width": 1024, "height": 1024, "n": 4}
+
+用法(在src/api目录下):
+    python batch.py prompts.jsonl -o results.jsonl --tokens sessionid1,sessionid2
+    cat prompts.jsonl | python batch.py - -o results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import AsyncIterator, Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from controllers.images import generate_images_with_tokens_async
+from controllers.tokens import token_split
+from lib.http_client import get_upstream_client
+from lib.logger import logger
+
+DEFAULT_CONCURRENCY = 2  # 每个token同时进行的生成数
+PROGRESS_INTERVAL = 100  # 每完成该数量的提示词输出一次进度
+
+
+class Journal:
+    """
+    已完成提示词ID的日志，每完成一个追加一行
+
+    只记录成功的ID，失败的提示词在下次运行时重试
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._done.update(line.rstrip('\n') for line in f if line.strip())
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._done
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def record(self, item_id: str):
+        self._done.add(item_id)
+        self._file.write(f"{item_id}\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def parse_item(line: str, line_number: int) -> Optional[Tuple[str, Dict]]:
+    """
+    解析一行输入
+
+    Args:
+        line: 输入行，JSON对象或JSON字符串(仅提示词)
+        line_number: 行号，未指定id时作为id
+
+    Returns:
+        Optional[Tuple[str, Dict]]: (id, 生成参数)，空行返回None
+    """
+    line = line.strip()
+    if not line:
+        return None
+    item = json.loads(line)
+    if isinstance(item, str):
+        item = {"prompt": item}
+    if not isinstance(item, dict) or not item.get("prompt"):
+        raise ValueError("缺少prompt")
+    item_id = str(item.get("id", line_number))
+    params = {
+        "prompt": item["prompt"],
+        "model": item.get("model", "jimeng-3.0"),
+        "width": item.get("width", 1024),
+        "height": item.get("height", 1024),
+        "sample_strength": item.get("sample_strength", 0.5),
+        "negative_prompt": item.get("negative_prompt", item.get("negativePrompt", "")),
+        "n": item.get("n")
+    }
+    if "seed" in item:
+        params["seed"] = item["seed"]
+    return item_id, params
+
+
+async def read_lines(path: str) -> AsyncIterator[str]:
+    """逐行读取输入，读取在线程池中进行，标准输入等待数据时不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        while True:
+            line = await loop.run_in_executor(None, f.readline)
+            if not line:
+                return
+            yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+async def run_batch(input_path: str, output_path: str, journal_path: str, tokens, concurrency: int = DEFAULT_CONCURRENCY) -> Dict:
+    """
+    执行批量生成
+
+    同时进行的生成数为concurrency乘以token数量，读取输入的速度受队列长度限制，
+    内存占用与输入文件大小无关
+
+    Args:
+        input_path: 输入JSONL文件路径，-表示标准输入
+        output_path: 结果JSONL文件路径，结果按完成顺序追加写入
+        journal_path: 已完成ID的日志文件路径
+        tokens: 参与生成的token列表
+        concurrency: 每个token同时进行的生成数
+
+    Returns:
+        Dict: 各状态的数量及耗时
+    """
+    workers = max(concurrency, 1) * len(tokens)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    journal = Journal(journal_path)
+    output = open(output_path, 'a', encoding='utf-8')
+    summary = {"succeeded": 0, "failed": 0, "skipped": 0, "invalid": 0}
+    start = time.monotonic()
+
+    def write_result(result: Dict):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+    async def worker():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            item_id, params = entry
+            item_start = time.monotonic()
+            try:
+                result = await generate_images_with_tokens_async(tokens, **params)
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            record = {"id": item_id, "prompt": params["prompt"], "status": result.get("status")}
+            if result.get("status") == "success":
+                record["data"] = [{"url": url} for url in result["image_urls"]]
+            else:
+                record["error"] = result.get("message")
+            record["elapsed"] = round(time.monotonic() - item_start, 3)
+            # 先写结果再记日志，中断时最多重复生成一次，不会丢失结果
+            write_result(record)
+            if record["status"] == "success":
+                journal.record(item_id)
+                summary["succeeded"] += 1
+            else:
+                summary["failed"] += 1
+            finished = summary["succeeded"] + summary["failed"]
+            if finished % PROGRESS_INTERVAL == 0:
+                elapsed = time.monotonic() - start
+                logger.info("批量生成进度: 已完成%d个，失败%d个，%.2f个/秒", finished, summary['failed'], finished / elapsed)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        line_number = 0
+        async for line in read_lines(input_path):
+            line_number += 1
+            try:
+                entry = parse_item(line, line_number)
+            except ValueError as e:
+                summary["invalid"] += 1
+                logger.warning("跳过第%d行无效输入: %s", line_number, e)
+                continue
+            if entry is None:
+                continue
+            if entry[0] in journal:
+                summary["skipped"] += 1
+                continue
+            await queue.put(entry)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        journal.close()
+        output.close()
+        await get_upstream_client().close()
+
+    summary["elapsed"] = round(time.monotonic() - start, 3)
+    return summary
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="从JSONL批量生成图片")
+    parser.add_argument("input", help="输入JSONL文件路径，-表示标准输入")
+    parser.add_argument("-o", "--output", required=True, help="结果JSONL文件路径，结果追加写入")
+    parser.add_argument("--journal", help="已完成ID的日志文件路径，默认为<output>.journal")
+    parser.add_argument("--tokens", default=os.getenv("JIMENG_SESSIONID", ""), help="以逗号分隔的sessionid，默认读取JIMENG_SESSIONID")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="每个token同时进行的生成数")
+    args = parser.parse_args()
+
+    tokens = token_split(args.tokens)
+    if not tokens:
+        parser.error("缺少sessionid，请通过--tokens或JIMENG_SESSIONID指定")
+
+    summary = asyncio.run(run_batch(args.input, args.output, args.journal or f"{args.output}.journal", tokens, args.concurrency))
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
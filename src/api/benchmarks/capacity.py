@@ -0,0 +1,107 @@
+"""
+并发容量测试: 在逐级提高的并发下分别压测各种启动方式的被测服务，比较开发服务器与生产配置能承载的并发
+
+每个(启动方式, 并发)组合都重新启动模拟服务和被测服务，运行一次端到端基准测试(见benchmarks/e2e.py)，
+报告吞吐、p95耗时和失败比例；失败比例不超过--max-error-rate(且指定--max-p95时p95不超过该值)的最高并发即为该方式的容量
+
+运行方式(在src/api目录下):
+    python -m benchmarks.capacity
+    python -m benchmarks.capacity --servers flask,gunicorn,gunicorn-gthread --levels 32,128,512 --duration 20
+
+为了测量服务本身的承载能力，未设置时将准入控制的并发和排队上限放宽到最高并发
+"""
+import argparse
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from benchmarks.common import save_results
+from benchmarks.e2e import SERVERS, benchmark, build_parser
+
+
+def error_rate(result: Dict) -> Optional[float]:
+    if not result["requests"]:
+        return None
+    return round(1 - result["statuses"].get("200", 0) / result["requests"], 4)
+
+
+def capacity(runs: List[Dict], max_error_rate: float, max_p95: Optional[float]) -> Optional[int]:
+    """满足失败比例和p95要求的最高并发，均不满足时为None"""
+    passed = [
+        run["concurrency"] for run in runs
+        if run["error_rate"] is not None and run["error_rate"] <= max_error_rate
+        and (max_p95 is None or (run["p95_ms"] is not None and run["p95_ms"] <= max_p95))
+    ]
+    return max(passed) if passed else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较不同启动方式的并发容量")
+    parser.add_argument("--servers", default="flask,gunicorn", help=f"以逗号分隔的被测启动方式，可选: {', '.join(sorted(SERVERS))}")
+    parser.add_argument("--levels", default="16,64,256", help="以逗号分隔的并发数")
+    parser.add_argument("--duration", type=float, default=20.0, help="每级的计时时长(秒)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="每级的预热时长(秒)")
+    parser.add_argument("--latency", default="lognormal:3,0.3", help="模拟服务的生成耗时分布")
+    parser.add_argument("--request-timeout", type=float, default=60.0, help="单个请求的超时时间(秒)，超时计为失败")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="计入容量的最大失败比例")
+    parser.add_argument("--max-p95", type=float, help="计入容量的最大p95耗时(毫秒)")
+    parser.add_argument("--output", help="结果JSON文件路径，默认为benchmarks/results/capacity-<时间>.json")
+    args = parser.parse_args()
+
+    servers = [server.strip() for server in args.servers.split(",") if server.strip()]
+    levels = sorted(int(level) for level in args.levels.split(","))
+    unknown = [server for server in servers if server not in SERVERS]
+    if unknown:
+        parser.error(f"未知的启动方式: {', '.join(unknown)}")
+
+    # 被测服务从环境变量继承配置
+    os.environ.setdefault("JIMENG_MAX_IN_FLIGHT", str(levels[-1]))
+    os.environ.setdefault("JIMENG_MAX_IN_FLIGHT_PER_TOKEN", str(levels[-1]))
+    os.environ.setdefault("JIMENG_ADMISSION_QUEUE_SIZE", str(levels[-1]))
+
+    results = {}
+    for server in servers:
+        runs = []
+        for level in levels:
+            e2e_args = build_parser().parse_args([
+                "--server", server, "--concurrency", str(level), "--duration", str(args.duration),
+                "--warmup", str(args.warmup), "--latency", args.latency, "--request-timeout", str(args.request_timeout)
+            ])
+            print(f"{server} 并发 {level} ...", flush=True)
+            result = asyncio.run(benchmark(e2e_args))
+            runs.append({
+                "concurrency": level,
+                "requests_per_second": result["throughput"]["requests_per_second"],
+                "p95_ms": result["latency_ms"]["p95"],
+                "error_rate": error_rate(result),
+                "statuses": result["statuses"],
+                "cpu_ms_per_request": result["server"].get("cpu_ms_per_request"),
+                "rss_peak_mb": result["server"].get("rss_peak_mb"),
+            })
+        results[server] = {"capacity": capacity(runs, args.max_error_rate, args.max_p95), "runs": runs}
+
+    print(f"{'server':<18}{'concurrency':>12}{'req/s':>10}{'p95 (ms)':>12}{'errors':>8}{'cpu ms/req':>12}{'rss (MB)':>10}")
+    for server, summary in results.items():
+        for run in summary["runs"]:
+            values = [run["requests_per_second"], run["p95_ms"], run["error_rate"], run["cpu_ms_per_request"], run["rss_peak_mb"]]
+            cells = ["-" if value is None else value for value in values]
+            print(f"{server:<18}{run['concurrency']:>12}{cells[0]:>10}{cells[1]:>12}{cells[2]:>8}{cells[3]:>12}{cells[4]:>10}")
+    for server, summary in results.items():
+        print(f"{server} 容量: {summary['capacity'] if summary['capacity'] is not None else '低于' + str(levels[0])}")
+
+    document = {
+        "config": {
+            "levels": levels,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "latency": args.latency,
+            "max_error_rate": args.max_error_rate,
+            "max_p95": args.max_p95
+        },
+        "results": results
+    }
+    print(f"结果已保存: {save_results('capacity', document, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+基准测试共用的计时、统计和结果保存
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def measure(func: Callable[[], object], seconds: float) -> float:
+    """在给定时间内反复执行func，返回每秒执行次数"""
+    count = 0
+    batch = 200
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(batch):
+            func()
+        count += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """最近秩法计算百分位数，values须已排序，为空时返回None"""
+    if not values:
+        return None
+    rank = math.ceil(p / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """耗时分布(毫秒): 平均值、p50、p95、p99、最大值"""
+    values = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "mean": ms(sum(values) / len(values)) if values else None,
+        "p50": ms(percentile(values, 50)),
+        "p95": ms(percentile(values, 95)),
+        "p99": ms(percentile(values, 99)),
+        "max": ms(values[-1]) if values else None
+    }
+
+
+def environment() -> Dict:
+    """运行环境信息，便于比较不同时间的结果"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "git_revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def save_results(name: str, results: Dict, path: str = None) -> str:
+    """
+    保存结果为JSON文件
+
+    Args:
+        name: 基准测试名称，用于默认文件名
+        results: 测试结果
+        path: 文件路径，默认为benchmarks/results/<name>-<时间>.json
+
+    Returns:
+        str: 保存的文件路径
+    """
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {
+        "benchmark": name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment(),
+        **results
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return path
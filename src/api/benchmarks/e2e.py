@@ -0,0 +1,385 @@
+"""
+端到端基准测试: 以固定并发持续调用/v1/images/generations，上游为simulator.py模拟服务
+
+默认同时启动模拟服务和被测服务(均为子进程)，预热后开始计时，报告吞吐、耗时分布、每张图片的上游调用次数、
+被测服务每个请求消耗的CPU时间及内存增长，结果保存为JSON，可通过--compare与之前的结果比较
+
+运行方式(在src/api目录下):
+    python -m benchmarks.e2e --concurrency 16 --duration 30
+    python -m benchmarks.e2e --server asgi --latency lognormal:3,0.3 --compare benchmarks/results/e2e-20250101-120000.json
+    # 以生产配置(gunicorn.conf.py)运行被测服务
+    python -m benchmarks.e2e --server gunicorn
+    # 压测已启动的服务，服务的JIMENG_BASE_URL须指向--simulator-url，指定--pid时统计该进程的CPU和内存
+    python -m benchmarks.e2e --url http://127.0.0.1:8000 --simulator-url http://127.0.0.1:9000 --pid 12345
+
+CPU和内存从/proc读取(包括被测进程的子进程)，其他系统上不报告这两项
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from benchmarks.common import latency_summary, save_results
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPSTREAM_ENDPOINTS = ("user_credit", "credit_receive", "generate", "get_history_by_ids")
+READY_TIMEOUT = 30  # 等待子进程开始监听的最长时间(秒)
+SAMPLE_INTERVAL = 1.0  # 采样被测服务内存的间隔(秒)
+
+# 被测服务的启动命令
+SERVERS = {
+    # Flask开发服务器(多线程)，与python app.py相同但不启用调试和自动重载
+    "flask": lambda host, port: [sys.executable, "-c", f"from app import app; app.run(host={host!r}, port={port}, threaded=True)"],
+    "asgi": lambda host, port: [sys.executable, "-m", "uvicorn", "asgi:app", "--host", host, "--port", str(port), "--log-level", "warning"],
+    # 生产配置(gunicorn.conf.py)，分别使用ASGI worker和gthread worker
+    "gunicorn": lambda host, port: [sys.executable, "-m", "gunicorn", "--bind", f"{host}:{port}"],
+    "gunicorn-gthread": lambda host, port: [sys.executable, "-m", "gunicorn", "--bind", f"{host}:{port}"],
+}
+# 被测服务额外的环境变量
+SERVER_ENV = {
+    "gunicorn-gthread": {"JIMENG_WORKER_CLASS": "gthread"},
+}
+
+# 比较结果时显示的指标: (名称, 路径, 越大越好)
+COMPARED_METRICS = [
+    ("throughput (req/s)", ("throughput", "requests_per_second"), True),
+    ("images/s", ("throughput", "images_per_second"), True),
+    ("p50 (ms)", ("latency_ms", "p50"), False),
+    ("p95 (ms)", ("latency_ms", "p95"), False),
+    ("p99 (ms)", ("latency_ms", "p99"), False),
+    ("upstream calls/image", ("upstream", "calls_per_image"), False),
+    ("cpu ms/request", ("server", "cpu_ms_per_request"), False),
+    ("rss growth (MB)", ("server", "rss_growth_mb"), False),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def process_usage(pid: int) -> Optional[Tuple[float, int]]:
+    """
+    读取进程及其所有子进程的CPU时间和内存占用
+
+    Returns:
+        Optional[Tuple[float, int]]: (用户态加内核态CPU秒数, RSS字节数)，无法读取/proc时为None
+    """
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    cpu, rss = 0.0, 0
+    pending = [pid]
+    found = False
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                # comm字段可能包含空格，从最后一个右括号之后解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        found = True
+        # utime、stime为第14、15个字段，rss为第24个字段(以页为单位)
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page_size
+        pending.extend(_children(current))
+    return (cpu, rss) if found else None
+
+
+def start_process(command: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    try:
+        return subprocess.Popen(command, cwd=API_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    finally:
+        log.close()
+
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen = None):
+    """等待服务开始响应"""
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"进程已退出({process.returncode}): {' '.join(process.args)}")
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待服务启动超时: {url}")
+
+
+async def fetch_json(session: aiohttp.ClientSession, url: str) -> Dict:
+    async with session.get(url) as response:
+        return await response.json()
+
+
+class LoadResult:
+    """压测期间的请求结果"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.images = 0
+        self.requests = 0
+
+    def record(self, status: str, latency: float, images: int):
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status == "200":
+            self.latencies.append(latency)
+            self.images += images
+
+
+async def run_load(session: aiohttp.ClientSession, url: str, authorization: str, concurrency: int, warmup: float, duration: float, n: Optional[int], on_start) -> Tuple[LoadResult, float]:
+    """
+    以固定并发持续发送请求，预热期间的请求不计入结果
+
+    Args:
+        on_start: 预热结束、开始计时时调用的协程函数
+
+    Returns:
+        Tuple[LoadResult, float]: 计时期间开始的请求的结果，实际计时时长(秒)
+    """
+    result = LoadResult()
+    counter = itertools.count()
+    loop = asyncio.get_running_loop()
+    measure_from = loop.time() + warmup
+    stop_at = measure_from + duration
+
+    async def worker():
+        while loop.time() < stop_at:
+            index = next(counter)
+            body = {"prompt": f"benchmark prompt {index}", "width": 1024, "height": 1024}
+            if n is not None:
+                body["n"] = n
+            start = loop.time()
+            try:
+                async with session.post(url, json=body, headers={"Authorization": authorization}) as response:
+                    data = await response.read()
+                    status = str(response.status)
+                    images = len(json.loads(data).get("data", [])) if response.status == 200 else 0
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                status, images = type(e).__name__, 0
+            if start >= measure_from:
+                result.record(status, loop.time() - start, images)
+
+    async def timer():
+        await asyncio.sleep(warmup)
+        await on_start()
+
+    timer_task = asyncio.create_task(timer())
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await timer_task
+    # 计时期间开始的请求全部完成后才结束，时长按实际结束时间计算
+    return result, loop.time() - measure_from
+
+
+async def benchmark(args) -> Dict:
+    processes = []
+    log_dir = args.log_dir or os.path.join(API_DIR, "benchmarks", "results")
+    os.makedirs(log_dir, exist_ok=True)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        try:
+            simulator_url = args.simulator_url
+            if simulator_url is None:
+                port = free_port()
+                simulator_url = f"http://127.0.0.1:{port}"
+                command = [
+                    sys.executable, "simulator.py", "--port", str(port), "--latency", args.latency, "--rtt", args.rtt,
+                    "--error-rate", str(args.error_rate), "--filter-rate", str(args.filter_rate),
+                    "--rate-limit", str(args.rate_limit), "--image-bytes", str(args.image_bytes)
+                ]
+                processes.append(start_process(command, dict(os.environ), os.path.join(log_dir, "simulator.log")))
+                await wait_ready(session, f"{simulator_url}/simulator/stats", processes[-1])
+
+            url, pid = args.url, args.pid
+            if url is None:
+                port = free_port()
+                url = f"http://127.0.0.1:{port}"
+                env = {
+                    **os.environ,
+                    "JIMENG_BASE_URL": simulator_url,
+                    "JIMENG_LOG_FILE": os.environ.get("JIMENG_LOG_FILE", ""),
+                    "JIMENG_LOG_LEVEL": os.environ.get("JIMENG_LOG_LEVEL", "WARNING"),
+                    **SERVER_ENV.get(args.server, {}),
+                }
+                processes.append(start_process(SERVERS[args.server]("127.0.0.1", port), env, os.path.join(log_dir, "server.log")))
+                pid = processes[-1].pid
+                await wait_ready(session, f"{url}/v1/upstream/pool", processes[-1])
+            url = url.rstrip("/")
+
+            tokens = ",".join(f"benchmark-{i}" for i in range(args.tokens))
+            baseline = {}
+            rss_samples: List[int] = []
+
+            async def on_start():
+                # 开始计时时记录被测服务的CPU时间和模拟服务的调用统计，预热期间的消耗不计入
+                baseline["usage"] = process_usage(pid) if pid else None
+                baseline["upstream"] = await fetch_json(session, f"{simulator_url}/simulator/stats")
+
+            async def sample_rss():
+                while True:
+                    usage = process_usage(pid) if pid else None
+                    if usage is not None:
+                        rss_samples.append(usage[1])
+                    await asyncio.sleep(SAMPLE_INTERVAL)
+
+            sampler = asyncio.create_task(sample_rss())
+            try:
+                result, elapsed = await run_load(session, f"{url}/v1/images/generations", f"Bearer {tokens}", args.concurrency, args.warmup, args.duration, args.n, on_start)
+            finally:
+                sampler.cancel()
+            end_usage = process_usage(pid) if pid else None
+            upstream_end = await fetch_json(session, f"{simulator_url}/simulator/stats")
+        finally:
+            for process in reversed(processes):
+                stop_process(process)
+
+    return report(args, result, elapsed, baseline, end_usage, upstream_end, rss_samples)
+
+
+def report(args, result: LoadResult, elapsed: float, baseline: Dict, end_usage, upstream_end: Dict, rss_samples: List[int]) -> Dict:
+    upstream_start = baseline.get("upstream", {})
+    calls = {
+        endpoint: upstream_end.get("calls", {}).get(endpoint, 0) - upstream_start.get("calls", {}).get(endpoint, 0)
+        for endpoint in UPSTREAM_ENDPOINTS
+    }
+    total_calls = sum(calls.values())
+    server = {}
+    start_usage = baseline.get("usage")
+    if start_usage is not None and end_usage is not None:
+        cpu = end_usage[0] - start_usage[0]
+        server = {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_ms_per_request": round(cpu * 1000 / result.requests, 3) if result.requests else None,
+            "cpu_utilization": round(cpu / elapsed, 3) if elapsed > 0 else None,
+            "rss_start_mb": round(start_usage[1] / 2 ** 20, 1),
+            "rss_end_mb": round(end_usage[1] / 2 ** 20, 1),
+            "rss_peak_mb": round(max(rss_samples + [end_usage[1]]) / 2 ** 20, 1),
+            "rss_growth_mb": round((end_usage[1] - start_usage[1]) / 2 ** 20, 1),
+        }
+    return {
+        "config": {
+            "server": args.server if args.url is None else args.url,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "tokens": args.tokens,
+            "n": args.n,
+            "upstream": upstream_end.get("config")
+        },
+        "requests": result.requests,
+        "statuses": result.statuses,
+        "images": result.images,
+        "elapsed": round(elapsed, 3),
+        "throughput": {
+            "requests_per_second": round(result.statuses.get("200", 0) / elapsed, 3) if elapsed > 0 else None,
+            "images_per_second": round(result.images / elapsed, 3) if elapsed > 0 else None
+        },
+        "latency_ms": latency_summary(result.latencies),
+        "upstream": {
+            "calls": calls,
+            "calls_per_image": round(total_calls / result.images, 3) if result.images else None,
+            "rate_limited": upstream_end.get("rate_limited", 0) - upstream_start.get("rate_limited", 0),
+            "errors": upstream_end.get("errors", 0) - upstream_start.get("errors", 0)
+        },
+        "server": server
+    }
+
+
+def _lookup(results: Dict, path: Tuple[str, ...]):
+    value = results
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def print_summary(results: Dict, baseline: Dict = None):
+    print(f"请求 {results['requests']}，状态 {results['statuses']}，图片 {results['images']}，耗时 {results['elapsed']}s")
+    header = f"{'metric':<24}{'value':>12}"
+    if baseline is not None:
+        header += f"{'baseline':>12}{'change':>10}"
+    print(header)
+    for name, path, higher_is_better in COMPARED_METRICS:
+        value = _lookup(results, path)
+        line = f"{name:<24}{'-' if value is None else value:>12}"
+        if baseline is not None:
+            previous = _lookup(baseline, path)
+            line += f"{'-' if previous is None else previous:>12}"
+            if value is not None and previous:
+                change = (value - previous) / abs(previous) * 100
+                better = (change > 0) == higher_is_better
+                line += f"{change:>+9.1f}%" + (" " if abs(change) < 5 else ("+" if better else "!"))
+        print(line)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="生成接口端到端基准测试")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="flask", help="被测服务的启动方式")
+    parser.add_argument("--url", help="压测已启动的服务，不再启动被测服务")
+    parser.add_argument("--pid", type=int, help="配合--url使用，统计该进程的CPU和内存")
+    parser.add_argument("--simulator-url", help="使用已启动的模拟服务，不再启动模拟服务")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="同时进行的请求数")
+    parser.add_argument("--duration", type=float, default=30.0, help="计时时长(秒)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="预热时长(秒)，期间的请求不计入结果")
+    parser.add_argument("--tokens", type=int, default=4, help="使用的模拟sessionid数量，总并发受JIMENG_MAX_IN_FLIGHT_PER_TOKEN限制")
+    parser.add_argument("-n", type=int, help="每个请求的图片数量，默认为一次生成的全部图片")
+    parser.add_argument("--request-timeout", type=float, default=300.0, help="单个请求的超时时间(秒)")
+    parser.add_argument("--latency", default="lognormal:3,0.3", help="模拟服务的生成耗时分布")
+    parser.add_argument("--rtt", default="fixed:0.02", help="模拟服务的接口响应耗时分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务返回500的比例")
+    parser.add_argument("--filter-rate", type=float, default=0.0, help="模拟服务返回内容被过滤的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="模拟服务每个token每秒允许的调用数")
+    parser.add_argument("--image-bytes", type=int, default=200 * 1024, help="模拟服务返回的图片大小(字节)")
+    parser.add_argument("--log-dir", help="子进程日志目录，默认为benchmarks/results")
+    parser.add_argument("--output", help="结果JSON文件路径，默认为benchmarks/results/e2e-<时间>.json")
+    parser.add_argument("--compare", help="与之前保存的结果JSON比较")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(benchmark(args))
+    print_summary(results, baseline)
+    print(f"结果已保存: {save_results('e2e', results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+生成流程中热点函数的微基准测试: 请求头与签名、Cookie、请求体构建、结果解析与图片URL提取
+
+运行方式(在src/api目录下): python -m benchmarks.helpers [--seconds 2] [--output results.json]
+
+单线程执行，结果即每核每秒可执行的次数
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import measure, save_results
+from controllers.images import build_static_headers, extract_image_urls, generate_cookie, generate_sign, get_common_params, header_cache
+from controllers.payloads import build_history_payload, build_submit_payload
+
+MODEL = "high_aes_general_v30l:general_v3.0_18b"
+PROMPT = "一只可爱的猫，两眼炯炯有神地看着鸡圈里的鸡"
+TOKEN = "a7eb745aec44bb3186dbc2083ea9e1a6"
+HISTORY_ID = "7000000000000000001"
+HISTORY_IDS = [str(7000000000000000000 + i) for i in range(10)]
+
+# 与get_history_by_ids的响应一致的一条已完成记录，含4张图片
+HISTORY_RESPONSE = json.dumps({
+    "ret": "0",
+    "errmsg": "success",
+    "data": {
+        HISTORY_ID: {
+            "status": 50,
+            "fail_code": None,
+            "item_list": [
+                {
+                    "common_attr": {"cover_url": f"https://p3-dreamina-sign.byteimg.com/tos-cn-i/{index}~tplv-cover.webp"},
+                    "image": {
+                        "format": "webp",
+                        "large_images": [{
+                            "image_uri": f"tos-cn-i/{index}",
+                            "image_url": f"https://p3-dreamina-sign.byteimg.com/tos-cn-i/{index}~tplv-2048.webp?x-expires=1735689600&x-signature=abc",
+                            "width": 2048,
+                            "height": 2048,
+                            "format": "webp"
+                        }]
+                    }
+                }
+                for index in range(4)
+            ]
+        }
+    }
+}).encode()
+HISTORY_RECORD = json.loads(HISTORY_RESPONSE)["data"][HISTORY_ID]
+
+
+def parse_history():
+    """generate_images_with_result中获取结果的解析部分: 解析响应并提取图片URL"""
+    result = json.loads(HISTORY_RESPONSE)
+    return extract_image_urls(result["data"][HISTORY_ID])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成流程热点函数微基准测试")
+    parser.add_argument("--seconds", type=float, default=2.0, help="每个用例的运行时间(秒)")
+    parser.add_argument("--output", help="结果JSON文件路径，不指定时不保存")
+    args = parser.parse_args()
+
+    assert len(parse_history()) == 4, "图片URL提取结果不正确"
+
+    uri = "/mweb/v1/aigc_draft/generate"
+    cases = [
+        ("generate_sign", lambda: generate_sign(uri, int(time.time()))),
+        ("generate_cookie", lambda: generate_cookie(TOKEN)),
+        ("build_static_headers", lambda: build_static_headers(TOKEN)),
+        ("get_common_params", lambda: get_common_params(TOKEN, uri)),
+        ("build_submit_payload", lambda: build_submit_payload(MODEL, PROMPT, "", 2523456789, 0.5, 1664, 936)),
+        ("build_history_payload", lambda: build_history_payload(513695, HISTORY_IDS)),
+        ("extract_image_urls", lambda: extract_image_urls(HISTORY_RECORD)),
+        ("parse_history", parse_history),
+    ]
+    # get_common_params命中缓存时只复制请求头，先预热
+    header_cache.get(TOKEN, uri)
+
+    results = {}
+    print(f"{'case':<24}{'ops/s/core':>14}{'us/op':>10}")
+    for name, func in cases:
+        rate = measure(func, args.seconds)
+        results[name] = {"ops_per_second": round(rate), "us_per_op": round(1e6 / rate, 3)}
+        print(f"{name:<24}{rate:>14,.0f}{1e6 / rate:>10.2f}")
+
+    if args.output:
+        print(f"结果已保存: {save_results('helpers', {'seconds': args.seconds, 'results': results}, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+请求体构建的微基准测试: 预编译模板 vs 每次构建字典后json.dumps
+
+运行方式(在src/api目录下): python -m benchmarks.payloads [--seconds 2]
+
+单线程执行，结果即每核每秒可构建的请求体数量
+"""
+import argparse
+import json
+import uuid
+from typing import Dict, List
+
+from benchmarks.common import measure
+from controllers.payloads import build_history_payload, build_submit_payload, get_history_template, get_submit_template
+
+MODEL = "high_aes_general_v30l:general_v3.0_18b"
+AID = 513695
+PROMPT = "一只可爱的猫，两眼炯炯有神地看着鸡圈里的鸡 \"quoted\" \\ backslash"
+HISTORY_IDS = [str(7000000000000000000 + i) for i in range(10)]
+
+
+def build_submit_dict(model: str, prompt: str, negative_prompt: str, seed: int, sample_strength: float, width: int, height: int, ids: Dict[str, str] = None) -> Dict:
+    """模板化之前generate_images中的构建方式，作为对照"""
+    ids = ids or {name: str(uuid.uuid4()) for name in (
+        "submit_id", "draft_id", "component_id", "ability_id", "generate_id",
+        "core_param_id", "history_option_id", "large_image_info_id"
+    )}
+    return {
+        "extend": {
+            "root_model": model,
+            "template_id": ""
+        },
+        "submit_id": ids["submit_id"],
+        "metrics_extra": json.dumps({
+            "templateId": "",
+            "generateCount": 2,
+            "promptSource": "custom",
+            "templateSource": "",
+            "lastRequestId": "",
+            "originRequestId": ""
+        }),
+        "draft_content": json.dumps({
+            "type": "draft",
+            "id": ids["draft_id"],
+            "min_version": "3.0.2",
+            "min_features": [],
+            "is_from_tsn": True,
+            "version": "3.1.5",
+            "main_component_id": ids["component_id"],
+            "component_list": [{
+                "type": "image_base_component",
+                "id": ids["component_id"],
+                "min_version": "3.0.2",
+                "generate_type": "generate",
+                "aigc_mode": "workbench",
+                "abilities": {
+                    "type": "",
+                    "id": ids["ability_id"],
+                    "generate": {
+                        "type": "",
+                        "id": ids["generate_id"],
+                        "core_param": {
+                            "type": "",
+                            "id": ids["core_param_id"],
+                            "model": model,
+                            "prompt": prompt,
+                            "negative_prompt": negative_prompt,
+                            "seed": seed,
+                            "sample_strength": sample_strength,
+                            "image_ratio": 1,
+                            "large_image_info": {
+                                "type": "",
+                                "id": ids["large_image_info_id"],
+                                "height": height,
+                                "width": width,
+                                "resolution_type": "1k"
+                            }
+                        },
+                        "history_option": {
+                            "type": "",
+                            "id": ids["history_option_id"]
+                        }
+                    }
+                }
+            }]
+        })
+    }
+
+
+def build_history_dict(aid: int, history_ids: List[str]) -> Dict:
+    """模板化之前get_history_by_ids中的构建方式，作为对照"""
+    return {
+        "history_ids": history_ids,
+        "image_info": {
+            "width": 2048,
+            "height": 2048,
+            "format": "webp",
+            "image_scene_list": [
+                {"scene": "smart_crop", "width": 360, "height": 360, "uniq_key": "smart_crop-w:360-h:360", "format": "webp"},
+                {"scene": "smart_crop", "width": 480, "height": 480, "uniq_key": "smart_crop-w:480-h:480", "format": "webp"},
+                {"scene": "smart_crop", "width": 720, "height": 720, "uniq_key": "smart_crop-w:720-h:720", "format": "webp"},
+                {"scene": "normal", "width": 2400, "height": 2400, "uniq_key": "2400", "format": "webp"},
+                {"scene": "normal", "width": 1080, "height": 1080, "uniq_key": "1080", "format": "webp"},
+                {"scene": "normal", "width": 720, "height": 720, "uniq_key": "720", "format": "webp"},
+                {"scene": "normal", "width": 480, "height": 480, "uniq_key": "480", "format": "webp"},
+                {"scene": "normal", "width": 360, "height": 360, "uniq_key": "360", "format": "webp"}
+            ]
+        },
+        "http_common_info": {
+            "aid": aid
+        }
+    }
+
+
+def check_equivalence():
+    """确认模板渲染结果与字典构建后json.dumps逐字节一致"""
+    ids = {name: str(uuid.uuid4()) for name in (
+        "submit_id", "draft_id", "component_id", "ability_id", "generate_id",
+        "core_param_id", "history_option_id", "large_image_info_id"
+    )}
+    for prompt, negative_prompt, seed, strength, width, height in [
+        (PROMPT, "", 2523456789, 0.5, 1664, 936),
+        ("line\nbreak\ttab   emoji \U0001F431 </script>", "blurry", 0, 1, 1024, 1024),
+    ]:
+        expected = json.dumps(build_submit_dict(MODEL, prompt, negative_prompt, seed, strength, width, height, ids)).encode()
+        actual = get_submit_template(MODEL).render(prompt=prompt, negative_prompt=negative_prompt, seed=seed, sample_strength=strength, width=width, height=height, **ids)
+        assert actual == expected, "submit请求体与字典构建结果不一致"
+        assert json.loads(json.loads(actual)["draft_content"])["component_list"][0]["abilities"]["generate"]["core_param"]["prompt"] == prompt
+    expected = json.dumps(build_history_dict(AID, HISTORY_IDS)).encode()
+    assert get_history_template(AID).render(history_ids=HISTORY_IDS) == expected, "history请求体与字典构建结果不一致"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="请求体构建微基准测试")
+    parser.add_argument("--seconds", type=float, default=2.0, help="每个用例的运行时间(秒)")
+    args = parser.parse_args()
+
+    check_equivalence()
+
+    cases = [
+        ("submit", "dict + json.dumps",
+         lambda: json.dumps(build_submit_dict(MODEL, PROMPT, "", 2523456789, 0.5, 1664, 936)).encode()),
+        ("submit", "template",
+         lambda: build_submit_payload(MODEL, PROMPT, "", 2523456789, 0.5, 1664, 936)),
+        ("history", "dict + json.dumps",
+         lambda: json.dumps(build_history_dict(AID, HISTORY_IDS)).encode()),
+        ("history", "template",
+         lambda: build_history_payload(AID, HISTORY_IDS)),
+    ]
+    results = {}
+    print(f"{'payload':<10}{'method':<20}{'req/s/core':>14}")
+    for payload, method, func in cases:
+        rate = measure(func, args.seconds)
+        results[(payload, method)] = rate
+        print(f"{payload:<10}{method:<20}{rate:>14,.0f}")
+    for payload in ("submit", "history"):
+        speedup = results[(payload, "template")] / results[(payload, "dict + json.dumps")]
+        print(f"{payload}: 模板快 {speedup:.2f} 倍")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from controllers.tokens import TokenPool
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext, current_context
+
+# 准入控制配置，可通过环境变量覆盖
+MAX_IN_FLIGHT = int(os.getenv("JIMENG_MAX_IN_FLIGHT", "64"))  # 全局同时进行的生成数
+MAX_IN_FLIGHT_PER_TOKEN = int(os.getenv("JIMENG_MAX_IN_FLIGHT_PER_TOKEN", "4"))  # 每个token同时进行的生成数
+QUEUE_SIZE = int(os.getenv("JIMENG_ADMISSION_QUEUE_SIZE", "256"))  # 最多排队的生成数
+MAX_QUEUE_WAIT = float(os.getenv("JIMENG_ADMISSION_MAX_WAIT", "30"))  # 最长排队时间(秒)，预计超过时直接拒绝
+DEFAULT_GENERATION_SECONDS = 20.0  # 完成数不足以估算速率时，假定的单次生成耗时
+RATE_WINDOW = 50  # 估算完成速率使用的最近完成数
+MIN_RATE_SAMPLES = 5
+
+
+class AdmissionRejected(Exception):
+    """排队已满或预计等待过久，应返回429"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def client_key(authorization: str) -> str:
+    """根据Authorization请求头生成调用方标识，不保留原始sessionid"""
+    return hashlib.sha256(authorization.encode()).hexdigest()[:12]
+
+
+class _Waiter:
+    __slots__ = ('seq', 'tokens', 'client', 'priority', 'loop', 'future', 'token')
+
+    def __init__(self, seq: int, tokens: List[str], client: str, priority: int, loop: asyncio.AbstractEventLoop):
+        self.seq = seq
+        self.tokens = tokens
+        self.client = client
+        self.priority = priority
+        self.loop = loop
+        self.future = loop.create_future()
+        self.token: Optional[str] = None
+
+
+def _resolve(future: asyncio.Future, token: str):
+    if not future.done():
+        future.set_result(token)
+
+
+def _fail(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+
+class AdmissionScheduler:
+    """
+    生成请求的准入控制
+
+    每次生成在选择token前先取得并发名额: 全局并发和每个token的并发都有上限，
+    超出时进入有界队列等待。队列按优先级调度，同一优先级下进行中生成最少的调用方优先，
+    避免单个调用方占满并发。队列已满或预计等待时间超过上限时立即拒绝，并给出建议的重试时间
+    """
+
+    def __init__(
+        self,
+        token_pool: TokenPool,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_in_flight_per_token: int = MAX_IN_FLIGHT_PER_TOKEN,
+        queue_size: int = QUEUE_SIZE,
+        max_wait: float = MAX_QUEUE_WAIT
+    ):
+        self._pool = token_pool
+        self._max_in_flight = max_in_flight
+        self._max_per_token = max_in_flight_per_token
+        self._queue_size = queue_size
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiting: List[_Waiter] = []
+        self._in_flight = 0
+        self._token_in_flight: Dict[str, int] = {}
+        self._client_in_flight: Dict[str, int] = {}
+        self._completions = deque(maxlen=RATE_WINDOW)
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = 0
+
+    async def acquire(self, tokens: List[str]) -> str:
+        """
+        取得并发名额并选择token，使用完毕后须调用release
+
+        Args:
+            tokens: 候选token列表
+
+        Returns:
+            str: 选中的token
+
+        Raises:
+            AdmissionRejected: 排队已满、预计等待过久或排队超时
+            CircuitOpenError: 所有候选token都已熔断
+            DeadlineExceeded: 请求的总时限已到，或预计排队时间超过剩余时间
+        """
+        if not tokens:
+            raise ValueError("缺少可用的token")
+        context = current_context()
+        remaining = context.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("请求总时限已到，未开始排队")
+        tokens = list(dict.fromkeys(tokens))
+        with self._lock:
+            # 没有优先级不低于自己且可能用到相同token的排队请求时直接取得名额，
+            # 既不插队，也不会因为其他token繁忙而让空闲的token等待
+            if not self._contended(tokens, context.priority):
+                token = self._grant(tokens, context.client)
+                if token is not None:
+                    self._admitted += 1
+                    return token
+            self._check(tokens, context.priority, remaining)
+            waiter = _Waiter(next(self._seq), tokens, context.client, context.priority, asyncio.get_running_loop())
+            self._waiting.append(waiter)
+            self._queued += 1
+            # 排队后立即尝试分配，名额空闲时不必等到其他请求归还名额
+            self._dispatch()
+
+        # 排队时间不超过请求的剩余时间
+        bounded_by_deadline = remaining is not None and remaining < self._max_wait
+        try:
+            return await asyncio.wait_for(waiter.future, remaining if bounded_by_deadline else self._max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if waiter.token is None:
+                    if waiter in self._waiting:
+                        self._waiting.remove(waiter)
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    self._rejected += 1
+                    if bounded_by_deadline:
+                        raise DeadlineExceeded("请求总时限已到，仍在排队")
+                    raise AdmissionRejected("排队超时，请稍后重试", self._retry_after(self._ahead(waiter.priority), tokens))
+            # 等待结束时名额已经分配
+            if isinstance(e, asyncio.CancelledError):
+                self.release(waiter.token, True)
+                raise
+            return waiter.token
+
+    def check(self, tokens: List[str], context: Optional[RequestContext] = None):
+        """
+        检查是否可以接受新的生成，用于在开始流式响应前提前拒绝
+
+        Args:
+            tokens: 候选token列表
+            context: 请求的调度信息，此时通常尚未进入请求上下文，不传则使用当前上下文
+
+        Raises:
+            AdmissionRejected: 排队已满或预计等待过久
+            DeadlineExceeded: 预计排队时间超过请求的剩余时间
+        """
+        context = context or current_context()
+        with self._lock:
+            self._check(list(dict.fromkeys(tokens)), context.priority, context.remaining())
+
+    def release(self, token: str, success: Optional[bool]):
+        """归还名额，并把名额分配给排队中的生成，success的含义与TokenPool.release一致"""
+        context = current_context()
+        with self._lock:
+            self._pool.release(token, success)
+            self._in_flight = max(self._in_flight - 1, 0)
+            self._decrement(self._token_in_flight, token)
+            self._decrement(self._client_in_flight, context.client)
+            self._completions.append(time.monotonic())
+            self._dispatch()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._waiting),
+                "max_in_flight": self._max_in_flight,
+                "max_in_flight_per_token": self._max_per_token,
+                "queue_size": self._queue_size,
+                "admitted": self._admitted,
+                "queued_total": self._queued,
+                "rejected": self._rejected,
+                "completion_rate": round(self._completion_rate() or 0.0, 3),
+                "clients": dict(self._client_in_flight)
+            }
+
+    def _contended(self, tokens: List[str], priority: int) -> bool:
+        # 是否有优先级不低于该请求、且候选token有交集的排队请求
+        candidates = set(tokens)
+        return any(waiter.priority >= priority and not candidates.isdisjoint(waiter.tokens) for waiter in self._waiting)
+
+    def _ahead(self, priority: int) -> int:
+        # 优先级更低的等待者不会先于该请求被调度
+        return sum(1 for waiter in self._waiting if waiter.priority >= priority)
+
+    def _check(self, tokens: List[str], priority: int, remaining: Optional[float] = None):
+        if len(self._waiting) >= self._queue_size:
+            self._rejected += 1
+            raise AdmissionRejected("排队的请求过多，请稍后重试", self._retry_after(len(self._waiting), tokens))
+        wait = self._estimate_wait(self._ahead(priority) + 1, tokens)
+        if wait > self._max_wait:
+            self._rejected += 1
+            raise AdmissionRejected("预计等待时间过长，请稍后重试", math.ceil(wait))
+        if remaining is not None and wait > remaining:
+            # 排到时结果已经没有意义，直接失败以免占用队列
+            self._rejected += 1
+            raise DeadlineExceeded(f"预计排队{wait:.0f}秒，超过请求剩余时间{max(remaining, 0):.0f}秒")
+
+    def _grant(self, tokens: List[str], client: str) -> Optional[str]:
+        if self._in_flight >= self._max_in_flight:
+            return None
+        eligible = [token for token in tokens if self._token_in_flight.get(token, 0) < self._max_per_token]
+        if not eligible:
+            return None
+        try:
+            token = self._pool.acquire(eligible)
+        except CircuitOpenError:
+            # 并发已满的token可能仍然健康，等待其空出名额
+            if len(eligible) < len(tokens):
+                return None
+            raise
+        self._in_flight += 1
+        self._token_in_flight[token] = self._token_in_flight.get(token, 0) + 1
+        self._client_in_flight[client] = self._client_in_flight.get(client, 0) + 1
+        return token
+
+    def _dispatch(self):
+        # 按优先级、调用方进行中的生成数、排队顺序依次尝试分配
+        while self._waiting and self._in_flight < self._max_in_flight:
+            order = sorted(self._waiting, key=lambda w: (-w.priority, self._client_in_flight.get(w.client, 0), w.seq))
+            for waiter in order:
+                try:
+                    token = self._grant(waiter.tokens, waiter.client)
+                except CircuitOpenError as e:
+                    # 候选token全部熔断，不再等待
+                    self._waiting.remove(waiter)
+                    waiter.loop.call_soon_threadsafe(_fail, waiter.future, e)
+                    token = None
+                    break
+                if token is not None:
+                    break
+            else:
+                return
+            if token is None:
+                continue
+            self._waiting.remove(waiter)
+            waiter.token = token
+            self._admitted += 1
+            # 等待者可能属于其他事件循环
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future, token)
+
+    def _completion_rate(self) -> Optional[float]:
+        if len(self._completions) < MIN_RATE_SAMPLES:
+            return None
+        elapsed = time.monotonic() - self._completions[0]
+        return len(self._completions) / elapsed if elapsed > 0 else None
+
+    def _estimate_wait(self, position: int, tokens: List[str]) -> float:
+        rate = self._completion_rate()
+        if rate is None:
+            capacity = min(self._max_in_flight, self._max_per_token * len(tokens))
+            rate = capacity / DEFAULT_GENERATION_SECONDS
+        return position / rate
+
+    def _retry_after(self, ahead: int, tokens: List[str]) -> int:
+        return max(1, math.ceil(self._estimate_wait(ahead + 1, tokens)))
+
+    @staticmethod
+    def _decrement(counts: Dict[str, int], key: str):
+        count = counts.get(key, 0) - 1
+        if count > 0:
+            counts[key] = count
+        else:
+            counts.pop(key, None)
@@ -0,0 +1,134 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from lib.singleflight import SingleFlight
+
+logger = logging.getLogger('jimeng_api')
+
+# 积分缓存配置，可通过环境变量覆盖
+CREDIT_CACHE_TTL = float(os.getenv("JIMENG_CREDIT_CACHE_TTL", "300"))  # 缓存有效期(秒)，超过后同步查询
+CREDIT_CACHE_SIZE = int(os.getenv("JIMENG_CREDIT_CACHE_SIZE", "1024"))  # 最多缓存的token数量
+CREDIT_LOW_THRESHOLD = int(os.getenv("JIMENG_CREDIT_LOW_THRESHOLD", "5"))  # 余额不高于该值时同步查询
+REFRESH_AFTER = 0.5  # 缓存时间超过有效期的该比例时在后台刷新
+GENERATION_COST = 1  # 每次提交生成预扣的积分
+
+FetchCredit = Callable[[str], Awaitable[Dict]]
+
+
+class _Entry:
+    __slots__ = ('credit', 'fetched_at')
+
+    def __init__(self, credit: Dict, fetched_at: float):
+        self.credit = credit
+        self.fetched_at = fetched_at
+
+
+class CreditCache:
+    """
+    按token缓存的积分余额
+
+    缓存有效且余额充足时直接返回，不再占用请求的关键路径；缓存接近过期时在后台刷新，
+    已过期或余额接近0时才同步查询上游，同一token的并发查询合并为一次请求。提交生成成功后在本地预扣积分
+    """
+
+    def __init__(
+        self,
+        fetch_credit: FetchCredit,
+        ttl: float = CREDIT_CACHE_TTL,
+        max_size: int = CREDIT_CACHE_SIZE,
+        low_threshold: int = CREDIT_LOW_THRESHOLD
+    ):
+        self._fetch_credit = fetch_credit
+        self._ttl = ttl
+        self._max_size = max_size
+        self._low_threshold = low_threshold
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    async def get(self, refresh_token: str) -> Dict:
+        """
+        获取积分信息
+
+        Args:
+            refresh_token: 刷新令牌
+
+        Returns:
+            Dict: 与get_credit返回格式一致的积分信息
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(refresh_token)
+            if entry is not None:
+                self._entries.move_to_end(refresh_token)
+
+        if entry is None or now - entry.fetched_at >= self._ttl or entry.credit["total_credit"] <= self._low_threshold:
+            return await self._refresh(refresh_token)
+
+        if now - entry.fetched_at >= self._ttl * REFRESH_AFTER:
+            self._refresh_in_background(refresh_token)
+        logger.debug("使用缓存的积分信息: 总积分: %s", entry.credit['total_credit'])
+        return dict(entry.credit)
+
+    def peek(self, refresh_token: str) -> Optional[int]:
+        """返回缓存的总积分，未缓存时返回None，不会触发查询"""
+        with self._lock:
+            entry = self._entries.get(refresh_token)
+            return entry.credit["total_credit"] if entry is not None else None
+
+    def consume(self, refresh_token: str, amount: int = GENERATION_COST):
+        """提交生成成功后在本地预扣积分，实际余额以下次刷新为准"""
+        with self._lock:
+            entry = self._entries.get(refresh_token)
+            if entry is not None:
+                entry.credit["total_credit"] = max(entry.credit["total_credit"] - amount, 0)
+
+    def invalidate(self, refresh_token: str):
+        """丢弃缓存，下次获取时同步查询上游"""
+        with self._lock:
+            self._entries.pop(refresh_token, None)
+
+    def flight_stats(self) -> Dict:
+        """积分查询的合并统计"""
+        return self._flight.stats()
+
+    async def _refresh(self, refresh_token: str) -> Dict:
+        credit = await self._flight.do(refresh_token, functools.partial(self._fetch_and_store, refresh_token))
+        return dict(credit)
+
+    async def _fetch_and_store(self, refresh_token: str) -> Dict:
+        credit = await self._fetch_credit(refresh_token)
+        with self._lock:
+            self._entries[refresh_token] = _Entry(dict(credit), time.monotonic())
+            self._entries.move_to_end(refresh_token)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return credit
+
+    def _refresh_in_background(self, refresh_token: str):
+        with self._lock:
+            if refresh_token in self._refreshing:
+                return
+            self._refreshing.add(refresh_token)
+
+        async def refresh():
+            try:
+                await self._refresh(refresh_token)
+            except Exception as e:
+                logger.warning("后台刷新积分失败: %s", e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(refresh_token)
+
+        # 保留任务引用，避免后台任务在完成前被回收
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
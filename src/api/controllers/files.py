@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from typing import List, Optional, Tuple
+
+from lib.http_client import get_upstream_client
+
+logger = logging.getLogger('jimeng_api')
+
+# 本地图片存储配置，可通过环境变量覆盖
+IMAGE_STORE_DIR = os.getenv("JIMENG_IMAGE_STORE_DIR", "")  # 为空时不下载图片，直接返回上游URL
+IMAGE_BASE_URL = os.getenv("JIMENG_IMAGE_BASE_URL", "")  # 本地图片URL的前缀，为空时使用请求的Host
+IMAGE_MAX_BYTES = int(os.getenv("JIMENG_IMAGE_MAX_BYTES", str(50 * 1024 * 1024)))  # 单张图片的大小上限
+DOWNLOAD_TIMEOUT = (5, 30)  # 下载图片的超时: (连接超时, 读取超时)
+
+FILE_ROUTE = "/v1/images/files/"
+
+_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+_RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+# 根据文件头识别图片类型
+_MAGIC_TYPES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+]
+
+
+class ImageStore:
+    """
+    按内容哈希保存的本地图片存储
+
+    图片边下载边计算SHA-256并写入临时文件，完成后以哈希为文件名移入存储目录，
+    相同内容的图片只保存一份。下载过程中不在内存中缓存整张图片
+    """
+
+    def __init__(self, root: str = IMAGE_STORE_DIR, max_bytes: int = IMAGE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root)
+
+    def path_of(self, file_hash: str) -> Optional[str]:
+        """
+        获取已保存图片的路径
+
+        Args:
+            file_hash: 图片内容的SHA-256
+
+        Returns:
+            Optional[str]: 文件路径，哈希无效或文件不存在时返回None
+        """
+        if not self.enabled or not _HASH_PATTERN.fullmatch(file_hash):
+            return None
+        path = os.path.join(self.root, file_hash[:2], file_hash)
+        return path if os.path.isfile(path) else None
+
+    async def store(self, url: str) -> str:
+        """
+        下载图片并保存
+
+        Args:
+            url: 图片地址
+
+        Returns:
+            str: 图片内容的SHA-256
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".download-")
+        digest = hashlib.sha256()
+        size = 0
+        loop = asyncio.get_running_loop()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async def write(chunk: bytes):
+                    nonlocal size
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise Exception(f"图片超过大小上限: {self.max_bytes}字节")
+                    digest.update(chunk)
+                    # 写磁盘在线程池中进行，不阻塞事件循环
+                    await loop.run_in_executor(None, f.write, chunk)
+
+                status = await get_upstream_client().stream_get(url, write, timeout=DOWNLOAD_TIMEOUT)
+            if status != 200:
+                raise Exception(f"下载图片失败: {status}")
+
+            file_hash = digest.hexdigest()
+            path = os.path.join(self.root, file_hash[:2], file_hash)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            return file_hash
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    async def store_all(self, urls: List[str]) -> List[Optional[str]]:
+        """
+        并发下载多张图片
+
+        Returns:
+            List[Optional[str]]: 与urls一一对应的哈希，下载失败的为None
+        """
+        results = await asyncio.gather(*(self.store(url) for url in urls), return_exceptions=True)
+        hashes = []
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logger.warning("保存图片失败，返回上游URL: %s", result)
+                hashes.append(None)
+            else:
+                hashes.append(result)
+        return hashes
+
+    async def localize(self, urls: List[str], base_url: str) -> List[str]:
+        """
+        保存图片并将上游URL替换为本地图片URL，保存失败的图片保留上游URL
+
+        Args:
+            urls: 上游图片地址
+            base_url: 本地服务地址，如http://localhost:8000，配置了IMAGE_BASE_URL时忽略
+
+        Returns:
+            List[str]: 图片URL
+        """
+        base_url = (IMAGE_BASE_URL or base_url).rstrip("/")
+        hashes = await self.store_all(urls)
+        return [f"{base_url}{FILE_ROUTE}{file_hash}" if file_hash else url for url, file_hash in zip(urls, hashes)]
+
+
+def content_type(path: str) -> str:
+    """根据文件头识别图片的Content-Type，即梦默认返回webp"""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mimetype in _MAGIC_TYPES:
+        if head.startswith(magic):
+            return mimetype
+    return "application/octet-stream"
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单个区间的Range请求头
+
+    Args:
+        header: Range请求头，如bytes=0-1023、bytes=-500
+        size: 文件大小
+
+    Returns:
+        Optional[Tuple[int, int]]: 闭区间(start, end)；请求头缺失或无法解析时返回None，
+        此时应返回完整文件
+
+    Raises:
+        ValueError: 区间超出文件范围，应返回416
+    """
+    match = _RANGE_PATTERN.fullmatch(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # 后缀区间: 最后N个字节
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError("请求的区间超出文件范围")
+    return start, end
+
+
+image_store = ImageStore()
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+
+# 请求头缓存配置，可通过环境变量覆盖
+HEADER_CACHE_SIZE = int(os.getenv("JIMENG_HEADER_CACHE_SIZE", "1024"))  # 最多缓存的(token, 接口)组合数量
+
+BuildStatic = Callable[[str], Dict[str, str]]
+Sign = Callable[[str, int], str]
+
+
+class _Entry:
+    __slots__ = ('device_time', 'headers')
+
+    def __init__(self, device_time: int, headers: Dict[str, str]):
+        self.device_time = device_time
+        self.headers = headers
+
+
+class HeaderCache:
+    """
+    按(token, 接口)缓存的请求头
+
+    伪装头和Cookie等不变的部分只在首次使用时构建，Device-Time和Sign每秒最多重新计算一次，
+    长时间轮询时签名始终与当前时间一致
+    """
+
+    def __init__(self, build_static: BuildStatic, sign: Sign, max_size: int = HEADER_CACHE_SIZE):
+        """
+        Args:
+            build_static: 根据token构建不随时间变化的请求头
+            sign: 根据接口路径和设备时间计算签名
+            max_size: 最多缓存的(token, 接口)组合数量，超过后淘汰最久未使用的
+        """
+        self._build_static = build_static
+        self._sign = sign
+        self._max_size = max_size
+        self._static: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, refresh_token: str, uri: str) -> Dict[str, str]:
+        """
+        获取请求头
+
+        Returns:
+            Dict[str, str]: 请求头副本，调用方可以自由修改
+        """
+        device_time = int(time.time())
+        key = (refresh_token, uri)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.device_time != device_time:
+                headers = {
+                    **self._static_headers(refresh_token),
+                    "Device-Time": str(device_time),
+                    "Sign": self._sign(uri, device_time),
+                    "Sign-Ver": "1"
+                }
+                entry = self._entries[key] = _Entry(device_time, headers)
+                self._evict(self._entries)
+            self._entries.move_to_end(key)
+            return dict(entry.headers)
+
+    def _static_headers(self, refresh_token: str) -> Dict[str, str]:
+        headers = self._static.get(refresh_token)
+        if headers is None:
+            headers = self._static[refresh_token] = self._build_static(refresh_token)
+            self._evict(self._static)
+        self._static.move_to_end(refresh_token)
+        return headers
+
+    def _evict(self, cache: OrderedDict):
+        while len(cache) > self._max_size:
+            cache.popitem(last=False)
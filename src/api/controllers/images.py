@@ -1,26 +1,33 @@
+import asyncio
+import functools
 import json
 import uuid
 import time
-import requests
-from typing import Dict, List, Optional, Union
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
 import urllib.parse
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import hashlib
 from urllib.parse import quote
 import logging
-import sys
-
-# 配置日志
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('api_debug.log')
-    ]
-)
-logger = logging.getLogger('jimeng_api')
+import weakref
+
+from controllers.admission import AdmissionScheduler
+from controllers.credit import CreditCache
+from controllers.headers import HeaderCache
+from controllers.payloads import build_history_payload, build_submit_payload
+from controllers.poller import HistoryPoller, poller_stats
+from controllers.results import ResultCache, result_key
+from controllers.tokens import TokenPool
+from lib.aio import iterate_sync, run_sync
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext, run_with_context, stream_with_context, within_deadline
+from lib.http_client import breaker_stats, get_upstream_client, pool_stats
+from lib.logger import log_payloads, logger, setup_logging
+from lib.metrics import registry
+from lib.tracing import span
+from lib.singleflight import SingleFlight
+
+# 配置日志，级别及日志文件见lib/logger.py
+setup_logging()
 
 DEFAULT_ASSISTANT_ID = "513695"
 DEFAULT_MODEL = "high_aes_general_v30l:general_v3.0_18b"
@@ -29,6 +36,7 @@ VERSION_CODE = "5.8.0"
 PLATFORM_CODE = "7"
 DEVICE_ID = str(int(time.time() * 1000) % 100000000 + 2500000000)
 DEFAULT_WEB_ID = str(int(time.time() * 1000) % 100000000 + 2500000000)
+IMAGES_PER_GENERATION = 4  # 一次生成返回的图片数量
 
 # 伪装headers
 FAKE_HEADERS = {
@@ -90,18 +98,19 @@ def generate_cookie(refresh_token):
         f"sid_tt={refresh_token}"
     ]
 
-def get_common_params(refresh_token, uri):
-    logger.debug(f"开始生成通用参数 - URI: {uri}")
-    device_time = get_device_time()
-    sign = generate_sign(uri, device_time)
-    
-    headers = {
+def build_static_headers(refresh_token):
+    # 不随时间变化的请求头，Cookie按token生成一次后复用
+    return {
         **FAKE_HEADERS,
-        "Cookie": "; ".join(generate_cookie(refresh_token)),
-        "Device-Time": str(device_time),
-        "Sign": sign,
-        "Sign-Ver": "1"
+        "Cookie": "; ".join(generate_cookie(refresh_token))
     }
+
+# 按(token, 接口)缓存的请求头，Device-Time和Sign每秒更新
+header_cache = HeaderCache(build_static_headers, generate_sign)
+
+def get_common_params(refresh_token, uri):
+    logger.debug("开始生成通用参数 - URI: %s", uri)
+    headers = header_cache.get(refresh_token, uri)
     
     params = {
         "aid": DEFAULT_ASSISTANT_ID,
@@ -110,52 +119,30 @@ def get_common_params(refresh_token, uri):
         "web_id": DEFAULT_WEB_ID
     }
     
-    logger.debug(f"生成的请求头: {json.dumps(headers, ensure_ascii=False)}")
-    logger.debug(f"生成的参数: {json.dumps(params, ensure_ascii=False)}")
     return headers, params
 
-def get_credit(refresh_token):
+async def get_credit_async(refresh_token):
     logger.info("开始获取信用额度")
     uri = "/commerce/v1/benefits/user_credit"
     headers, params = get_common_params(refresh_token, uri)
     
     try:
-        # 创建会话并配置重试策略
-        session = requests.Session()
-        retry = Retry(
-            total=3,
-            backoff_factor=0.1,
-            status_forcelist=[500, 502, 503, 504]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        
         # 移除Accept-Encoding头，避免服务器返回压缩响应
         headers.pop('Accept-Encoding', None)
         
-        response = session.post(
-            f"https://jimeng.jianying.com{uri}",
+        response = await get_upstream_client().post(
+            uri,
             headers=headers,
             params=params,
-            json={},
-            timeout=15
+            json={}
         )
         
-        logger.debug(f"信用额度请求URL: {response.url}")
-        logger.debug(f"信用额度请求头: {json.dumps(dict(response.request.headers), ensure_ascii=False)}")
-        logger.debug(f"信用额度响应状态码: {response.status_code}")
-        
-        # 检查响应编码
-        if response.encoding is None:
-            response.encoding = 'utf-8'
-            
         # 记录原始响应内容
         raw_content = response.content
-        logger.debug(f"原始响应内容: {raw_content}")
+        log_payloads("信用额度", url=response.url, headers=headers, status=response.status_code, response=raw_content)
         
         if response.status_code != 200:
-            logger.error(f"获取信用额度失败: {response.text}")
+            logger.error("获取信用额度失败: %s", response.text)
             raise Exception(f"获取信用额度失败: {response.text}")
         
         # 处理响应数据
@@ -167,20 +154,20 @@ def get_credit(refresh_token):
             try:
                 # 尝试使用不同的编码方式解码
                 decoded_content = raw_content.decode('utf-8')
-                logger.debug(f"解码后的响应内容: {decoded_content}")
+                logger.debug("解码后的响应内容: %s", decoded_content)
                 data = json.loads(decoded_content)
             except Exception as e:
-                logger.error(f"响应内容解码失败: {str(e)}")
-                logger.error(f"原始响应内容: {raw_content}")
+                logger.error("响应内容解码失败: %s", e)
+                logger.error("原始响应内容: %s", raw_content)
                 raise Exception(f"响应内容解码失败: {str(e)}")
             
         if not isinstance(data, dict):
-            logger.error(f"获取信用额度失败: 响应格式错误")
+            logger.error("获取信用额度失败: 响应格式错误")
             raise Exception("获取信用额度失败: 响应格式错误")
             
         # 检查响应状态
         if data.get("ret") != "0":
-            logger.error(f"获取信用额度失败: {data.get('errmsg')}")
+            logger.error("获取信用额度失败: %s", data.get('errmsg'))
             raise Exception(f"获取信用额度失败: {data.get('errmsg')}")
             
         # 从data字段获取信用信息
@@ -190,7 +177,7 @@ def get_credit(refresh_token):
         vip_credit = credit_data.get("vip_credit", 0)
         total_credit = gift_credit + purchase_credit + vip_credit
         
-        logger.info(f"积分信息: 赠送积分: {gift_credit}, 购买积分: {purchase_credit}, VIP积分: {vip_credit}, 总积分: {total_credit}")
+        logger.info("积分信息: 赠送积分: %s, 购买积分: %s, VIP积分: %s, 总积分: %s", gift_credit, purchase_credit, vip_credit, total_credit)
         
         return {
             "gift_credit": gift_credit,
@@ -199,60 +186,99 @@ def get_credit(refresh_token):
             "total_credit": total_credit
         }
     except Exception as e:
-        logger.error(f"获取信用额度时发生异常: {str(e)}")
+        logger.error("获取信用额度时发生异常: %s", e)
         raise
 
-def receive_credit(refresh_token):
+# 生成流水线各阶段的耗时，轮询阶段的指标见poller.py
+credit_lookup_seconds = registry.histogram("jimeng_credit_lookup_seconds", "生成前获取积分的耗时(含缓存命中)")
+submit_seconds = registry.histogram("jimeng_submit_seconds", "提交生成请求的往返耗时")
+generation_seconds = registry.histogram("jimeng_generation_seconds", "从提交到获取图片URL的总耗时", ["status"])
+
+# 积分缓存，生成前的积分检查优先使用缓存
+credit_cache = CreditCache(get_credit_async)
+# 多账号token池，按负载和健康状况选择token
+token_pool = TokenPool(credit_cache.peek)
+# 按生成参数缓存的结果，相同参数的并发请求合并为一次生成
+result_cache = ResultCache()
+generation_flight = SingleFlight()
+# 生成的准入控制，限制全局和每个token的并发，超出时排队
+scheduler = AdmissionScheduler(token_pool)
+
+# 导出时读取的瞬时状态
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+def _pool_samples(field: str):
+    return lambda: [({}, pool_stats()[field])]
+
+def _pool_usage_samples():
+    pools = pool_stats()["pools"]
+    # 无法读取连接数的连接池不计入
+    return [({"state": state}, sum(pool[state] for pool in pools if pool[state] is not None)) for state in ("idle", "in_use")]
+
+registry.gauge("jimeng_token_in_flight", "各账号进行中的生成数，账号仅保留末4位", lambda: [({"token": item["token"]}, item["in_flight"]) for item in token_pool.stats()])
+registry.gauge("jimeng_token_breaker_state", "各账号熔断器状态: 0关闭 1半开 2打开", lambda: [({"token": item["token"]}, BREAKER_STATE_VALUES[item["state"]]) for item in token_pool.stats()])
+registry.gauge("jimeng_endpoint_breaker_state", "各上游接口熔断器状态: 0关闭 1半开 2打开", lambda: [({"uri": uri}, BREAKER_STATE_VALUES[item["state"]]) for uri, item in breaker_stats().items()])
+registry.gauge("jimeng_admission_in_flight", "准入控制放行的进行中生成数", lambda: [({}, scheduler.stats()["in_flight"])])
+registry.gauge("jimeng_admission_queued", "排队等待的生成数", lambda: [({}, scheduler.stats()["queued"])])
+registry.callback_counter("jimeng_upstream_requests", "发往上游的HTTP请求数", _pool_samples("requests"))
+registry.callback_counter("jimeng_upstream_connections_opened", "新建的上游连接数", _pool_samples("connections_opened"))
+registry.callback_counter("jimeng_upstream_connections_reused", "复用长连接的次数", _pool_samples("connections_reused"))
+registry.gauge("jimeng_upstream_pool_connections", "上游连接池中的连接数", _pool_usage_samples)
+registry.callback_counter("jimeng_upstream_retries", "建立连接失败后的重试次数，denied为因重试预算不足而放弃的次数", lambda: [({"result": "allowed"}, pool_stats()["retry_budget"]["retries"]), ({"result": "denied"}, pool_stats()["retry_budget"]["denied"])])
+
+async def receive_credit_async(refresh_token):
     logger.info("开始领取信用额度")
     uri = "/commerce/v1/benefits/credit_receive"
     headers, params = get_common_params(refresh_token, uri)
     
     try:
-        response = requests.post(
-            f"https://jimeng.jianying.com{uri}",
+        response = await get_upstream_client().post(
+            uri,
             headers=headers,
             params=params,
-            json={"time_zone": "Asia/Shanghai"},
-            timeout=15
+            json={"time_zone": "Asia/Shanghai"}
         )
         
-        logger.debug(f"领取信用额度请求URL: {response.url}")
-        logger.debug(f"领取信用额度请求头: {json.dumps(dict(response.request.headers), ensure_ascii=False)}")
-        logger.debug(f"领取信用额度响应状态码: {response.status_code}")
-        logger.debug(f"领取信用额度响应内容: {response.text}")
+        log_payloads("领取信用额度", url=response.url, headers=headers, status=response.status_code, response=response.content)
         
         if response.status_code != 200:
-            logger.error(f"领取信用额度失败: {response.text}")
+            logger.error("领取信用额度失败: %s", response.text)
             raise Exception(f"领取信用额度失败: {response.text}")
         
         data = response.json()
         if not isinstance(data, dict):
-            logger.error(f"领取信用额度失败: 响应格式错误")
+            logger.error("领取信用额度失败: 响应格式错误")
             raise Exception("领取信用额度失败: 响应格式错误")
             
         cur_total_credits = data.get("cur_total_credits", 0)
         receive_quota = data.get("receive_quota", 0)
         
-        logger.info(f"今日{receive_quota}积分收取成功，剩余积分: {cur_total_credits}")
+        logger.info("今日%s积分收取成功，剩余积分: %s", receive_quota, cur_total_credits)
+        credit_cache.invalidate(refresh_token)
         
         return {
             "cur_total_credits": cur_total_credits,
             "receive_quota": receive_quota
         }
     except Exception as e:
-        logger.error(f"领取信用额度时发生异常: {str(e)}")
+        logger.error("领取信用额度时发生异常: %s", e)
         raise
 
-def generate_images(prompt: str, refresh_token: str = None, sample_strength: float = 0.5, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID)) -> dict:
+async def generate_images_async(prompt: str, refresh_token: str = None, sample_strength: float = 0.5, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), model: str = DEFAULT_MODEL, negative_prompt: str = "") -> dict:
     try:
-        logger.info(f"开始生成图片 - 模型: {DEFAULT_MODEL}, 提示词: {prompt}, 尺寸: 1024x1024, 精细度: 0.5")
-        
-        # 获取信用额度
-        credit_info = get_credit(refresh_token)
+        model = get_model(model)
+        logger.info("开始生成图片 - 模型: %s, 提示词: %s, 尺寸: %sx%s, 精细度: %s", model, prompt, width, height, sample_strength)
+        
+        # 获取信用额度，优先使用缓存
+        start = time.monotonic()
+        with span("credit.lookup"):
+            # 并发的积分查询会被合并，等待其他请求发起的查询时同样不超过本请求的剩余时间
+            credit_info = await within_deadline(credit_cache.get(refresh_token), "积分查询")
+        credit_lookup_seconds.observe(time.monotonic() - start)
         if not credit_info:
             return {"status": "error", "message": "获取信用额度失败"}
             
-        total_credit = credit_info.get("gift_credit", 0) + credit_info.get("purchase_credit", 0) + credit_info.get("vip_credit", 0)
+        total_credit = credit_info.get("total_credit", 0)
         if total_credit < 1:
             return {"status": "error", "message": "信用额度不足"}
             
@@ -268,264 +294,175 @@ def generate_images(prompt: str, refresh_token: str = None, sample_strength: flo
             "scenario": "image_video_generation",
             "feature_key": "aigc_to_image",
             "feature_entrance": "to_image",
-            "feature_entrance_detail": f"to_image-{DEFAULT_MODEL}"
+            "feature_entrance_detail": f"to_image-{model}"
         }
         params["babi_param"] = json.dumps(babi_param)
         
-        # 生成请求数据
-        submit_id = str(uuid.uuid4())
-        draft_id = str(uuid.uuid4())
-        component_id = str(uuid.uuid4())
-        ability_id = str(uuid.uuid4())
-        generate_id = str(uuid.uuid4())
-        core_param_id = str(uuid.uuid4())
-        history_option_id = str(uuid.uuid4())
-        large_image_info_id = str(uuid.uuid4())
-        
-        data = {
-            "extend": {
-                "root_model": DEFAULT_MODEL,
-                "template_id": ""
-            },
-            "submit_id": submit_id,
-            "metrics_extra": json.dumps({
-                "templateId": "",
-                "generateCount": 2,
-                "promptSource": "custom",
-                "templateSource": "",
-                "lastRequestId": "",
-                "originRequestId": ""
-            }),
-            "draft_content": json.dumps({
-                "type": "draft",
-                "id": draft_id,
-                "min_version": "3.0.2",
-                "min_features": [],
-                "is_from_tsn": True,
-                "version": "3.1.5",
-                "main_component_id": component_id,
-                "component_list": [{
-                    "type": "image_base_component",
-                    "id": component_id,
-                    "min_version": "3.0.2",
-                    "generate_type": "generate",
-                    "aigc_mode": "workbench",
-                    "abilities": {
-                        "type": "",
-                        "id": ability_id,
-                        "generate": {
-                            "type": "",
-                            "id": generate_id,
-                            "core_param": {
-                                "type": "",
-                                "id": core_param_id,
-                                "model": DEFAULT_MODEL,
-                                "prompt": prompt,
-                                "negative_prompt": "",
-                                "seed": seed,
-                                "sample_strength": sample_strength,
-                                "image_ratio": 1,
-                                "large_image_info": {
-                                    "type": "",
-                                    "id": large_image_info_id,
-                                    "height": height,
-                                    "width": width,
-                                    "resolution_type": "1k"
-                                }
-                            },
-                            "history_option": {
-                                "type": "",
-                                "id": history_option_id
-                            }
-                        }
-                    }
-                }]
-            })
-        }
+        # 使用预编译模板生成请求体，只填入提示词、种子、尺寸及各ID
+        body = build_submit_payload(model, prompt, negative_prompt, seed, sample_strength, width, height)
+        headers["Content-Type"] = "application/json"
         
         # 发送生成请求
-        response = requests.post(
-            f"https://jimeng.jianying.com{uri}",
+        start = time.monotonic()
+        response = await get_upstream_client().post(
+            uri,
             headers=headers,
             params=params,
-            json=data
+            data=body
         )
+        submit_seconds.observe(time.monotonic() - start)
         
-        logger.debug(f"生成图片请求URL: {response.url}")
-        logger.debug(f"生成图片请求头: {json.dumps(dict(response.request.headers), ensure_ascii=False)}")
-        logger.debug(f"生成图片请求体: {json.dumps(data, ensure_ascii=False)}")
-        logger.debug(f"生成图片响应状态码: {response.status_code}")
-        logger.debug(f"生成图片响应内容: {response.text}")
+        log_payloads("生成图片", url=response.url, headers=headers, body=body, status=response.status_code, response=response.content)
         
         if response.status_code != 200:
+            credit_cache.invalidate(refresh_token)
             return {"status": "error", "message": f"生成图片失败: {response.status_code}"}
             
         result = response.json()
         if result.get("ret") != "0":
+            credit_cache.invalidate(refresh_token)
             return {"status": "error", "message": f"生成图片失败: {result.get('errmsg')}"}
             
+        credit_cache.consume(refresh_token)
         return {"status": "success", "data": result.get("data", {})}
         
+    except (CircuitOpenError, DeadlineExceeded):
+        # 接口熔断或请求总时限已到时直接失败，由调用方返回503或504
+        raise
     except Exception as e:
-        logger.error(f"生成图片时发生异常: {str(e)}")
+        logger.error("生成图片时发生异常: %s", e)
         return {"status": "error", "message": str(e)}
 
-def get_history_by_ids(refresh_token: str, history_record_ids: List[str], max_retries: int = 30, retry_interval: int = 2) -> Dict:
+async def fetch_history_batch_async(refresh_token: str, history_ids: List[str]) -> Dict:
+    """
+    发送一次get_history_by_ids请求，批量查询多个history_record_id的状态
+    
+    Args:
+        refresh_token: 刷新令牌
+        history_ids: 历史记录ID列表(须属于同一token)
+    
+    Returns:
+        Dict: 上游原始响应
+    """
+    uri = "/mweb/v1/get_history_by_ids"
+    headers, params = get_common_params(refresh_token, uri)
+    
+    # 移除Accept-Encoding头，避免服务器返回压缩响应
+    headers.pop('Accept-Encoding', None)
+    
+    # 根据images.ts中的实现构建请求数据，除history_ids外均为预编译的模板
+    body = build_history_payload(int(DEFAULT_ASSISTANT_ID), history_ids)
+    headers["Content-Type"] = "application/json"
+    
+    response = await get_upstream_client().post(
+        uri,
+        headers=headers,
+        params=params,
+        data=body
+    )
+    
+    log_payloads("获取图片结果", url=response.url, headers=headers, body=body, status=response.status_code, response=response.content)
+    
+    if response.status_code != 200:
+        raise Exception(f"获取图片结果失败: {response.status_code}")
+        
+    result = response.json()
+    if result.get("ret") != "0":
+        raise Exception(f"获取图片结果失败: {result.get('errmsg')}")
+    return result
+
+_history_pollers = weakref.WeakKeyDictionary()
+
+def get_history_poller() -> HistoryPoller:
+    """获取当前事件循环的批量轮询器"""
+    loop = asyncio.get_running_loop()
+    poller = _history_pollers.get(loop)
+    if poller is None:
+        poller = _history_pollers[loop] = HistoryPoller(fetch_history_batch_async)
+    return poller
+
+def coalescing_stats() -> Dict:
+    """生成和积分查询的请求合并统计"""
+    return {
+        "generations": generation_flight.stats(),
+        "credits": credit_cache.flight_stats()
+    }
+
+def history_poller_stats() -> Dict:
+    """汇总所有事件循环的轮询统计"""
+    return {
+        **poller_stats.snapshot(),
+        "waiting": sum(poller.waiting for poller in list(_history_pollers.values()))
+    }
+
+async def get_history_by_ids_async(refresh_token: str, history_record_ids: List[str], max_retries: int = 30, retry_interval: int = 2, model: str = DEFAULT_MODEL, width: int = None, height: int = None, on_update: Callable[[str, Dict], None] = None) -> Dict:
     """
     根据history_record_id获取生成图片的结果
     
+    同一token下所有并发等待中的记录由批量轮询器合并为一次请求查询，
+    轮询时间根据同模型、同尺寸的历史完成耗时自适应调整
+    
     Args:
         refresh_token: 刷新令牌
         history_record_ids: 历史记录ID列表
-        max_retries: 最大重试次数
-        retry_interval: 重试间隔(秒)
+        max_retries: 最大重试次数，与retry_interval共同决定总等待时间
+        retry_interval: 无历史耗时样本时的重试间隔(秒)
+        model: 模型，用于耗时统计分组
+        width: 图像宽度，用于耗时统计分组
+        height: 图像高度，用于耗时统计分组
+        on_update: 每次轮询拿到记录数据时以(history_record_id, 记录数据)调用
     
     Returns:
-        Dict: 包含生成图片结果的字典
+        Dict: 包含生成图片结果的字典，poll_count为每条记录的轮询次数
     """
     try:
-        uri = "/mweb/v1/get_history_by_ids"
-        headers, params = get_common_params(refresh_token, uri)
-        
-        # 移除Accept-Encoding头，避免服务器返回压缩响应
-        headers.pop('Accept-Encoding', None)
-        
-        # 根据images.ts中的实现修改请求数据
-        data = {
-            "history_ids": history_record_ids,
-            "image_info": {
-                "width": 2048,
-                "height": 2048,
-                "format": "webp",
-                "image_scene_list": [
-                    {
-                        "scene": "smart_crop",
-                        "width": 360,
-                        "height": 360,
-                        "uniq_key": "smart_crop-w:360-h:360",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "smart_crop",
-                        "width": 480,
-                        "height": 480,
-                        "uniq_key": "smart_crop-w:480-h:480",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "smart_crop",
-                        "width": 720,
-                        "height": 720,
-                        "uniq_key": "smart_crop-w:720-h:720",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "normal",
-                        "width": 2400,
-                        "height": 2400,
-                        "uniq_key": "2400",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "normal",
-                        "width": 1080,
-                        "height": 1080,
-                        "uniq_key": "1080",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "normal",
-                        "width": 720,
-                        "height": 720,
-                        "uniq_key": "720",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "normal",
-                        "width": 480,
-                        "height": 480,
-                        "uniq_key": "480",
-                        "format": "webp",
-                    },
-                    {
-                        "scene": "normal",
-                        "width": 360,
-                        "height": 360,
-                        "uniq_key": "360",
-                        "format": "webp",
-                    }
-                ]
-            },
-            "http_common_info": {
-                "aid": int(DEFAULT_ASSISTANT_ID)
-            }
+        poller = get_history_poller()
+        key = (get_model(model), width, height)
+        results = await asyncio.gather(*[
+            poller.wait(refresh_token, history_id, max_retries, retry_interval, key,
+                        functools.partial(on_update, history_id) if on_update else None)
+            for history_id in history_record_ids
+        ])
+        return {
+            "ret": "0",
+            "data": {history_id: history_data for history_id, (history_data, _) in zip(history_record_ids, results)},
+            "poll_count": {history_id: polls for history_id, (_, polls) in zip(history_record_ids, results)}
         }
         
-        # 完全对应images.ts逻辑的状态变量
-        status = 20  # 初始状态: 20（生成中）
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(
-                    f"https://jimeng.jianying.com{uri}",
-                    headers=headers,
-                    params=params,
-                    json=data
-                )
-                
-                logger.debug(f"获取图片结果请求URL: {response.url}")
-                logger.debug(f"获取图片结果请求头: {json.dumps(dict(response.request.headers), ensure_ascii=False)}")
-                logger.debug(f"获取图片结果请求体: {json.dumps(data, ensure_ascii=False)}")
-                logger.debug(f"获取图片结果响应状态码: {response.status_code}")
-                logger.debug(f"获取图片结果响应内容: {response.text}")
-                
-                if response.status_code != 200:
-                    raise Exception(f"获取图片结果失败: {response.status_code}")
-                    
-                result = response.json()
-                if result.get("ret") != "0":
-                    raise Exception(f"获取图片结果失败: {result.get('errmsg')}")
-                
-                # 严格按照images.ts中的处理逻辑获取结果
-                history_id = history_record_ids[0]
-                if not result.get("data", {}).get(history_id):
-                    raise Exception("记录不存在")
-                    
-                history_data = result["data"][history_id]
-                status = history_data.get("status")
-                fail_code = history_data.get("fail_code")
-                item_list = history_data.get("item_list", [])
-                
-                logger.debug(f"图片生成状态: {status}, 失败代码: {fail_code}, 项目列表: {item_list}")
-                
-                # 与images.ts保持完全一致的状态检查
-                if status == 50:  # 完成
-                    return result
-                elif status == 30:  # 失败
-                    if fail_code == '2038':
-                        raise Exception("内容被过滤")
-                    else:
-                        raise Exception("图片生成失败")
-                elif status == 20:  # 生成中
-                    if attempt < max_retries - 1:
-                        logger.info(f"图片生成中，等待{retry_interval}秒后重试...")
-                        time.sleep(retry_interval)
-                    else:
-                        raise Exception("图片生成超时")
-                else:
-                    raise Exception(f"未知的图片生成状态: {status}")
-                    
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    raise
-                logger.warning(f"获取图片结果失败，重试中... ({str(e)})")
-                time.sleep(retry_interval)
-                
     except Exception as e:
-        logger.error(f"获取图片结果时发生异常: {str(e)}")
+        logger.error("获取图片结果时发生异常: %s", e)
         raise
 
-def generate_images_with_result(prompt: str, width: int = 1664, height: int = 936, refresh_token: str = None, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5) -> dict:
+def extract_image_urls(history_data: Dict) -> List[str]:
+    """
+    从history数据中提取图片URL列表，参考images.ts中的处理逻辑
+    
+    Args:
+        history_data: get_history_by_ids响应中单条记录的数据
+    
+    Returns:
+        List[str]: 图片URL列表
+    """
+    image_urls = []
+    for item in history_data.get("item_list", []):
+        image_url = None
+        # 判断是否存在large_images及其image_url
+        if (item.get("image") and 
+            item["image"].get("large_images") and 
+            len(item["image"]["large_images"]) > 0 and 
+            item["image"]["large_images"][0].get("image_url")):
+            image_url = item["image"]["large_images"][0]["image_url"]
+        else:
+            # 如果没有large_images，则尝试使用cover_url
+            if item.get("common_attr") and item["common_attr"].get("cover_url"):
+                image_url = item["common_attr"]["cover_url"]
+        
+        # 只添加非空URL
+        if image_url:
+            image_urls.append(image_url)
+    return image_urls
+
+async def generate_images_with_result_async(prompt: str, width: int = 1664, height: int = 936, refresh_token: str = None, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "") -> dict:
     """
     生成图片并等待获取结果
     
@@ -536,9 +473,25 @@ def generate_images_with_result(prompt: str, width: int = 1664, height: int = 93
     Returns:
         dict: 包含生成图片结果的字典
     """
+    start = time.monotonic()
+    status = "error"
+    with span("generation", model=model, seed=seed, width=width, height=height, token=f"***{(refresh_token or '')[-4:]}") as trace_span:
+        try:
+            result = await _generate_images_with_result_async(prompt, width, height, refresh_token, seed, sample_strength, model, negative_prompt)
+            status = result.get("status", "error")
+            if trace_span is not None and status != "success":
+                trace_span.set_error(str(result.get("message")))
+            return result
+        except DeadlineExceeded:
+            status = "deadline_exceeded"
+            raise
+        finally:
+            generation_seconds.observe(time.monotonic() - start, status=status)
+
+async def _generate_images_with_result_async(prompt: str, width: int, height: int, refresh_token: str, seed: int, sample_strength: float, model: str, negative_prompt: str) -> dict:
     try:
         # 首先调用生成图片接口
-        generate_result = generate_images(prompt, refresh_token, sample_strength, width, height, seed)
+        generate_result = await generate_images_async(prompt, refresh_token, sample_strength, width, height, seed, model, negative_prompt)
         if generate_result.get("status") != "success":
             return generate_result
             
@@ -548,43 +501,276 @@ def generate_images_with_result(prompt: str, width: int = 1664, height: int = 93
             return {"status": "error", "message": "未获取到history_record_id"}
             
         # 直接调用get_history_by_ids方法获取结果
-        result = get_history_by_ids(refresh_token, [history_record_id])
+        result = await get_history_by_ids_async(refresh_token, [history_record_id], model=model, width=width, height=height)
         
-        # 提取图片URL列表，参考images.ts中的处理逻辑
+        # 提取图片URL列表
         image_urls = []
         if result.get("data", {}).get(history_record_id):
-            item_list = result["data"][history_record_id].get("item_list", [])
-            for item in item_list:
-                image_url = None
-                # 判断是否存在large_images及其image_url
-                if (item.get("image") and 
-                    item["image"].get("large_images") and 
-                    len(item["image"]["large_images"]) > 0 and 
-                    item["image"]["large_images"][0].get("image_url")):
-                    image_url = item["image"]["large_images"][0]["image_url"]
-                else:
-                    # 如果没有large_images，则尝试使用cover_url
-                    if item.get("common_attr") and item["common_attr"].get("cover_url"):
-                        image_url = item["common_attr"]["cover_url"]
-                
-                # 只添加非空URL
-                if image_url:
-                    image_urls.append(image_url)
-            
-            logger.info(f"成功获取到{len(image_urls)}个图片URL")
+            image_urls = extract_image_urls(result["data"][history_record_id])
+            logger.info("成功获取到%d个图片URL", len(image_urls))
         else:
-            logger.warning(f"响应中未找到history_id: {history_record_id}")
+            logger.warning("响应中未找到history_id: %s", history_record_id)
             
         return {
             "status": "success",
             "image_urls": image_urls,
+            "poll_count": result["poll_count"][history_record_id],
             "raw_response": result  # 保留原始响应，以便调试
         }
         
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
     except Exception as e:
-        logger.error(f"生成图片并获取结果时发生异常: {str(e)}")
+        logger.error("生成图片并获取结果时发生异常: %s", e)
         return {"status": "error", "message": str(e)}
 
+def generation_count(n: Optional[int]) -> int:
+    """返回n张图片所需的生成次数，每次生成返回IMAGES_PER_GENERATION张图片"""
+    if n is None:
+        return 1
+    return max(1, -(-n // IMAGES_PER_GENERATION))
+
+async def generate_images_with_tokens_async(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", n: int = None) -> dict:
+    """
+    从多个token中选择负载最低的健康token生成图片并等待获取结果
+    
+    n超过一次生成的图片数时并发提交多次生成，每次分别选择token、使用不同的种子，
+    结果一起轮询，总耗时接近一次生成
+    
+    Args:
+        refresh_tokens: 候选刷新令牌列表
+        prompt: 提示词
+        n: 需要的图片数量，不传则返回一次生成的全部图片
+    
+    Returns:
+        dict: 与generate_images_with_result一致的结果字典，部分生成失败时errors为失败原因
+    
+    Raises:
+        AdmissionRejected: 全部生成都未能取得并发名额
+    """
+    count = generation_count(n)
+    outcomes = await asyncio.gather(*(
+        _generate_images_with_token_async(refresh_tokens, prompt, width, height, seed + i, sample_strength, model, negative_prompt)
+        for i in range(count)
+    ), return_exceptions=True)
+    results = []
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            if count == 1 or isinstance(outcome, asyncio.CancelledError):
+                raise outcome
+            results.append({"status": "error", "message": str(outcome), "exception": outcome})
+        else:
+            results.append(outcome)
+    if count == 1:
+        result = results[0]
+        if n is not None and result.get("status") == "success":
+            result = {**result, "image_urls": result["image_urls"][:n]}
+        return result
+    
+    succeeded = [result for result in results if result.get("status") == "success"]
+    if not succeeded:
+        if "exception" in results[0]:
+            raise results[0]["exception"]
+        return results[0]
+    image_urls = [url for result in succeeded for url in result["image_urls"]]
+    return {
+        "status": "success",
+        "image_urls": image_urls[:n],
+        "poll_count": sum(result["poll_count"] for result in succeeded),
+        "errors": [result.get("message") for result in results if result.get("status") != "success"],
+        "raw_response": [result.get("raw_response") for result in succeeded]
+    }
+
+async def _generate_images_with_token_async(refresh_tokens: List[str], prompt: str, width: int, height: int, seed: int, sample_strength: float, model: str, negative_prompt: str) -> dict:
+    # 同一组账号下参数完全相同的生成直接返回缓存结果，并发的相同请求只提交一次
+    key = result_key(get_model(model), prompt, negative_prompt, seed, width, height, sample_strength, refresh_tokens)
+    with span("result_cache.get") as trace_span:
+        image_urls = await result_cache.get(key)
+        if trace_span is not None:
+            trace_span.set(hit=image_urls is not None)
+    if image_urls is not None:
+        logger.info("使用缓存的生成结果: %d个图片URL", len(image_urls))
+        return {"status": "success", "image_urls": image_urls, "poll_count": 0, "cached": True}
+    
+    async def generate():
+        with span("admission.wait"):
+            refresh_token = await scheduler.acquire(refresh_tokens)
+        success = False
+        try:
+            result = await generate_images_with_result_async(prompt, width, height, refresh_token, seed, sample_strength, model, negative_prompt)
+            # 内容被过滤与token无关，不计入错误率
+            success = result.get("status") == "success" or result.get("message") == "内容被过滤"
+            if result.get("status") == "success":
+                await result_cache.put(key, result["image_urls"])
+            return result
+        except (CircuitOpenError, DeadlineExceeded, asyncio.CancelledError):
+            # 上游接口熔断、请求总时限已到或请求被取消，与token无关
+            success = None
+            raise
+        finally:
+            scheduler.release(refresh_token, success)
+    
+    # 合并到其他请求的生成时，等待时间同样不超过本请求的剩余时间
+    result = await within_deadline(generation_flight.do(key, generate), "生成")
+    # 合并的请求共享同一个结果字典，返回副本以免调用方互相影响
+    return {**result, "image_urls": list(result.get("image_urls", []))} if result.get("status") == "success" else result
+
+async def generate_images_stream_async(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", n: int = None) -> AsyncIterator[Dict]:
+    """
+    生成图片并逐步产出进度事件，用于SSE流式响应
+    
+    事件类型: submitted(已提交)、status(每次轮询的状态)、image(新出现的图片URL)、
+    completed(全部生成结束，包含全部URL)、error(全部生成失败)。
+    submitted和status事件的generation为所属生成的序号，并发生成多次时用于区分
+    
+    Args:
+        refresh_tokens: 候选刷新令牌列表
+        prompt: 提示词
+        n: 需要的图片数量，不传则返回一次生成的全部图片
+    
+    Returns:
+        AsyncIterator[Dict]: 进度事件
+    """
+    count = generation_count(n)
+    events = asyncio.Queue()
+    
+    async def forward(generation: int, stream: AsyncIterator[Dict]):
+        # 各次生成的事件汇入同一队列，结束时放入None
+        try:
+            async for event in stream:
+                events.put_nowait((generation, event))
+        except Exception as e:
+            events.put_nowait((generation, {"type": "error", "message": str(e)}))
+        finally:
+            events.put_nowait((generation, None))
+    
+    loop = asyncio.get_running_loop()
+    tasks = [
+        loop.create_task(forward(i, _generate_images_stream_one(refresh_tokens, prompt, width, height, seed + i, sample_strength, model, negative_prompt)))
+        for i in range(count)
+    ]
+    try:
+        remaining = count
+        image_urls = []
+        errors = []
+        poll_count = 0
+        while remaining:
+            generation, event = await events.get()
+            if event is None:
+                remaining -= 1
+            elif event["type"] == "image":
+                if n is None or len(image_urls) < n:
+                    image_urls.append(event["url"])
+                    yield {"type": "image", "index": len(image_urls) - 1, "url": event["url"]}
+            elif event["type"] == "completed":
+                poll_count += event["poll_count"]
+            elif event["type"] == "error":
+                errors.append(event["message"])
+            else:
+                yield {**event, "generation": generation}
+        
+        if errors and len(errors) == count:
+            yield {"type": "error", "message": errors[0]}
+            return
+        completed = {"type": "completed", "data": [{"url": url} for url in image_urls], "poll_count": poll_count}
+        if errors:
+            completed["errors"] = errors
+        yield completed
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _generate_images_stream_one(refresh_tokens: List[str], prompt: str, width: int, height: int, seed: int, sample_strength: float, model: str, negative_prompt: str) -> AsyncIterator[Dict]:
+    # 一次生成的进度事件，image事件的index为本次生成内的序号
+    key = result_key(get_model(model), prompt, negative_prompt, seed, width, height, sample_strength, refresh_tokens)
+    cached_urls = await result_cache.get(key)
+    if cached_urls is not None:
+        for index, image_url in enumerate(cached_urls):
+            yield {"type": "image", "index": index, "url": image_url}
+        yield {"type": "completed", "data": [{"url": url} for url in cached_urls], "poll_count": 0}
+        return
+    
+    with span("admission.wait"):
+        refresh_token = await scheduler.acquire(refresh_tokens)
+    success = False
+    history_task = None
+    try:
+        try:
+            generate_result = await generate_images_async(prompt, refresh_token, sample_strength, width, height, seed, model, negative_prompt)
+        except (CircuitOpenError, DeadlineExceeded):
+            success = None
+            raise
+        if generate_result.get("status") != "success":
+            yield {"type": "error", "message": generate_result.get("message")}
+            return
+        
+        history_record_id = generate_result.get("data", {}).get("aigc_data", {}).get("history_record_id")
+        if not history_record_id:
+            yield {"type": "error", "message": "未获取到history_record_id"}
+            return
+        yield {"type": "submitted", "history_record_id": history_record_id}
+        
+        # 轮询结果通过队列转交，轮询结束时放入None
+        updates = asyncio.Queue()
+        history_task = asyncio.get_running_loop().create_task(get_history_by_ids_async(
+            refresh_token, [history_record_id], model=model, width=width, height=height,
+            on_update=lambda _, history_data: updates.put_nowait(history_data)
+        ))
+        history_task.add_done_callback(lambda _: updates.put_nowait(None))
+        
+        polls = 0
+        image_urls = []
+        while True:
+            history_data = await updates.get()
+            if history_data is None:
+                break
+            polls += 1
+            yield {"type": "status", "status": history_data.get("status"), "fail_code": history_data.get("fail_code"), "poll": polls}
+            # 部分图片可能先于整体完成返回，出现即推送
+            for image_url in extract_image_urls(history_data):
+                if image_url not in image_urls:
+                    image_urls.append(image_url)
+                    yield {"type": "image", "index": len(image_urls) - 1, "url": image_url}
+        
+        try:
+            history_task.result()
+        except Exception as e:
+            # 内容被过滤和请求总时限已到与token无关，不计入错误率
+            success = None if isinstance(e, DeadlineExceeded) else str(e) == "内容被过滤"
+            yield {"type": "error", "message": str(e)}
+            return
+        success = True
+        await result_cache.put(key, image_urls)
+        yield {"type": "completed", "data": [{"url": url} for url in image_urls], "poll_count": polls}
+    finally:
+        if history_task is not None and not history_task.done():
+            history_task.cancel()
+        scheduler.release(refresh_token, success)
+
+# 同步接口，均为异步流水线的薄封装，在后台事件循环中执行
+
+def get_credit(refresh_token):
+    return run_sync(get_credit_async(refresh_token))
+
+def receive_credit(refresh_token):
+    return run_sync(receive_credit_async(refresh_token))
+
+def generate_images(prompt: str, refresh_token: str = None, sample_strength: float = 0.5, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), model: str = DEFAULT_MODEL, negative_prompt: str = "") -> dict:
+    return run_sync(generate_images_async(prompt, refresh_token, sample_strength, width, height, seed, model, negative_prompt))
+
+def get_history_by_ids(refresh_token: str, history_record_ids: List[str], max_retries: int = 30, retry_interval: int = 2, model: str = DEFAULT_MODEL, width: int = None, height: int = None) -> Dict:
+    return run_sync(get_history_by_ids_async(refresh_token, history_record_ids, max_retries, retry_interval, model, width, height))
+
+def generate_images_with_result(prompt: str, width: int = 1664, height: int = 936, refresh_token: str = None, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "") -> dict:
+    return run_sync(generate_images_with_result_async(prompt, width, height, refresh_token, seed, sample_strength, model, negative_prompt))
+
+def generate_images_with_tokens(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", n: int = None, context: RequestContext = None) -> dict:
+    return run_sync(run_with_context(generate_images_with_tokens_async(refresh_tokens, prompt, width, height, seed, sample_strength, model, negative_prompt, n), context))
+
+def generate_images_stream(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", n: int = None, context: RequestContext = None) -> Iterator[Dict]:
+    return iterate_sync(stream_with_context(generate_images_stream_async(refresh_tokens, prompt, width, height, seed, sample_strength, model, negative_prompt, n), context))
+
 def main(
     prompt: str,
     width: int = 1664,
@@ -635,7 +821,7 @@ def main(
             "image_urls": image_urls
         }
     except Exception as e:
-        logger.error(f"生成图片时发生异常: {str(e)}")
+        logger.error("生成图片时发生异常: %s", e)
         return {
             "status": "error",
             "message": str(e)
@@ -643,10 +829,8 @@ def main(
 
 if __name__ == "__main__":
     try:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
+        # 测试时输出全部日志
+        logging.getLogger().setLevel(logging.DEBUG)
         
         # 测试生成图片
         logger.info("开始测试图片生成")
@@ -655,7 +839,7 @@ if __name__ == "__main__":
             prompt="一只可爱的猫咪",
             refresh_token=refresh_token
         )
-        logger.info(f"生成结果: {result}")
+        logger.info("生成结果: %s", result)
         
     except Exception as e:
-        logger.error(f"测试失败: {str(e)}") 
\ No newline at end of file
+        logger.error("测试失败: %s", e)
\ No newline at end of file
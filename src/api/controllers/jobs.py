@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from controllers.images import (
+    DEFAULT_MODEL,
+    DEFAULT_WEB_ID,
+    extract_image_urls,
+    generate_images_async,
+    get_history_by_ids_async,
+    scheduler
+)
+from lib.aio import run_sync
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext, current_context, run_with_context
+from lib.http_client import get_upstream_client
+from lib.tracing import span
+from lib.upstream_config import REQUEST_DEADLINE
+
+logger = logging.getLogger('jimeng_api')
+
+# 任务表配置，可通过环境变量覆盖
+JOB_TTL = float(os.getenv("JIMENG_JOB_TTL", "3600"))  # 已结束任务的保留时间(秒)
+MAX_JOBS = int(os.getenv("JIMENG_MAX_JOBS", "10000"))  # 任务表最多保存的任务数
+CALLBACK_RETRIES = 3  # 回调失败时的重试次数
+CALLBACK_TIMEOUT = 10  # 回调超时(秒)
+
+# 任务状态
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class Job:
+    """一次异步生成任务"""
+
+    def __init__(self, history_record_id: str, callback_url: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.status = JOB_RUNNING
+        self.created = int(time.time())
+        self.finished_at: Optional[float] = None
+        self.history_record_id = history_record_id
+        self.callback_url = callback_url
+        self.image_urls: List[str] = []
+        self.error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status != JOB_RUNNING
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "history_record_id": self.history_record_id,
+            "data": [{"url": url} for url in self.image_urls],
+            "error": self.error
+        }
+
+
+class JobStore:
+    """
+    进程内任务表
+
+    已结束的任务保留JOB_TTL秒后淘汰；任务数超过上限时优先淘汰最早结束的任务，
+    进行中的任务不会被淘汰
+    """
+
+    def __init__(self, ttl: float = JOB_TTL, max_jobs: int = MAX_JOBS):
+        self._ttl = ttl
+        self._max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job: Job):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def finish(self, job: Job, image_urls: List[str] = None, error: str = None):
+        with self._lock:
+            job.status = JOB_FAILED if error is not None else JOB_SUCCEEDED
+            job.image_urls = image_urls or []
+            job.error = error
+            job.finished_at = time.monotonic()
+            # 按结束时间排序，便于从头部淘汰
+            if job.id in self._jobs:
+                self._jobs.move_to_end(job.id)
+
+    def _evict(self):
+        now = time.monotonic()
+        for job_id in list(self._jobs.keys()):
+            job = self._jobs[job_id]
+            expired = job.finished and now - job.finished_at >= self._ttl
+            over_limit = job.finished and len(self._jobs) > self._max_jobs
+            if expired or over_limit:
+                del self._jobs[job_id]
+
+
+job_store = JobStore()
+
+# 保留后台任务引用，避免任务在完成前被回收
+_background_tasks: Set[asyncio.Task] = set()
+
+
+async def submit_job_async(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", callback_url: str = None) -> Dict:
+    """
+    提交生成任务，拿到history_record_id后立即返回，结果在后台轮询
+
+    Args:
+        refresh_tokens: 候选刷新令牌列表
+        prompt: 提示词
+        callback_url: 任务结束后以POST方式推送任务信息的地址
+
+    Returns:
+        Dict: 成功时status为success，job为任务信息；失败时status为error
+
+    Raises:
+        AdmissionRejected: 未能取得并发名额
+        CircuitOpenError: 所有候选token或上游接口已熔断
+        DeadlineExceeded: 提交完成前请求的总时限已到
+    """
+    with span("admission.wait"):
+        refresh_token = await scheduler.acquire(refresh_tokens)
+    try:
+        generate_result = await generate_images_async(prompt, refresh_token, sample_strength, width, height, seed, model, negative_prompt)
+        if generate_result.get("status") != "success":
+            scheduler.release(refresh_token, False)
+            return generate_result
+
+        history_record_id = generate_result.get("data", {}).get("aigc_data", {}).get("history_record_id")
+        if not history_record_id:
+            scheduler.release(refresh_token, False)
+            return {"status": "error", "message": "未获取到history_record_id"}
+    except (CircuitOpenError, DeadlineExceeded, asyncio.CancelledError):
+        # 上游接口熔断、请求总时限已到或请求被取消，与token无关
+        scheduler.release(refresh_token, None)
+        raise
+    except Exception:
+        scheduler.release(refresh_token, False)
+        raise
+
+    job = Job(history_record_id, callback_url)
+    job_store.add(job)
+    logger.info("生成任务已提交: %s, history_record_id: %s", job.id, history_record_id)
+
+    # 调用方的timeout只约束等待提交结果的时间，后台轮询按服务端的总时限重新计时；
+    # 调用方和优先级保持不变，结束时按同一调用方归还名额
+    context = current_context()
+    deadline = time.monotonic() + REQUEST_DEADLINE if REQUEST_DEADLINE > 0 else None
+    job_context = RequestContext(context.client, context.priority, deadline)
+    task = asyncio.get_running_loop().create_task(run_with_context(_run_job(job, refresh_token, model, width, height), job_context))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return {"status": "success", "job": job.to_dict()}
+
+
+async def wait_background_jobs():
+    """
+    等待当前事件循环中进行中的任务结束
+
+    服务退出(如gunicorn按max_requests回收worker)前调用，避免已返回任务ID的任务被中断。
+    每个任务受请求总时限约束，等待时间不会超过JIMENG_REQUEST_DEADLINE
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [task for task in _background_tasks if task.get_loop() is loop]
+    if tasks:
+        logger.info("等待%d个进行中的生成任务结束", len(tasks))
+        await asyncio.wait(tasks)
+
+
+def submit_job(refresh_tokens: List[str], prompt: str, width: int = 1664, height: int = 936, seed: int = int(DEFAULT_WEB_ID), sample_strength: float = 0.5, model: str = DEFAULT_MODEL, negative_prompt: str = "", callback_url: str = None, context: RequestContext = None) -> Dict:
+    # 同步接口，任务在后台事件循环中继续轮询
+    return run_sync(run_with_context(submit_job_async(refresh_tokens, prompt, width, height, seed, sample_strength, model, negative_prompt, callback_url), context))
+
+
+async def _run_job(job: Job, refresh_token: str, model: str, width: int, height: int):
+    success = False
+    try:
+        result = await get_history_by_ids_async(refresh_token, [job.history_record_id], model=model, width=width, height=height)
+        image_urls = extract_image_urls(result["data"][job.history_record_id])
+        job_store.finish(job, image_urls=image_urls)
+        success = True
+        logger.info("生成任务完成: %s, 获取到%d个图片URL", job.id, len(image_urls))
+    except Exception as e:
+        job_store.finish(job, error=str(e))
+        # 内容被过滤和任务总时限已到与token无关，不计入错误率
+        success = None if isinstance(e, DeadlineExceeded) else str(e) == "内容被过滤"
+        logger.error("生成任务失败: %s, %s", job.id, e)
+    finally:
+        scheduler.release(refresh_token, success)
+
+    if job.callback_url:
+        await _send_callback(job)
+
+
+async def _send_callback(job: Job):
+    for attempt in range(CALLBACK_RETRIES):
+        try:
+            response = await get_upstream_client().post_url(job.callback_url, timeout=CALLBACK_TIMEOUT, json=job.to_dict())
+            if 200 <= response.status_code < 300:
+                return
+            logger.warning("任务回调失败: %s, 状态码: %s", job.id, response.status_code)
+        except Exception as e:
+            logger.warning("任务回调失败: %s, %s", job.id, e)
+        if attempt < CALLBACK_RETRIES - 1:
+            await asyncio.sleep(2 ** attempt)
+    logger.error("任务回调多次失败，放弃推送: %s", job.id)
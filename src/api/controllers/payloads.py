@@ -0,0 +1,259 @@
+import functools
+import json
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+# 占位符格式，仅出现在模板骨架中，用户输入在拆分模板之后才填入，不会被当作占位符
+_MARKER = "@@jimeng:{}@@"
+_MARKER_PATTERN = re.compile(r"@@jimeng:(\w+)@@")
+
+# 无需转义的字符串(可打印ASCII且不含引号和反斜杠)，任意嵌套层级下编码结果都只是加上引号
+_PLAIN_STRING = re.compile(r"[ !#-\[\]-~]*")
+
+
+def encode_value(value: Any, depth: int = 0) -> str:
+    """
+    按字段所在的嵌套层级编码JSON值
+
+    depth为0时即json.dumps的结果；字段位于被序列化为字符串的JSON(如draft_content)中时，
+    每嵌套一层再按字符串内容转义一次
+
+    Args:
+        value: 字段值
+        depth: 字段所在的字符串嵌套层数
+
+    Returns:
+        str: 可直接拼接进模板的JSON片段
+    """
+    if type(value) is int:
+        return str(value)
+    if type(value) is str and _PLAIN_STRING.fullmatch(value):
+        quote = _quote(depth)
+        return f"{quote}{value}{quote}"
+    encoded = json.dumps(value)
+    for _ in range(depth):
+        encoded = json.dumps(encoded)[1:-1]
+    return encoded
+
+
+@functools.lru_cache(maxsize=None)
+def _quote(depth: int) -> str:
+    # 各嵌套层级下字符串引号的写法: "、\"、\\\"...
+    quote = '"'
+    for _ in range(depth):
+        quote = json.dumps(quote)[1:-1]
+    return quote
+
+
+def new_uuid4s(count: int) -> List[str]:
+    """
+    批量生成UUID4字符串，与str(uuid.uuid4())格式一致
+
+    一次读取所有随机字节，省去逐个构造UUID对象的开销
+    """
+    digits = os.urandom(16 * count).hex()
+    ids = []
+    for offset in range(0, 32 * count, 32):
+        h = digits[offset:offset + 32]
+        # 设置版本号(4)和变体位(10xx)
+        ids.append(f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{'89ab'[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}")
+    return ids
+
+
+def field(name: str) -> str:
+    """模板骨架中的占位符，序列化后在最终请求体中替换为对应字段的值"""
+    return _MARKER.format(name)
+
+
+class JsonTemplate:
+    """
+    预编译的JSON请求体模板
+
+    骨架只序列化一次并拆分为字节片段，渲染时仅对可变字段做JSON转义后拼接，
+    结果与json.dumps整个请求体逐字节一致
+    """
+
+    def __init__(self, skeleton: Dict, depths: Dict[str, int] = None):
+        """
+        Args:
+            skeleton: 含占位符的请求体，嵌套的JSON字符串须已用json.dumps序列化
+            depths: 各字段所在的字符串嵌套层数，未列出的字段为0
+        """
+        depths = depths or {}
+        text = json.dumps(skeleton)
+        self._segments: List[bytes] = []
+        self._fields: List[Tuple[str, int]] = []
+        position = 0
+        for match in _MARKER_PATTERN.finditer(text):
+            name = match.group(1)
+            depth = depths.get(name, 0)
+            # 占位符本身是字符串，序列化后带有(可能已转义的)引号，替换时一并去掉
+            quote = _quote(depth)
+            start, end = match.start() - len(quote), match.end() + len(quote)
+            if text[start:match.start()] != quote or text[match.end():end] != quote:
+                raise ValueError(f"模板字段{name}的嵌套层数与骨架不一致")
+            self._segments.append(text[position:start].encode())
+            self._fields.append((name, depth))
+            position = end
+        self._segments.append(text[position:].encode())
+
+    @property
+    def fields(self) -> List[str]:
+        return [name for name, _ in self._fields]
+
+    def render(self, **values) -> bytes:
+        """
+        填入可变字段，生成请求体
+
+        Returns:
+            bytes: UTF-8编码的JSON请求体
+        """
+        parts = [self._segments[0]]
+        for (name, depth), segment in zip(self._fields, self._segments[1:]):
+            parts.append(encode_value(values[name], depth).encode())
+            parts.append(segment)
+        return b"".join(parts)
+
+
+# draft_content中的字段，位于被序列化为字符串的JSON中
+_DRAFT_FIELDS = (
+    "draft_id", "component_id", "ability_id", "generate_id", "core_param_id",
+    "history_option_id", "large_image_info_id",
+    "prompt", "negative_prompt", "seed", "sample_strength", "width", "height"
+)
+
+# 每次提交都重新生成的ID
+_SUBMIT_IDS = ("submit_id",) + _DRAFT_FIELDS[:7]
+
+
+@functools.lru_cache(maxsize=64)
+def get_submit_template(model: str) -> JsonTemplate:
+    """
+    获取aigc_draft/generate请求体模板，按模型缓存
+
+    字段结构与images.ts中的实现一致，提示词、种子、尺寸及各ID在渲染时填入
+    """
+    draft_content = {
+        "type": "draft",
+        "id": field("draft_id"),
+        "min_version": "3.0.2",
+        "min_features": [],
+        "is_from_tsn": True,
+        "version": "3.1.5",
+        "main_component_id": field("component_id"),
+        "component_list": [{
+            "type": "image_base_component",
+            "id": field("component_id"),
+            "min_version": "3.0.2",
+            "generate_type": "generate",
+            "aigc_mode": "workbench",
+            "abilities": {
+                "type": "",
+                "id": field("ability_id"),
+                "generate": {
+                    "type": "",
+                    "id": field("generate_id"),
+                    "core_param": {
+                        "type": "",
+                        "id": field("core_param_id"),
+                        "model": model,
+                        "prompt": field("prompt"),
+                        "negative_prompt": field("negative_prompt"),
+                        "seed": field("seed"),
+                        "sample_strength": field("sample_strength"),
+                        "image_ratio": 1,
+                        "large_image_info": {
+                            "type": "",
+                            "id": field("large_image_info_id"),
+                            "height": field("height"),
+                            "width": field("width"),
+                            "resolution_type": "1k"
+                        }
+                    },
+                    "history_option": {
+                        "type": "",
+                        "id": field("history_option_id")
+                    }
+                }
+            }
+        }]
+    }
+    skeleton = {
+        "extend": {
+            "root_model": model,
+            "template_id": ""
+        },
+        "submit_id": field("submit_id"),
+        "metrics_extra": json.dumps({
+            "templateId": "",
+            "generateCount": 2,
+            "promptSource": "custom",
+            "templateSource": "",
+            "lastRequestId": "",
+            "originRequestId": ""
+        }),
+        "draft_content": json.dumps(draft_content)
+    }
+    return JsonTemplate(skeleton, {name: 1 for name in _DRAFT_FIELDS})
+
+
+def build_submit_payload(model: str, prompt: str, negative_prompt: str, seed: int, sample_strength: float, width: int, height: int) -> bytes:
+    """
+    生成aigc_draft/generate请求体
+
+    Returns:
+        bytes: 与按字典构建后json.dumps的结果一致的请求体
+    """
+    ids = dict(zip(_SUBMIT_IDS, new_uuid4s(len(_SUBMIT_IDS))))
+    return get_submit_template(model).render(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        seed=seed,
+        sample_strength=sample_strength,
+        width=width,
+        height=height,
+        **ids
+    )
+
+
+# get_history_by_ids返回的图片尺寸，与images.ts中的实现一致
+_IMAGE_SCENES = [
+    ("smart_crop", 360, "smart_crop-w:360-h:360"),
+    ("smart_crop", 480, "smart_crop-w:480-h:480"),
+    ("smart_crop", 720, "smart_crop-w:720-h:720"),
+    ("normal", 2400, "2400"),
+    ("normal", 1080, "1080"),
+    ("normal", 720, "720"),
+    ("normal", 480, "480"),
+    ("normal", 360, "360"),
+]
+
+
+@functools.lru_cache(maxsize=8)
+def get_history_template(aid: int) -> JsonTemplate:
+    """获取get_history_by_ids请求体模板，只有history_ids需要在渲染时填入"""
+    skeleton = {
+        "history_ids": field("history_ids"),
+        "image_info": {
+            "width": 2048,
+            "height": 2048,
+            "format": "webp",
+            "image_scene_list": [{
+                "scene": scene,
+                "width": size,
+                "height": size,
+                "uniq_key": uniq_key,
+                "format": "webp",
+            } for scene, size, uniq_key in _IMAGE_SCENES]
+        },
+        "http_common_info": {
+            "aid": aid
+        }
+    }
+    return JsonTemplate(skeleton)
+
+
+def build_history_payload(aid: int, history_ids: List[str]) -> bytes:
+    """生成get_history_by_ids请求体"""
+    return get_history_template(aid).render(history_ids=history_ids)
@@ -0,0 +1,339 @@
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, current_context, within_deadline
+from lib.metrics import registry
+from lib.tracing import Span, record_span, span
+
+logger = logging.getLogger('jimeng_api')
+
+# 单次get_history_by_ids请求最多携带的history_id数量
+MAX_BATCH_SIZE = 50
+# 即将到期(该时间内)的等待者合并到同一次请求中
+COALESCE_WINDOW = 0.5
+
+# 自适应轮询参数
+HISTORY_SIZE = 200  # 每个模型/尺寸保留的最近完成耗时样本数
+MIN_SAMPLES = 5  # 样本不足时使用固定间隔轮询
+MIN_INTERVAL = 1.0  # 最小轮询间隔(秒)
+MAX_BACKOFF = 8.0  # 超过预计完成时间后退避的最大间隔(秒)
+
+FetchBatch = Callable[[str, List[str]], Awaitable[Dict]]
+OnUpdate = Callable[[Dict], None]
+
+
+class LatencyTracker:
+    """按模型和尺寸记录最近的生成完成耗时，用于估计下一次生成的完成时间"""
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        self._size = size
+        self._samples: Dict[Hashable, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self._size)
+            samples.append(seconds)
+
+    def quantiles(self, key: Hashable) -> Optional[Tuple[float, float, float]]:
+        """返回(p10, p50, p90)，样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        last = len(samples) - 1
+        return samples[int(last * 0.1)], samples[int(last * 0.5)], samples[int(last * 0.9)]
+
+
+class PollerStats:
+    """轮询统计，batch_factor即平均每次请求合并的记录数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.ids_polled = 0
+        self.completed = 0
+        self.completed_polls = 0
+        self._recent_latency = deque(maxlen=1000)
+
+    def record_request(self, ids: int):
+        with self._lock:
+            self.requests_sent += 1
+            self.ids_polled += ids
+
+    def record_completion(self, polls: int, seconds: float):
+        with self._lock:
+            self.completed += 1
+            self.completed_polls += polls
+            self._recent_latency.append(seconds)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            latencies = sorted(self._recent_latency)
+            return {
+                "requests_sent": self.requests_sent,
+                "ids_polled": self.ids_polled,
+                "batch_factor": self.ids_polled / self.requests_sent if self.requests_sent else 0,
+                "completed": self.completed,
+                "polls_per_generation": self.completed_polls / self.completed if self.completed else 0,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0
+            }
+
+
+# 进程内共享，所有事件循环的轮询器共同学习完成耗时并汇总统计
+latency_tracker = LatencyTracker()
+poller_stats = PollerStats()
+
+time_to_result = registry.histogram("jimeng_time_to_result_seconds", "提交生成后到查询到完成状态的耗时")
+polls_per_generation = registry.histogram("jimeng_polls_per_generation", "每次生成完成前的轮询次数", buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30))
+generation_failures = registry.counter("jimeng_generation_failures", "上游返回生成失败的次数，按fail_code区分(2038为内容被过滤)", ["fail_code"])
+
+
+class PollSchedule:
+    """
+    单次生成的轮询计划
+
+    有足够历史样本时: 在p10时首次轮询，p10到p90之间密集轮询，超过p90后指数退避并加入抖动。
+    样本不足时按固定间隔轮询
+    """
+
+    def __init__(self, quantiles: Optional[Tuple[float, float, float]], retry_interval: float):
+        self.quantiles = quantiles
+        self.retry_interval = retry_interval
+        self._backoffs = 0
+
+    def first_delay(self) -> float:
+        if self.quantiles is None:
+            return self.retry_interval
+        return max(MIN_INTERVAL, self.quantiles[0])
+
+    def next_delay(self, elapsed: float) -> float:
+        if self.quantiles is None:
+            return self.retry_interval
+        p10, p50, p90 = self.quantiles
+        if elapsed < p10:
+            return max(MIN_INTERVAL, p10 - elapsed)
+        if elapsed < p90:
+            return min(max(MIN_INTERVAL, (p90 - p10) / 4), self.retry_interval)
+        base = min(MAX_BACKOFF, self.retry_interval * (2 ** self._backoffs))
+        self._backoffs += 1
+        return random.uniform(base / 2, base)
+
+
+class _Waiter:
+    __slots__ = ('history_id', 'future', 'schedule', 'key', 'start', 'deadline', 'last_poll', 'attempts', 'due', 'on_update', 'span')
+
+    def __init__(self, history_id: str, future: asyncio.Future, schedule: PollSchedule, key: Hashable, start: float, deadline: float, on_update: Optional[OnUpdate] = None, trace_span: Optional[Span] = None):
+        self.history_id = history_id
+        self.on_update = on_update
+        self.span = trace_span
+        self.future = future
+        self.schedule = schedule
+        self.key = key
+        self.start = start
+        self.deadline = deadline
+        self.last_poll = start
+        self.attempts = 0
+        self.due = min(start + schedule.first_delay(), deadline)
+
+
+class HistoryPoller:
+    """
+    批量轮询器
+
+    收集当前事件循环中所有等待结果的history_record_id并按token分组，
+    到期的记录合并为一次get_history_by_ids请求，再将结果分发给各自的等待者。
+    每条记录按自适应轮询计划决定下一次查询时间
+    """
+
+    def __init__(self, fetch_batch: FetchBatch, max_batch_size: int = MAX_BATCH_SIZE, tracker: LatencyTracker = latency_tracker, stats: PollerStats = poller_stats):
+        self._fetch_batch = fetch_batch
+        self._max_batch_size = max_batch_size
+        self._tracker = tracker
+        self._stats = stats
+        self._waiters: Dict[str, List[_Waiter]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._wakeups: Dict[str, asyncio.Event] = {}
+
+    async def wait(self, refresh_token: str, history_id: str, max_retries: int = 30, retry_interval: float = 2, key: Hashable = None, on_update: Optional[OnUpdate] = None) -> Tuple[Dict, int]:
+        """
+        等待单个history_record_id生成完成
+
+        Args:
+            refresh_token: 刷新令牌
+            history_id: 历史记录ID
+            max_retries: 最大重试次数，与retry_interval共同决定总等待时间
+            retry_interval: 无历史样本时的轮询间隔(秒)
+            key: 耗时统计分组，如(模型, 宽, 高)
+            on_update: 每次轮询拿到该记录的数据时调用，用于推送生成进度
+
+        Returns:
+            Tuple[Dict, int]: 该记录的history数据(status为50)及轮询次数
+
+        Raises:
+            DeadlineExceeded: 请求的总时限已到
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        schedule = PollSchedule(self._tracker.quantiles(key), retry_interval)
+        # 总等待时间不超过请求的剩余时间，最后一次轮询安排在时限到期时
+        max_wait = max_retries * retry_interval
+        remaining = current_context().remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(f"请求总时限已到，未开始查询{history_id}的结果")
+            max_wait = min(max_wait, remaining)
+        with span("history.wait", history_id=history_id) as wait_span:
+            waiter = _Waiter(history_id, loop.create_future(), schedule, key, start, start + max_wait, on_update, wait_span)
+            self._waiters.setdefault(refresh_token, []).append(waiter)
+            if refresh_token not in self._tasks:
+                self._wakeups[refresh_token] = asyncio.Event()
+                # 轮询任务被所有请求共享，不继承发起请求的上下文，各请求的轮询span由_poll补记
+                self._tasks[refresh_token] = contextvars.Context().run(loop.create_task, self._run(refresh_token))
+            else:
+                self._wakeups[refresh_token].set()
+            try:
+                # 轮询任务不受请求总时限约束，时限到期时取消等待，不等进行中的轮询返回
+                return await within_deadline(waiter.future, f"查询{history_id}的结果")
+            finally:
+                self._discard(refresh_token, waiter)
+                if wait_span is not None:
+                    wait_span.set(polls=waiter.attempts)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _discard(self, refresh_token: str, waiter: _Waiter):
+        waiters = self._waiters.get(refresh_token)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self._waiters.pop(refresh_token, None)
+
+    async def _run(self, refresh_token: str):
+        loop = asyncio.get_running_loop()
+        wakeup = self._wakeups[refresh_token]
+        try:
+            while self._waiters.get(refresh_token):
+                waiters = self._waiters[refresh_token]
+                delay = min(w.due for w in waiters) - loop.time()
+                if delay > 0:
+                    # 有新的等待者加入时提前醒来重新计算
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                now = loop.time()
+                batch = [w for w in waiters if w.due - now <= COALESCE_WINDOW]
+                ids = list(dict.fromkeys(w.history_id for w in batch))
+                chunks = [ids[i:i + self._max_batch_size] for i in range(0, len(ids), self._max_batch_size)]
+                await asyncio.gather(*[
+                    self._poll(refresh_token, chunk, [w for w in batch if w.history_id in chunk])
+                    for chunk in chunks
+                ])
+        finally:
+            self._tasks.pop(refresh_token, None)
+            self._wakeups.pop(refresh_token, None)
+
+    async def _poll(self, refresh_token: str, history_ids: List[str], waiters: List[_Waiter]):
+        self._stats.record_request(len(history_ids))
+        for waiter in waiters:
+            waiter.attempts += 1
+        logger.debug("批量获取图片结果: %d个记录", len(history_ids))
+        start_ns = time.time_ns()
+        try:
+            result = await self._fetch_batch(refresh_token, history_ids)
+        except CircuitOpenError as e:
+            # 生成已经提交，接口熔断期间暂停轮询，恢复后继续等待结果
+            for waiter in waiters:
+                self._defer(refresh_token, waiter, e.retry_after)
+            return
+        except Exception as e:
+            end_ns = time.time_ns()
+            for waiter in waiters:
+                record_span(waiter.span, "history.poll", start_ns, end_ns, attempt=waiter.attempts, batch_size=len(history_ids), error=str(e))
+                self._retry_or_fail(refresh_token, waiter, e)
+            return
+        end_ns = time.time_ns()
+
+        data = result.get("data") or {}
+        now = asyncio.get_running_loop().time()
+        for waiter in waiters:
+            if waiter.future.done():
+                self._discard(refresh_token, waiter)
+                continue
+            history_data = data.get(waiter.history_id)
+            record_span(waiter.span, "history.poll", start_ns, end_ns, attempt=waiter.attempts, batch_size=len(history_ids), status=(history_data or {}).get("status", -1))
+            if not history_data:
+                self._retry_or_fail(refresh_token, waiter, Exception("记录不存在"))
+                continue
+
+            status = history_data.get("status")
+            fail_code = history_data.get("fail_code")
+            logger.debug("图片生成状态: %s, 失败代码: %s, 记录: %s", status, fail_code, waiter.history_id)
+            if waiter.on_update is not None:
+                try:
+                    waiter.on_update(history_data)
+                except Exception as e:
+                    logger.warning("推送生成进度失败: %s", e)
+
+            if status == 50:  # 完成
+                # 实际完成时间介于上一次和本次轮询之间，取中点作为样本
+                self._tracker.record(waiter.key, (waiter.last_poll + now) / 2 - waiter.start)
+                self._stats.record_completion(waiter.attempts, now - waiter.start)
+                time_to_result.observe(now - waiter.start)
+                polls_per_generation.observe(waiter.attempts)
+                logger.info("图片生成完成，耗时%.1f秒，轮询%d次 (%s)", now - waiter.start, waiter.attempts, waiter.history_id)
+                self._settle(refresh_token, waiter, result=(history_data, waiter.attempts))
+            elif status == 30:  # 失败
+                generation_failures.inc(fail_code=fail_code or "unknown")
+                if fail_code == '2038':
+                    self._settle(refresh_token, waiter, error=Exception("内容被过滤"))
+                else:
+                    self._settle(refresh_token, waiter, error=Exception("图片生成失败"))
+            elif status == 20:  # 生成中
+                waiter.last_poll = now
+                self._retry_or_fail(refresh_token, waiter, Exception("图片生成超时"), warn=False)
+            else:
+                self._retry_or_fail(refresh_token, waiter, Exception(f"未知的图片生成状态: {status}"))
+
+    def _retry_or_fail(self, refresh_token: str, waiter: _Waiter, error: Exception, warn: bool = True):
+        now = asyncio.get_running_loop().time()
+        if now >= waiter.deadline:
+            self._settle(refresh_token, waiter, error=error)
+            return
+        delay = waiter.schedule.next_delay(now - waiter.start)
+        if warn:
+            logger.warning("获取图片结果失败，重试中... (%s)", error)
+        else:
+            logger.debug("图片生成中，等待%.1f秒后重试... (%s)", delay, waiter.history_id)
+        waiter.due = min(now + delay, waiter.deadline)
+
+    def _defer(self, refresh_token: str, waiter: _Waiter, delay: float):
+        waiter.attempts -= 1
+        now = asyncio.get_running_loop().time()
+        if now >= waiter.deadline:
+            self._settle(refresh_token, waiter, error=Exception("获取图片结果超时: 接口暂时不可用"))
+            return
+        waiter.due = min(now + delay, waiter.deadline)
+
+    def _settle(self, refresh_token: str, waiter: _Waiter, result: Tuple[Dict, int] = None, error: Exception = None):
+        self._discard(refresh_token, waiter)
+        if waiter.future.done():
+            return
+        if error is not None:
+            waiter.future.set_exception(error)
+        else:
+            waiter.future.set_result(result)
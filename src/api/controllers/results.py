@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 生成结果缓存配置，可通过环境变量覆盖
+RESULT_CACHE_TTL = float(os.getenv("JIMENG_RESULT_CACHE_TTL", "3600"))  # 缓存有效期(秒)，不应超过上游图片URL的有效期，0为关闭缓存
+RESULT_CACHE_SIZE = int(os.getenv("JIMENG_RESULT_CACHE_SIZE", "1024"))  # 内存中最多缓存的结果数量
+RESULT_CACHE_DB = os.getenv("JIMENG_RESULT_CACHE_DB", "")  # sqlite文件路径，为空时只缓存在内存中
+PURGE_INTERVAL = 100  # 每写入该数量的结果清理一次磁盘中的过期记录
+
+
+def result_key(model: str, prompt: str, negative_prompt: str, seed: int, width: int, height: int, sample_strength: float, tokens: Iterable[str] = ()) -> str:
+    """
+    生成参数的内容哈希
+
+    模型、提示词、种子、尺寸和精细度都相同时，上游会生成相同的图片。
+    结果由账号生成并消耗其积分，键中包含调用方提供的全部token，只有提供相同token的调用方才能命中，
+    其他账号即使参数相同也不会拿到该结果
+    """
+    params = json.dumps([model, prompt, negative_prompt, seed, width, height, sample_strength, sorted(set(tokens))], ensure_ascii=False, default=str)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+class _DiskTier:
+    """sqlite保存的结果，进程重启后仍然有效，也可被多个进程共享"""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._connect()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, image_urls TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._pid = os.getpid()
+
+    def _connection(self) -> sqlite3.Connection:
+        # 连接不能跨fork使用，gunicorn预加载应用后fork出的worker各自重新连接
+        if self._pid != os.getpid():
+            self._connect()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[List[str], float]]:
+        with self._lock:
+            row = self._connection().execute("SELECT image_urls, expires_at FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: str, image_urls: List[str], expires_at: float):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, json.dumps(image_urls), expires_at))
+            self._writes += 1
+            if self._writes % PURGE_INTERVAL == 0:
+                conn.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+
+
+class ResultCache:
+    """
+    按生成参数缓存的图片URL
+
+    内存中按LRU保存最近的结果，配置了sqlite文件时同时写入磁盘，内存未命中时再查磁盘。
+    有效期应与上游图片URL的有效期一致，过期后重新生成
+    """
+
+    def __init__(self, ttl: float = RESULT_CACHE_TTL, max_size: int = RESULT_CACHE_SIZE, db_path: str = RESULT_CACHE_DB):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._memory: "OrderedDict[str, Tuple[List[str], float]]" = OrderedDict()
+        self._disk = _DiskTier(db_path) if db_path and ttl > 0 else None
+        self._lock = threading.Lock()
+        self._hits = {"memory": 0, "disk": 0}
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl > 0
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        """
+        获取缓存的图片URL
+
+        Returns:
+            Optional[List[str]]: 图片URL列表的副本，未命中或已过期时返回None
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] > now:
+                self._memory.move_to_end(key)
+                self._hits["memory"] += 1
+                return list(entry[0])
+            if entry is not None:
+                del self._memory[key]
+
+        entry = None
+        if self._disk is not None:
+            # sqlite查询在线程池中进行，不阻塞事件循环
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._disk.get, key)
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits["disk"] += 1
+            self._store_memory(key, entry[0], entry[1])
+            return list(entry[0])
+
+    async def put(self, key: str, image_urls: List[str]):
+        """保存生成结果，没有图片的结果不缓存"""
+        if not self.enabled or not image_urls:
+            return
+        expires_at = time.time() + self._ttl
+        with self._lock:
+            self._store_memory(key, list(image_urls), expires_at)
+        if self._disk is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._disk.put, key, list(image_urls), expires_at)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._memory),
+                "memory_hits": self._hits["memory"],
+                "disk_hits": self._hits["disk"],
+                "misses": self._misses
+            }
+
+    def _store_memory(self, key: str, image_urls: List[str], expires_at: float):
+        self._memory[key] = (image_urls, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_size:
+            self._memory.popitem(last=False)
@@ -0,0 +1,168 @@
+import os
+import random
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from lib.breaker import CircuitBreaker, CircuitOpenError
+
+# 多账号调度配置，可通过环境变量覆盖
+TOKEN_STRATEGY = os.getenv("JIMENG_TOKEN_STRATEGY", "least_outstanding")  # least_outstanding 或 weighted_round_robin
+ERROR_WINDOW = 20  # 统计错误率的最近请求数
+ERROR_WINDOW_SECONDS = 600  # 只统计该时间(秒)内的请求
+MIN_OUTCOMES = 4  # 请求数不足时不判定为不健康
+UNHEALTHY_ERROR_RATE = 0.5  # 错误率不低于该值时熔断
+UNHEALTHY_COOLDOWN = 30  # 熔断的token在该时间(秒)后放行一次探测请求，成功后恢复调度
+MAX_TRACKED_TOKENS = 1024  # 最多记录状态的token数量
+
+STRATEGIES = ("least_outstanding", "weighted_round_robin")
+
+
+def token_split(authorization: str) -> List[str]:
+    """与core.ts中的tokenSplit一致，支持 Bearer a,b,c 形式的多个sessionid"""
+    tokens = authorization.replace("Bearer ", "").split(",")
+    return [token.strip() for token in tokens if token.strip()]
+
+
+class _TokenState:
+    __slots__ = ('in_flight', 'breaker', 'current_weight')
+
+    def __init__(self, token: str):
+        self.in_flight = 0
+        # 生成耗时取决于上游排队，不按耗时熔断
+        self.breaker = CircuitBreaker(
+            f"账号***{token[-4:]}",
+            window=ERROR_WINDOW,
+            window_seconds=ERROR_WINDOW_SECONDS,
+            min_calls=MIN_OUTCOMES,
+            error_rate=UNHEALTHY_ERROR_RATE,
+            slow_seconds=None,
+            open_seconds=UNHEALTHY_COOLDOWN
+        )
+        self.current_weight = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.breaker.error_rate
+
+
+class TokenPool:
+    """
+    多账号token池
+
+    记录每个token的进行中请求数、最近错误率和积分余额，每次生成时从请求携带的token中
+    选择健康且负载最低的一个，使吞吐量随账号数量线性增长。
+    每个token各有一个熔断器，错误率过高的token暂停调度，请求改由其他token处理
+    """
+
+    def __init__(self, credit_of: Callable[[str], Optional[int]] = None, strategy: str = TOKEN_STRATEGY):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"不支持的token调度策略: {strategy}")
+        self._credit_of = credit_of or (lambda token: None)
+        self._strategy = strategy
+        self._states: "OrderedDict[str, _TokenState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: List[str]) -> str:
+        """
+        选择一个token并计入进行中请求数，使用完毕后须调用release
+
+        Args:
+            tokens: 候选token列表
+
+        Returns:
+            str: 选中的token
+
+        Raises:
+            CircuitOpenError: 所有候选token都已熔断
+        """
+        if not tokens:
+            raise ValueError("缺少可用的token")
+        with self._lock:
+            states = {token: self._state(token) for token in dict.fromkeys(tokens)}
+            # 本次的候选token即将被使用，淘汰时跳过，避免计数记在已被淘汰的状态上
+            self._evict(states)
+            healthy = [token for token, state in states.items() if state.breaker.available()]
+            if not healthy:
+                retry_after = min(state.breaker.retry_after() for state in states.values())
+                raise CircuitOpenError("所有账号均暂时不可用，请稍后重试", retry_after)
+            # 积分不足的token仅在没有其他选择时使用
+            candidates = [token for token in healthy if self._has_credit(token)] or healthy
+            if self._strategy == "weighted_round_robin":
+                token = self._pick_weighted(candidates, states)
+            else:
+                token = self._pick_least_outstanding(candidates, states)
+            states[token].breaker.begin()
+            states[token].in_flight += 1
+            return token
+
+    def release(self, token: str, success: Optional[bool]):
+        """
+        结束一次请求，记录结果用于计算错误率
+
+        Args:
+            token: acquire返回的token
+            success: 请求是否成功，None表示失败与token无关(如上游接口熔断、请求被取消)，不计入错误率
+        """
+        with self._lock:
+            state = self._states.get(token)
+            if state is None:
+                return
+            state.in_flight = max(state.in_flight - 1, 0)
+            state.breaker.end(success)
+
+    def stats(self) -> List[Dict]:
+        """各token的调度状态，token仅保留末4位"""
+        with self._lock:
+            return [{
+                "token": f"***{token[-4:]}",
+                "in_flight": state.in_flight,
+                "error_rate": state.error_rate,
+                "healthy": state.breaker.available(),
+                "state": state.breaker.state,
+                "credit": self._credit_of(token)
+            } for token, state in self._states.items()]
+
+    def breaker_stats(self) -> List[Dict]:
+        """各token熔断器的状态，token仅保留末4位"""
+        with self._lock:
+            return [{"token": f"***{token[-4:]}", **state.breaker.stats()} for token, state in self._states.items()]
+
+    def _state(self, token: str) -> _TokenState:
+        state = self._states.get(token)
+        if state is None:
+            state = self._states[token] = _TokenState(token)
+        self._states.move_to_end(token)
+        return state
+
+    def _evict(self, keep: Dict[str, _TokenState]):
+        # 按最近使用顺序淘汰，只淘汰没有进行中请求且不在keep中的token
+        for token in list(self._states.keys()):
+            if len(self._states) <= MAX_TRACKED_TOKENS:
+                return
+            if self._states[token].in_flight == 0 and token not in keep:
+                del self._states[token]
+
+    def _has_credit(self, token: str) -> bool:
+        credit = self._credit_of(token)
+        return credit is None or credit >= 1
+
+    def _pick_least_outstanding(self, candidates: List[str], states: Dict[str, _TokenState]) -> str:
+        lowest = min((states[token].in_flight, states[token].error_rate) for token in candidates)
+        return random.choice([token for token in candidates if (states[token].in_flight, states[token].error_rate) == lowest])
+
+    def _pick_weighted(self, candidates: List[str], states: Dict[str, _TokenState]) -> str:
+        # 平滑加权轮询，权重为积分余额乘以成功率，积分未知的token取已知积分的平均值
+        credits = {token: self._credit_of(token) for token in candidates}
+        known = [credit for credit in credits.values() if credit is not None]
+        default_credit = sum(known) / len(known) if known else 1
+        weights = {
+            token: max(credits[token] if credits[token] is not None else default_credit, 1) * (1 - states[token].error_rate) + 0.01
+            for token in candidates
+        }
+        total = sum(weights.values())
+        for token in candidates:
+            states[token].current_weight += weights[token]
+        token = max(candidates, key=lambda t: states[t].current_weight)
+        states[token].current_weight -= total
+        return token
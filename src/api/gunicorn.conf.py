@@ -0,0 +1,72 @@
+"""
+生产环境的gunicorn配置，在src/api目录下运行gunicorn时自动加载:
+    cd src/api && gunicorn
+
+默认以uvicorn的ASGI worker运行asgi:app，生成接口在事件循环中等待上游，一个worker即可同时等待大量生成；
+JIMENG_WORKER_CLASS=gthread时以线程池运行app:app，每个进行中的生成占用一个线程。
+超时均长于请求总时限，重启或回收worker时进行中的生成可以正常完成。
+
+默认只启动一个worker: 任务表、准入控制、账号熔断器和积分缓存都保存在进程内，多个worker时
+GET /v1/images/jobs/<id>查不到其他worker提交的任务，JIMENG_MAX_IN_FLIGHT_PER_TOKEN等限制也会按worker数成倍放大。
+只有在不依赖这些状态时(如只使用同步生成接口，或任务通过callback_url推送结果)才应调大JIMENG_WORKERS
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from lib.upstream_config import REQUEST_DEADLINE  # noqa: E402
+
+# 服务配置，可通过环境变量覆盖
+WORKER_CLASS = os.getenv("JIMENG_WORKER_CLASS", "asgi")  # asgi(uvicorn事件循环) 或 gthread(线程池)
+WORKERS = int(os.getenv("JIMENG_WORKERS", "1"))  # worker进程数，0为按CPU核数计算，多个worker之间不共享状态
+THREADS = int(os.getenv("JIMENG_THREADS", "64"))  # gthread模式下每个worker的线程数，即每个worker同时处理的请求数
+KEEPALIVE = int(os.getenv("JIMENG_KEEPALIVE", "75"))  # 空闲长连接保持时间(秒)，应长于前置负载均衡的空闲超时
+MAX_REQUESTS = int(os.getenv("JIMENG_MAX_REQUESTS", "10000"))  # 每个worker处理该数量的请求后重启，0为不重启
+SHUTDOWN_MARGIN = 30  # 超时在请求总时限之外额外留出的时间(秒)
+
+# JIMENG_WORKERS=0时按核数计算: asgi模式下worker不会被单个请求阻塞，每核一个即可用满CPU；
+# gthread模式下等待上游时线程会释放GIL，每核多一个进程以分摊GIL争用
+cpu_count = os.cpu_count() or 1
+if WORKER_CLASS == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    workers = WORKERS or cpu_count
+elif WORKER_CLASS == "gthread":
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    workers = WORKERS or cpu_count * 2
+    threads = THREADS
+else:
+    raise ValueError(f"无效的JIMENG_WORKER_CLASS: {WORKER_CLASS}，应为asgi或gthread")
+
+bind = os.getenv("JIMENG_BIND", "0.0.0.0:8000")
+backlog = 2048
+
+# 生成可能持续到请求总时限，worker超时和优雅退出时间都长于该时限，回收或重启worker时不中断进行中的生成
+_generation_window = REQUEST_DEADLINE if REQUEST_DEADLINE > 0 else 300
+timeout = int(_generation_window + SHUTDOWN_MARGIN)
+graceful_timeout = int(_generation_window + SHUTDOWN_MARGIN)
+keepalive = KEEPALIVE
+
+# 定期重启worker以回收内存碎片，加入随机量避免所有worker同时重启
+max_requests = MAX_REQUESTS
+max_requests_jitter = MAX_REQUESTS // 10
+
+# 在master中加载应用后再fork，worker启动更快并共享只读内存；
+# 后台事件循环、日志线程和sqlite连接在fork出的worker中会重新创建，各worker的日志写入带pid的文件，如api_debug.1234.log
+preload_app = True
+
+accesslog = os.getenv("JIMENG_ACCESS_LOG") or None  # 访问日志路径，"-"为标准输出，为空时不记录
+errorlog = "-"
+loglevel = os.getenv("JIMENG_LOG_LEVEL", "INFO").lower()
+
+
+def worker_exit(server, worker):
+    # gthread模式下任务在后台事件循环中运行，worker退出前等待已返回任务ID的任务结束；
+    # asgi模式下在lifespan shutdown中等待
+    if WORKER_CLASS == "gthread":
+        from controllers.jobs import wait_background_jobs
+        from lib.aio import run_sync
+        run_sync(wait_background_jobs())
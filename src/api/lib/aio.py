@@ -0,0 +1,91 @@
+import asyncio
+import atexit
+import os
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    获取进程内共享的后台事件循环
+
+    同步接口通过该事件循环执行异步流水线，所有线程共用同一个连接池，
+    等待上游时不占用事件循环。fork出的子进程会重新创建自己的事件循环
+    """
+    global _loop, _loop_pid
+    if _loop is None or _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop is None or _loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="jimeng-aio", daemon=True)
+                thread.start()
+                _loop, _loop_pid = loop, os.getpid()
+    return _loop
+
+
+def run_sync(coro: Coroutine, timeout: Optional[float] = None) -> Any:
+    """
+    在后台事件循环中执行协程，并阻塞当前线程直到返回结果
+
+    Args:
+        coro: 要执行的协程
+        timeout: 等待超时(秒)，不传则一直等待
+
+    Returns:
+        Any: 协程的返回值
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("不能在事件循环中调用同步接口，请直接await对应的异步接口")
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result(timeout)
+
+
+def iterate_sync(agen: AsyncIterator) -> Iterator:
+    """
+    在后台事件循环中逐项执行异步生成器，供同步代码(如Flask流式响应)迭代
+
+    Args:
+        agen: 异步生成器
+
+    Returns:
+        Iterator: 同步迭代器，提前结束时会关闭异步生成器
+    """
+    done = object()
+
+    async def next_item():
+        try:
+            return await agen.__anext__()
+        except StopAsyncIteration:
+            return done
+
+    async def close():
+        await agen.aclose()
+
+    try:
+        while True:
+            item = run_sync(next_item())
+            if item is done:
+                return
+            yield item
+    finally:
+        run_sync(close())
+
+
+@atexit.register
+def _shutdown():
+    # 退出前关闭后台事件循环上的上游会话，避免未关闭会话的告警
+    if _loop is None or _loop_pid != os.getpid() or not _loop.is_running():
+        return
+    from lib.http_client import get_upstream_client
+    try:
+        asyncio.run_coroutine_threadsafe(get_upstream_client().close(), _loop).result(1)
+    except Exception:
+        pass
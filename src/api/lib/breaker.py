@@ -0,0 +1,202 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+# 上游接口熔断配置，可通过环境变量覆盖
+BREAKER_WINDOW = int(os.getenv("JIMENG_BREAKER_WINDOW", "20"))  # 统计错误率的最近调用数
+BREAKER_WINDOW_SECONDS = float(os.getenv("JIMENG_BREAKER_WINDOW_SECONDS", "60"))  # 只统计该时间(秒)内的调用
+BREAKER_MIN_CALLS = int(os.getenv("JIMENG_BREAKER_MIN_CALLS", "5"))  # 调用数不足时不熔断
+BREAKER_ERROR_RATE = float(os.getenv("JIMENG_BREAKER_ERROR_RATE", "0.5"))  # 错误率或慢调用比例不低于该值时熔断
+BREAKER_SLOW_SECONDS = float(os.getenv("JIMENG_BREAKER_SLOW_SECONDS", "10"))  # 耗时超过该值的调用计为慢调用
+BREAKER_OPEN_SECONDS = float(os.getenv("JIMENG_BREAKER_OPEN_SECONDS", "30"))  # 熔断持续时间，之后放行探测请求
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("JIMENG_BREAKER_HALF_OPEN_PROBES", "1"))  # 半开状态下同时放行的探测请求数
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝，应返回503"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    按最近调用的错误率和耗时熔断
+
+    关闭状态下记录最近的调用结果，错误率或慢调用比例达到阈值后打开，打开期间直接拒绝调用；
+    持续时间过后进入半开状态，只放行少量探测调用，探测全部成功则关闭，任一失败则重新打开
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: int = BREAKER_WINDOW,
+        window_seconds: float = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        slow_seconds: Optional[float] = BREAKER_SLOW_SECONDS,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES
+    ):
+        self.name = name
+        self._window_seconds = window_seconds
+        self._min_calls = min_calls
+        self._threshold = error_rate
+        self._slow_seconds = slow_seconds
+        self._open_seconds = open_seconds
+        self._half_open_probes = max(half_open_probes, 1)
+        self._lock = threading.Lock()
+        # (完成时间, 是否成功, 是否慢调用)
+        self._calls = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._rejected = 0
+        self._opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            self._prune(time.monotonic())
+            return self._failure_rate()
+
+    def available(self) -> bool:
+        """是否可以放行一次调用，不占用探测名额"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state == CLOSED or (state == HALF_OPEN and self._probes < self._half_open_probes)
+
+    def begin(self):
+        """
+        开始一次调用，结束后须调用end
+
+        Raises:
+            CircuitOpenError: 熔断器打开，或半开状态下探测名额已满
+        """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes < self._half_open_probes:
+                self._probes += 1
+                return
+            self._rejected += 1
+            raise CircuitOpenError(f"{self.name}暂时不可用，请稍后重试", self._retry_after())
+
+    def end(self, success: Optional[bool], latency: float = None):
+        """
+        结束一次调用
+
+        Args:
+            success: 调用是否成功，None表示结果与上游健康状况无关(如被取消)，只归还探测名额
+            latency: 调用耗时(秒)，超过慢调用阈值时计为慢调用
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+            if success is None:
+                return
+            slow = self._slow_seconds is not None and latency is not None and latency > self._slow_seconds
+            if state == HALF_OPEN:
+                if success and not slow:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self._half_open_probes:
+                        self._state = CLOSED
+                        self._calls.clear()
+                else:
+                    self._open(now)
+                return
+            self._calls.append((now, success, slow))
+            if state == CLOSED and self._should_open(now):
+                self._open(now)
+
+    def retry_after(self) -> int:
+        """建议的重试等待时间(秒)"""
+        with self._lock:
+            return self._retry_after()
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            return {
+                "state": self._current_state(now),
+                "calls": len(self._calls),
+                "error_rate": round(self._failure_rate(), 4),
+                "slow_rate": round(self._slow_rate(), 4),
+                "opened": self._opened,
+                "rejected": self._rejected,
+                "retry_after": self._retry_after() if self._state == OPEN else 0
+            }
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self._open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def _open(self, now: float):
+        self._state = OPEN
+        self._opened_at = now
+        self._opened += 1
+
+    def _prune(self, now: float):
+        while self._calls and now - self._calls[0][0] > self._window_seconds:
+            self._calls.popleft()
+
+    def _failure_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, success, _ in self._calls if not success) / len(self._calls)
+
+    def _slow_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, _, slow in self._calls if slow) / len(self._calls)
+
+    def _should_open(self, now: float) -> bool:
+        self._prune(now)
+        if len(self._calls) < self._min_calls:
+            return False
+        return self._failure_rate() >= self._threshold or self._slow_rate() >= self._threshold
+
+    def _retry_after(self) -> int:
+        if self._state != OPEN:
+            return 1
+        return max(1, math.ceil(self._open_seconds - (time.monotonic() - self._opened_at)))
+
+
+class BreakerRegistry:
+    """按名称创建和保存熔断器，如每个上游接口一个"""
+
+    def __init__(self, **options):
+        self._options = options
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(name, CircuitBreaker(name, **self._options))
+        return breaker
+
+    def stats(self) -> Dict[str, Dict]:
+        return {name: breaker.stats() for name, breaker in list(self._breakers.items())}
@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import time
+from typing import AsyncIterator, Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+DEADLINE_TOLERANCE = 0.05  # 超时发生时剩余时间不超过该值(秒)则认为是总时限到期
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """请求的总时限已到，不再继续调用上游"""
+
+
+class RequestContext:
+    """
+    一次API请求的调度信息，在生成流水线的各个阶段中传递
+
+    通过contextvars传递，流水线中创建的子任务会自动继承
+    """
+
+    __slots__ = ('client', 'priority', 'deadline')
+
+    def __init__(self, client: str = "", priority: int = 0, deadline: Optional[float] = None):
+        """
+        Args:
+            client: 调用方标识，用于在调用方之间公平分配并发
+            priority: 优先级，数值越大越先被调度
+            deadline: 总时限到期的时间(time.monotonic())，None为不限制
+        """
+        self.client = client
+        self.priority = priority
+        self.deadline = deadline
+
+    def remaining(self) -> Optional[float]:
+        """距离总时限的剩余秒数，已过期时为负数，不限制时为None"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
+_DEFAULT = RequestContext()
+_current: contextvars.ContextVar = contextvars.ContextVar("jimeng_request_context", default=_DEFAULT)
+
+
+def current_context() -> RequestContext:
+    """获取当前请求的调度信息，不在请求中时返回默认值"""
+    return _current.get()
+
+
+async def within_deadline(awaitable: Awaitable[T], what: str) -> T:
+    """
+    在当前请求的剩余时间内等待，用于等待其他请求共享的结果(如合并的积分查询)等自身不受总时限约束的阶段
+
+    Args:
+        awaitable: 等待的协程或Future
+        what: 阶段名称，用于错误信息
+
+    Raises:
+        DeadlineExceeded: 总时限已到
+    """
+    remaining = current_context().remaining()
+    if remaining is None:
+        return await awaitable
+    if remaining <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded(f"请求总时限已到，未执行{what}")
+    try:
+        return await asyncio.wait_for(awaitable, remaining)
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError as e:
+        # 阶段内部的超时(如上游读取超时)在时限到期前发生时原样抛出
+        if current_context().remaining() > DEADLINE_TOLERANCE:
+            raise
+        raise DeadlineExceeded(f"请求总时限已到，{what}未完成") from e
+
+
+async def run_with_context(awaitable: Awaitable[T], context: Optional[RequestContext]) -> T:
+    """
+    在指定的请求上下文中执行协程
+
+    同步接口通过run_sync在后台事件循环中执行协程，调用线程的上下文不会被带过去，
+    需要用本函数包装后再提交
+    """
+    if context is None:
+        return await awaitable
+    token = _current.set(context)
+    try:
+        return await awaitable
+    finally:
+        _current.reset(token)
+
+
+async def stream_with_context(agen: AsyncIterator[T], context: Optional[RequestContext]) -> AsyncIterator[T]:
+    """
+    在指定的请求上下文中迭代异步生成器
+
+    每次迭代都可能在不同的任务中执行，因此每一步之前都重新设置上下文
+    """
+    try:
+        while True:
+            token = _current.set(context) if context is not None else None
+            try:
+                item = await agen.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                if token is not None:
+                    _current.reset(token)
+            yield item
+    finally:
+        await agen.aclose()
@@ -0,0 +1,357 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, Optional
+
+import aiohttp
+
+from lib.breaker import BreakerRegistry
+from lib.context import DEADLINE_TOLERANCE, DeadlineExceeded, RequestContext, current_context
+from lib.tracing import span
+from lib.upstream_config import (
+    BASE_URL, DEFAULT_TIMEOUT, ENDPOINT_TIMEOUTS, MAX_RETRIES, PROXY,
+    RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_RATIO, Timeout
+)
+
+# 连接池配置，可通过环境变量覆盖
+POOL_CONNECTIONS = int(os.getenv("JIMENG_POOL_CONNECTIONS", "4"))  # 同时保持连接的主机数量
+POOL_MAXSIZE = int(os.getenv("JIMENG_POOL_MAXSIZE", "32"))  # 每个主机保持的长连接数量
+KEEPALIVE_TIMEOUT = 60  # 空闲长连接保持时间(秒)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 流式下载时每次读取的字节数
+
+
+class UpstreamResponse:
+    """上游响应，读取完毕后立即释放连接回连接池"""
+
+    def __init__(self, status_code: int, content: bytes, url: str):
+        self.status_code = status_code
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _to_client_timeout(timeout: Timeout, remaining: Optional[float] = None) -> aiohttp.ClientTimeout:
+    # 有总时限时，整个请求(含建立连接和读取响应)不超过剩余时间
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(total=remaining, sock_connect=connect, sock_read=read)
+    return aiohttp.ClientTimeout(total=timeout if remaining is None else min(timeout, remaining))
+
+
+def _remaining(context: Optional[RequestContext], what: str) -> Optional[float]:
+    """
+    剩余时间，不受总时限约束时为None
+
+    Raises:
+        DeadlineExceeded: 总时限已到
+    """
+    remaining = context.remaining() if context is not None else None
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f"请求总时限已到，未执行{what}")
+    return remaining
+
+
+class RetryBudget:
+    """
+    所有请求共享的重试预算，避免上游故障时重试把请求量成倍放大
+
+    每个请求存入ratio个重试额度，每次重试消耗1个；另外每秒补充min_per_second个保底额度，
+    请求很少时也能重试。额度最多积累ttl秒的保底额度(至少1个)
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND, ttl: float = 10.0):
+        self._ratio = ratio
+        self._min_per_second = min_per_second
+        self._capacity = max(min_per_second * ttl, 1.0)
+        self._balance = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._retries = 0
+        self._denied = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._balance = min(self._capacity, self._balance + (now - self._updated) * self._min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        """记录一次请求"""
+        with self._lock:
+            self._refill()
+            self._balance = min(self._capacity, self._balance + self._ratio)
+
+    def try_spend(self) -> bool:
+        """申请一次重试，额度不足时返回False"""
+        with self._lock:
+            self._refill()
+            if self._balance < 1:
+                self._denied += 1
+                return False
+            self._balance -= 1
+            self._retries += 1
+            return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._refill()
+            return {
+                "balance": round(self._balance, 2),
+                "retries": self._retries,
+                "denied": self._denied
+            }
+
+
+class UpstreamClient:
+    """
+    进程内共享的上游HTTP客户端
+
+    所有对即梦接口的请求复用长连接池，避免每次请求都重新进行TCP和TLS握手。
+    aiohttp会话与事件循环绑定，因此每个事件循环各持有一个会话，统计信息在所有会话间汇总。
+    每个上游接口各有一个熔断器，接口持续出错或变慢时直接拒绝请求，不再等待超时。
+    地址、超时和重试等配置见upstream_config.py；当前请求设置了总时限时，超时不超过剩余时间
+    """
+
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        pool_connections: int = POOL_CONNECTIONS,
+        pool_maxsize: int = POOL_MAXSIZE,
+        max_retries: int = MAX_RETRIES,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        timeouts: Dict[str, Timeout] = None,
+        proxy: Optional[str] = PROXY,
+        retry_budget: RetryBudget = None
+    ):
+        self.base_url = base_url
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.timeouts = dict(ENDPOINT_TIMEOUTS if timeouts is None else timeouts)
+        self.proxy = proxy
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breakers = BreakerRegistry()
+        self._sessions = weakref.WeakKeyDictionary()
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._connections_opened = 0
+        self._connections_reused = 0
+
+    def _count(self, field: str):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self._count("_requests")
+
+        async def on_connection_create_end(session, ctx, params):
+            self._count("_connections_opened")
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._count("_connections_reused")
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_connections * self.pool_maxsize,
+                limit_per_host=self.pool_maxsize,
+                keepalive_timeout=KEEPALIVE_TIMEOUT
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                # 会话被所有token共享，禁止保存响应中的Cookie，避免不同token之间串号
+                cookie_jar=aiohttp.DummyCookieJar(),
+                trace_configs=[self._trace_config()]
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def post(self, uri: str, timeout: Optional[Timeout] = None, **kwargs) -> UpstreamResponse:
+        """
+        向上游发送POST请求
+
+        Args:
+            uri: 接口路径，如/mweb/v1/get_history_by_ids
+            timeout: 本次请求的超时，不传则使用该接口配置的超时
+            **kwargs: 透传给aiohttp的参数(headers、params、json等)
+
+        Returns:
+            UpstreamResponse: 已读取完毕的响应
+
+        Raises:
+            CircuitOpenError: 该接口已熔断
+            DeadlineExceeded: 当前请求的总时限已到
+        """
+        context = current_context()
+        _remaining(context, f"POST {uri}")
+        breaker = self.breakers.get(uri)
+        with span(f"POST {uri}", kind="client", uri=uri) as trace_span:
+            breaker.begin()
+            start = time.monotonic()
+            success = None
+            try:
+                response = await self._post(f"{self.base_url}{uri}", timeout if timeout is not None else self.timeouts.get(uri, self.timeout), context, **kwargs)
+                # 业务错误码与接口健康状况无关，只有5xx、超时和连接错误计为失败
+                success = response.status_code < 500
+                if trace_span is not None:
+                    trace_span.set(status_code=response.status_code)
+                return response
+            except DeadlineExceeded:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                remaining = context.remaining()
+                if isinstance(e, asyncio.TimeoutError) and remaining is not None and remaining <= DEADLINE_TOLERANCE:
+                    # 总时限到期导致的超时与上游健康状况无关，不计入熔断
+                    raise DeadlineExceeded(f"请求总时限已到，POST {uri}未完成") from e
+                success = False
+                raise
+            finally:
+                breaker.end(success, time.monotonic() - start)
+
+    async def post_url(self, url: str, timeout: Optional[Timeout] = None, **kwargs) -> UpstreamResponse:
+        """向完整URL发送POST请求，如任务完成回调，与上游请求共用连接池和重试策略，不受请求总时限约束"""
+        return await self._post(url, timeout if timeout is not None else self.timeout, None, **kwargs)
+
+    async def _post(self, url: str, timeout: Timeout, context: Optional[RequestContext], **kwargs) -> UpstreamResponse:
+        session = self._get_session()
+        self.retry_budget.deposit()
+        for attempt in range(self.max_retries + 1):
+            remaining = _remaining(context, f"POST {url}")
+            try:
+                async with session.post(url, timeout=_to_client_timeout(timeout, remaining), proxy=self.proxy, **kwargs) as response:
+                    content = await response.read()
+                    return UpstreamResponse(response.status, content, str(response.url))
+            except aiohttp.ClientConnectorError:
+                # 与原重试策略一致，POST请求仅在建立连接失败时重试
+                delay = 0.1 * (2 ** attempt)
+                if not self._may_retry(attempt, delay, context):
+                    raise
+                await asyncio.sleep(delay)
+
+    def _may_retry(self, attempt: int, delay: float, context: Optional[RequestContext]) -> bool:
+        # 重试次数用完、等待后已超出总时限或重试预算不足时不再重试
+        if attempt >= self.max_retries:
+            return False
+        remaining = context.remaining() if context is not None else None
+        if remaining is not None and remaining <= delay:
+            return False
+        return self.retry_budget.try_spend()
+
+    async def stream_get(self, url: str, on_chunk: Callable[[bytes], Awaitable[None]], timeout: Optional[Timeout] = None, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+        """
+        以GET方式下载完整URL，响应体分块交给on_chunk处理，不在内存中缓存整个响应
+
+        Args:
+            url: 完整URL，如生成结果的图片地址
+            on_chunk: 处理每个数据块的协程函数，抛出异常时中止下载
+            timeout: 本次请求的超时，不传则使用客户端默认超时
+            chunk_size: 每次读取的字节数
+
+        Returns:
+            int: 响应状态码，非200时不读取响应体
+
+        Raises:
+            DeadlineExceeded: 当前请求的总时限已到
+        """
+        session = self._get_session()
+        context = current_context()
+        timeout = timeout if timeout is not None else self.timeout
+        self.retry_budget.deposit()
+        for attempt in range(self.max_retries + 1):
+            remaining = _remaining(context, f"GET {url}")
+            try:
+                async with session.get(url, timeout=_to_client_timeout(timeout, remaining), proxy=self.proxy) as response:
+                    if response.status == 200:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            await on_chunk(chunk)
+                    return response.status
+            except aiohttp.ClientConnectorError:
+                delay = 0.1 * (2 ** attempt)
+                if not self._may_retry(attempt, delay, context):
+                    raise
+                await asyncio.sleep(delay)
+
+    def pool_stats(self) -> Dict:
+        """
+        获取连接池统计信息，用于确认长连接是否被复用
+
+        Returns:
+            Dict: 请求数、新建连接数、复用连接数、重试预算及各事件循环连接池的空闲连接数，
+                aiohttp版本不提供连接数时idle和in_use为None
+        """
+        pools = []
+        for session in list(self._sessions.values()):
+            if session.closed:
+                continue
+            connector = session.connector
+            # _conns和_acquired是aiohttp连接池的内部属性，没有公开接口，升级aiohttp后可能不存在
+            conns = getattr(connector, "_conns", None)
+            acquired = getattr(connector, "_acquired", None)
+            pools.append({
+                "limit": connector.limit,
+                "limit_per_host": connector.limit_per_host,
+                "idle": sum(len(idle) for idle in conns.values()) if conns is not None else None,
+                "in_use": len(acquired) if acquired is not None else None
+            })
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "connections_opened": self._connections_opened,
+                "connections_reused": self._connections_reused,
+                "retry_budget": self.retry_budget.stats(),
+                "pools": pools
+            }
+
+    async def close(self):
+        """关闭当前事件循环上的会话"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        session = self._sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+
+_client: Optional[UpstreamClient] = None
+_client_lock = threading.Lock()
+
+
+def get_upstream_client() -> UpstreamClient:
+    """获取进程内共享的上游客户端"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = UpstreamClient()
+    return _client
+
+
+def breaker_stats() -> Dict:
+    """各上游接口熔断器的状态"""
+    return get_upstream_client().breakers.stats()
+
+
+def pool_stats() -> Dict:
+    """获取共享客户端的连接池统计信息"""
+    return get_upstream_client().pool_stats()
@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Optional
+
+from lib.tracing import current_trace_id
+
+# 日志配置，可通过环境变量覆盖
+LOG_LEVEL = os.getenv("JIMENG_LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("JIMENG_LOG_FILE", "api_debug.log")  # 为空时只输出到标准输出
+LOG_MAX_BYTES = int(os.getenv("JIMENG_LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个日志文件的大小上限
+LOG_BACKUP_COUNT = int(os.getenv("JIMENG_LOG_BACKUP_COUNT", "5"))  # 保留的历史日志文件数
+PAYLOAD_SAMPLE_RATE = float(os.getenv("JIMENG_PAYLOAD_LOG_SAMPLE_RATE", "1"))  # DEBUG级别下记录请求详情的比例
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(trace)s'
+
+logger = logging.getLogger('jimeng_api')
+# 请求头、请求体、响应内容等详细日志，只在DEBUG级别下按比例记录
+payload_logger = logging.getLogger('jimeng_api.payload')
+
+# 请求详情各字段的名称
+_PAYLOAD_LABELS = {
+    "url": "请求URL",
+    "headers": "请求头",
+    "params": "请求参数",
+    "body": "请求体",
+    "status": "响应状态码",
+    "response": "响应内容",
+}
+
+
+class _TraceFilter(logging.Filter):
+    """在记录日志的线程中附加当前链路的trace_id，便于从日志查到对应的链路，未采样时为空"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = current_trace_id()
+        record.trace = f" [trace_id={trace_id}]" if trace_id else ""
+        return True
+
+
+_listener: Optional[QueueListener] = None
+_log_file = ""  # setup_logging配置的日志文件路径
+_setup_lock = threading.Lock()
+
+
+def setup_logging(level: str = LOG_LEVEL, log_file: str = LOG_FILE):
+    """
+    配置日志输出，重复调用只生效一次
+
+    日志记录先放入队列，由后台线程写入标准输出和按大小滚动的日志文件，
+    请求线程和事件循环不会因写磁盘而阻塞
+
+    Args:
+        level: 日志级别，如DEBUG、INFO
+        log_file: 日志文件路径，为空时不写文件
+    """
+    global _listener, _log_file
+    with _setup_lock:
+        if _listener is not None:
+            return
+        _log_file = log_file
+        formatter = logging.Formatter(LOG_FORMAT)
+        handlers = [logging.StreamHandler(sys.stdout)]
+        if log_file:
+            handlers.append(RotatingFileHandler(
+                log_file,
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUP_COUNT,
+                encoding='utf-8',
+                delay=True
+            ))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger()
+        root.setLevel(level)
+        # 后台线程格式化时已不在请求的上下文中，trace_id须在入队前取得
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(_TraceFilter())
+        root.addHandler(queue_handler)
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+def _process_file_handler(handler: RotatingFileHandler) -> RotatingFileHandler:
+    # 滚动日志文件不能被多个进程同时写入，fork出的子进程(如gunicorn的各个worker)写入带pid的文件，如api_debug.1234.log
+    root, ext = os.path.splitext(_log_file)
+    process_handler = RotatingFileHandler(
+        f"{root}.{os.getpid()}{ext}",
+        maxBytes=handler.maxBytes,
+        backupCount=handler.backupCount,
+        encoding=handler.encoding,
+        delay=True
+    )
+    process_handler.setFormatter(handler.formatter)
+    return process_handler
+
+
+def _restart_listener():
+    # fork出的子进程中没有写日志的后台线程，需要重新启动
+    global _listener
+    if _listener is not None:
+        handlers = [
+            _process_file_handler(handler) if isinstance(handler, RotatingFileHandler) else handler
+            for handler in _listener.handlers
+        ]
+        _listener = QueueListener(_listener.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+@atexit.register
+def _stop_listener():
+    # 退出前写完队列中剩余的日志
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _flush_before_fork():
+    # fork前写完队列中的日志，避免子进程复制到未写出的记录后重复写入
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _resume_in_parent():
+    if _listener is not None and _listener._thread is None:
+        _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_flush_before_fork, after_in_parent=_resume_in_parent, after_in_child=_restart_listener)
+
+
+def _format_payload(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', errors='replace')
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def log_payloads(action: str, **payloads):
+    """
+    记录一次上游请求的详情
+
+    只有DEBUG级别开启且命中采样时才会序列化请求头、请求体等内容，其余情况下开销仅为一次级别判断。
+    同一次请求的各字段一起采样，不会只记录一部分
+
+    Args:
+        action: 操作名称，如"生成图片"
+        **payloads: url、headers、params、body、status、response中的任意字段
+    """
+    if not payload_logger.isEnabledFor(logging.DEBUG):
+        return
+    if PAYLOAD_SAMPLE_RATE < 1 and random.random() >= PAYLOAD_SAMPLE_RATE:
+        return
+    for name, value in payloads.items():
+        payload_logger.debug("%s%s: %s", action, _PAYLOAD_LABELS.get(name, name), _format_payload(value))
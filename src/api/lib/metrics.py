@@ -0,0 +1,188 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认的耗时分桶(秒)，覆盖从毫秒级的接口调用到分钟级的图片生成
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Sharded:
+    """
+    按线程分片的指标存储
+
+    每个线程只写自己的分片，记录时不加锁；导出时汇总所有分片。
+    分片只在线程第一次记录时创建，该步骤加锁
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Dict[LabelValues, list]] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict[LabelValues, list]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if not labels and not self.labelnames:
+            return ()
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}的标签应为: {', '.join(self.labelnames)}")
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def _merged(self, width: int) -> Dict[LabelValues, list]:
+        merged: Dict[LabelValues, list] = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, values in list(shard.items()):
+                total = merged.setdefault(key, [0] * width)
+                for i, value in enumerate(values):
+                    total[i] += value
+        return merged
+
+
+class Counter(_Sharded):
+    """只增不减的计数"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        shard = self._shard()
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0]
+        values[0] += amount
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for key, (value,) in sorted(self._merged(1).items()):
+            yield f"{self.name}_total", dict(zip(self.labelnames, key)), value
+
+
+class Histogram(_Sharded):
+    """按分桶统计的分布，导出各分桶的累计数量、总和及次数"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        shard = self._shard()
+        values = shard.get(key)
+        if values is None:
+            # 各分桶的数量(最后一个为+Inf)、总和
+            values = shard[key] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for key, values in sorted(self._merged(len(self.buckets) + 2).items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, values[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Gauge:
+    """导出时通过回调读取的瞬时值，如进行中的请求数、连接池状态"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Iterable[Sample]]):
+        self.name = name
+        self.documentation = documentation
+        self._collect = collect
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for labels, value in self._collect():
+            yield self.name, labels, value
+
+
+class CallbackCounter(Gauge):
+    """导出时通过回调读取的累计值，如已有统计中的请求数"""
+
+    type = "counter"
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for labels, value in self._collect():
+            yield f"{self.name}_total", labels, value
+
+
+class Registry:
+    """指标注册表，以Prometheus文本格式导出全部指标"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, collect: Callable[[], Iterable[Sample]]) -> Gauge:
+        return self.register(Gauge(name, documentation, collect))
+
+    def callback_counter(self, name: str, documentation: str, collect: Callable[[], Iterable[Sample]]) -> CallbackCounter:
+        return self.register(CallbackCounter(name, documentation, collect))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
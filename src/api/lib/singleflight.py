@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Abandoned(Exception):
+    """执行者被取消，等待者需要重新发起调用"""
+
+
+class _Call:
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    合并相同key的并发调用
+
+    同一时刻相同key的调用只执行一次，其余调用等待并共享结果或异常。
+    执行者被取消时，等待者中的一个重新执行，不会连带取消其他请求。
+    调用方不应修改共享的返回值
+    """
+
+    def __init__(self):
+        self._calls: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], _Call] = {}
+        self._stats_lock = threading.Lock()
+        self._total = 0
+        self._executed = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行func，相同key的调用正在进行时直接等待其结果
+
+        Args:
+            key: 调用的唯一标识
+            func: 无参数的协程函数
+
+        Returns:
+            T: func的返回值
+        """
+        loop = asyncio.get_running_loop()
+        with self._stats_lock:
+            self._total += 1
+        # 不同事件循环之间的Future不能互相等待，按事件循环分别合并
+        call_key = (loop, key)
+        while True:
+            call = self._calls.get(call_key)
+            if call is None:
+                break
+            call.waiters += 1
+            try:
+                return await asyncio.shield(call.future)
+            except _Abandoned:
+                continue
+
+        call = self._calls[call_key] = _Call(loop.create_future())
+        with self._stats_lock:
+            self._executed += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            if call.waiters:
+                call.future.set_exception(_Abandoned())
+            raise
+        except Exception as e:
+            # 没有等待者时不设置异常，避免Future异常未被读取的告警
+            if call.waiters:
+                call.future.set_exception(e)
+            raise
+        else:
+            call.future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(call_key) is call:
+                del self._calls[call_key]
+
+    def stats(self) -> Dict:
+        """
+        合并统计
+
+        Returns:
+            Dict: 调用次数、实际执行次数、被合并的调用次数及合并比例、正在执行的key数量
+        """
+        with self._stats_lock:
+            collapsed = max(self._total - self._executed, 0)
+            return {
+                "calls": self._total,
+                "executed": self._executed,
+                "collapsed": collapsed,
+                "collapse_ratio": round(collapsed / self._total, 4) if self._total else 0.0,
+                "in_flight": len(self._calls)
+            }
@@ -0,0 +1,335 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+# 链路追踪配置，可通过环境变量覆盖
+TRACE_SAMPLE_RATE = float(os.getenv("JIMENG_TRACE_SAMPLE_RATE", "0"))  # 记录链路的请求比例，0为关闭
+TRACE_EXPORTER = os.getenv("JIMENG_TRACE_EXPORTER", "stdout")  # stdout(每行一个span的JSON) 或 otlp_file(OTLP/JSON)
+TRACE_FILE = os.getenv("JIMENG_TRACE_FILE", "traces.jsonl")  # otlp_file导出的文件路径
+SERVICE_NAME = "jimeng-free-api"
+
+# W3C Trace Context的traceparent请求头: 版本-trace_id-父span_id-标志位
+_TRACEPARENT_PATTERN = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("jimeng_trace_span", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return f"{random.getrandbits(nbytes * 8):0{nbytes * 2}x}"
+
+
+class _Trace:
+    """一次请求的所有span，根span结束时一起导出"""
+
+    __slots__ = ('trace_id', 'spans', 'finished')
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.finished = False
+
+
+class Span:
+    """链路中的一个阶段，记录起止时间、属性和结果"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], kind: str = "internal", start_ns: int = None, attributes: Dict[str, Any] = None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, **attributes):
+        """设置属性，值为字符串、数字或布尔值"""
+        self.attributes.update(attributes)
+
+    def set_error(self, message: str):
+        self.error = message
+
+    def end(self, end_ns: int = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+        if self.trace.finished:
+            # 根span结束后才结束的span(如后台任务)单独导出
+            _export([self])
+        else:
+            self.trace.spans.append(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class StdoutExporter:
+    """每行输出一个span的JSON"""
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+
+    def export(self, spans: List[Span]):
+        for span in spans:
+            self._stream.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+        self._stream.flush()
+
+    def close(self):
+        pass
+
+
+_OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpFileExporter:
+    """每行写入一个OTLP/JSON的ExportTraceServiceRequest，可由OpenTelemetry Collector的otlpjsonfile接收器读取"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, spans: List[Span]):
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "jimeng_api"},
+                "spans": [self._span(span) for span in spans]
+            }]
+        }]}
+        self._file.write(json.dumps(request, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def _span(span: Span) -> Dict:
+        data = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": _OTLP_KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent_id:
+            data["parentSpanId"] = span.parent_id
+        return data
+
+
+EXPORTERS = {
+    "stdout": StdoutExporter,
+    "otlp_file": OtlpFileExporter,
+}
+
+
+class _ExportWorker:
+    """在后台线程中导出span，请求线程和事件循环不会因写输出而阻塞"""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="jimeng-trace-export", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self) -> bool:
+        # fork出的子进程中后台线程不存在，需要重新创建
+        return self._pid == os.getpid() and self._thread.is_alive()
+
+    def put(self, spans: List[Span]):
+        self._queue.put(spans)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self.exporter.close()
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                return
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                sys.stderr.write(f"导出链路失败: {str(e)}\n")
+
+
+_sample_rate = TRACE_SAMPLE_RATE
+_exporter = None
+_worker: Optional[_ExportWorker] = None
+_worker_lock = threading.Lock()
+
+
+def configure(sample_rate: float = None, exporter=None):
+    """
+    修改采样比例或替换导出器
+
+    Args:
+        sample_rate: 记录链路的请求比例
+        exporter: 实现export(spans)和close()的对象，如StdoutExporter、OtlpFileExporter或自定义导出器
+    """
+    global _sample_rate, _exporter, _worker
+    with _worker_lock:
+        if sample_rate is not None:
+            _sample_rate = sample_rate
+        if exporter is not None:
+            if _worker is not None and _worker.alive:
+                _worker.stop()
+            _exporter, _worker = exporter, None
+
+
+def _export(spans: List[Span]):
+    global _exporter, _worker
+    worker = _worker
+    if worker is None or not worker.alive:
+        with _worker_lock:
+            if _worker is None or not _worker.alive:
+                if _exporter is None:
+                    _exporter = EXPORTERS[TRACE_EXPORTER]()
+                _worker = _ExportWorker(_exporter)
+            worker = _worker
+    worker.put(spans)
+
+
+@atexit.register
+def _flush():
+    if _worker is not None and _worker.alive:
+        _worker.stop()
+
+
+def current_span() -> Optional[Span]:
+    """当前正在记录的span，未采样时返回None"""
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+@contextlib.contextmanager
+def start_trace(name: str, traceparent: str = "", **attributes) -> Iterator[Optional[Span]]:
+    """
+    开始一次请求的链路，在接口入口处使用
+
+    上游调用方通过traceparent请求头传入已采样的链路时沿用其trace_id，否则按采样比例决定是否记录。
+    未采样时不创建任何span，各阶段的span()调用几乎没有开销
+
+    Args:
+        name: 根span名称，如POST /v1/images/generations
+        traceparent: W3C traceparent请求头
+        **attributes: 根span的属性
+
+    Returns:
+        Iterator[Optional[Span]]: 根span，未采样时为None
+    """
+    match = _TRACEPARENT_PATTERN.fullmatch(traceparent.strip()) if traceparent else None
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        sampled = int(flags, 16) & 1
+    else:
+        trace_id, parent_id = _new_id(16), None
+        sampled = _sample_rate > 0 and random.random() < _sample_rate
+    if not sampled:
+        yield None
+        return
+
+    trace = _Trace(trace_id)
+    root = Span(trace, name, parent_id, kind="server", attributes=attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.set_error(str(e) or type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        root.end()
+        trace.finished = True
+        _export(trace.spans)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = "internal", **attributes) -> Iterator[Optional[Span]]:
+    """
+    记录当前链路中的一个阶段，未采样时直接执行
+
+    Args:
+        name: span名称，如credit.lookup
+        kind: internal 或 client(调用上游)
+        **attributes: span的属性
+
+    Returns:
+        Iterator[Optional[Span]]: 当前span，未采样时为None
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, kind=kind, attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set_error(str(e) or type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def record_span(parent: Optional[Span], name: str, start_ns: int, end_ns: int, **attributes) -> Optional[Span]:
+    """
+    补记一个已经结束的阶段，用于在共享的后台任务中为各个请求记录span(如批量轮询)
+
+    Args:
+        parent: 所属请求的span，为None时不记录
+        name: span名称
+        start_ns: 开始时间(time.time_ns)
+        end_ns: 结束时间(time.time_ns)
+    """
+    if parent is None:
+        return None
+    child = Span(parent.trace, name, parent.span_id, start_ns=start_ns, attributes=attributes)
+    child.end(end_ns)
+    return child
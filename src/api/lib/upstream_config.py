@@ -0,0 +1,54 @@
+"""
+上游客户端配置: 地址、代理、各接口超时、请求总时限和重试预算
+
+所有配置均可通过环境变量覆盖。超时的格式为单个数字(总超时秒数)或"连接超时,读取超时"，如5,30
+"""
+import os
+from typing import Dict, Optional, Tuple, Union
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+def parse_timeout(value: str) -> Timeout:
+    """
+    解析超时配置
+
+    Args:
+        value: 如"15"或"5,30"
+
+    Returns:
+        Timeout: 总超时秒数，或(连接超时, 读取超时)
+
+    Raises:
+        ValueError: 格式错误
+    """
+    parts = [part.strip() for part in value.split(",")]
+    if len(parts) == 1:
+        return float(parts[0])
+    if len(parts) == 2:
+        return float(parts[0]), float(parts[1])
+    raise ValueError(f"无效的超时配置: {value}，应为总超时或\"连接超时,读取超时\"")
+
+
+def _env_timeout(name: str, default: str) -> Timeout:
+    return parse_timeout(os.getenv(name, default))
+
+
+# 上游地址，可指向区域节点、反向代理或本地的simulator.py
+BASE_URL = os.getenv("JIMENG_BASE_URL", "https://jimeng.jianying.com").rstrip("/")
+PROXY: Optional[str] = os.getenv("JIMENG_UPSTREAM_PROXY") or None  # 访问上游及下载图片使用的HTTP代理，如http://127.0.0.1:7890
+
+DEFAULT_TIMEOUT = _env_timeout("JIMENG_TIMEOUT", "5,15")  # 未单独配置的接口使用的超时
+
+# 各上游接口的超时
+ENDPOINT_TIMEOUTS: Dict[str, Timeout] = {
+    "/commerce/v1/benefits/user_credit": _env_timeout("JIMENG_TIMEOUT_CREDIT", "15"),
+    "/commerce/v1/benefits/credit_receive": _env_timeout("JIMENG_TIMEOUT_CREDIT_RECEIVE", "15"),
+    "/mweb/v1/aigc_draft/generate": _env_timeout("JIMENG_TIMEOUT_GENERATE", "5,30"),
+    "/mweb/v1/get_history_by_ids": _env_timeout("JIMENG_TIMEOUT_HISTORY", "5,15"),
+}
+
+REQUEST_DEADLINE = float(os.getenv("JIMENG_REQUEST_DEADLINE", "300"))  # 每个API请求从进入到返回的总时限(秒)，0为不限制
+MAX_RETRIES = int(os.getenv("JIMENG_MAX_RETRIES", "3"))  # 单次请求建立连接失败时的最多重试次数
+RETRY_BUDGET_RATIO = float(os.getenv("JIMENG_RETRY_BUDGET_RATIO", "0.2"))  # 所有重试不超过近期请求数的该比例
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("JIMENG_RETRY_BUDGET_MIN_PER_SECOND", "5"))  # 请求很少时每秒保底允许的重试次数
@@ -0,0 +1,387 @@
+"""
+上游模拟服务
+
+实现即梦的积分查询、积分领取、提交生成、批量查询生成结果四个接口，响应格式与controllers/images.py解析的一致，
+用于在不消耗积分的情况下压测整个服务。生成耗时按配置的分布抽样，可模拟接口错误、生成失败、
+内容被过滤(fail_code 2038)和按token限流；生成的图片由本服务提供，可配合本地图片存储一起压测
+
+耗时分布的格式:
+    fixed:10            固定10秒
+    uniform:5,20        5到20秒均匀分布
+    lognormal:12,0.4    中位数12秒、对数标准差0.4的对数正态分布
+
+用法(在src/api目录下):
+    python simulator.py --port 9000 --latency lognormal:12,0.4 --filter-rate 0.05 --rate-limit 5
+    JIMENG_BASE_URL=http://127.0.0.1:9000 python app.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from aiohttp import web
+
+DEFAULT_PORT = 9000
+DEFAULT_LATENCY = "lognormal:12,0.4"  # 默认的生成耗时分布，与实际生成耗时相近
+DEFAULT_RTT = "fixed:0.05"  # 默认的接口响应耗时
+HISTORY_TTL = 600  # 生成记录在完成后保留的时间(秒)
+RATE_LIMITED_RET = "1015"  # 被限流时返回的ret，提交和查询都会按失败处理后重试
+INSUFFICIENT_CREDIT_RET = "5000"  # 积分不足时返回的ret，与core.ts的处理一致
+FILTERED_FAIL_CODE = "2038"  # 内容被过滤
+FAILED_FAIL_CODE = "1000"  # 其他生成失败
+
+# 生成状态，与poller.py中的处理一致
+STATUS_GENERATING = 20
+STATUS_FAILED = 30
+STATUS_DONE = 50
+
+
+class Distribution:
+    """按fixed:x、uniform:a,b或lognormal:median,sigma格式描述的耗时分布(秒)"""
+
+    def __init__(self, spec: str):
+        kind, _, args = spec.partition(":")
+        try:
+            values = [float(value) for value in args.split(",")] if args else []
+        except ValueError:
+            raise ValueError(f"耗时分布参数应为数字: {spec}")
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(values) != expected[kind]:
+            raise ValueError(f"无效的耗时分布: {spec}，应为fixed:x、uniform:a,b或lognormal:median,sigma")
+        if any(value < 0 for value in values):
+            raise ValueError(f"耗时分布参数不能为负数: {spec}")
+        self.spec = spec
+        self._kind = kind
+        self._values = values
+
+    def sample(self) -> float:
+        if self._kind == "fixed":
+            return self._values[0]
+        if self._kind == "uniform":
+            return random.uniform(*self._values)
+        median, sigma = self._values
+        return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return self.spec
+
+
+class SimulatorConfig:
+    """
+    模拟行为的配置，运行期间可通过POST /simulator/config修改
+
+    Args:
+        latency: 从提交到生成结束的耗时分布
+        rtt: 每个接口调用的响应耗时分布
+        error_rate: 接口直接返回500的比例
+        fail_rate: 生成失败(status 30)的比例
+        filter_rate: 内容被过滤(status 30, fail_code 2038)的比例
+        rate_limit: 每个token每秒允许的调用数，0为不限流
+        credits: 每个token的初始积分
+        receive_quota: 每个token每天可领取的积分
+        cost: 每次生成消耗的积分
+        images: 每次生成返回的图片数量
+        image_bytes: 每张图片的大小(字节)
+    """
+
+    FIELDS = ("latency", "rtt", "error_rate", "fail_rate", "filter_rate", "rate_limit", "credits", "receive_quota", "cost", "images", "image_bytes")
+
+    def __init__(
+        self,
+        latency: str = DEFAULT_LATENCY,
+        rtt: str = DEFAULT_RTT,
+        error_rate: float = 0.0,
+        fail_rate: float = 0.0,
+        filter_rate: float = 0.0,
+        rate_limit: float = 0.0,
+        credits: int = 100000,
+        receive_quota: int = 66,
+        cost: int = 1,
+        images: int = 4,
+        image_bytes: int = 200 * 1024
+    ):
+        self.latency = Distribution(latency)
+        self.rtt = Distribution(rtt)
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.filter_rate = filter_rate
+        self.rate_limit = rate_limit
+        self.credits = credits
+        self.receive_quota = receive_quota
+        self.cost = cost
+        self.images = images
+        self.image_bytes = image_bytes
+
+    def update(self, values: Dict):
+        """
+        修改部分配置
+
+        Raises:
+            ValueError: 包含未知的配置项或无效的耗时分布
+        """
+        unknown = set(values) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"未知的配置项: {', '.join(sorted(unknown))}")
+        for key, value in values.items():
+            try:
+                value = Distribution(value) if key in ("latency", "rtt") else type(getattr(self, key))(value)
+            except (TypeError, AttributeError):
+                raise ValueError(f"无效的配置值: {key}={value!r}")
+            setattr(self, key, value)
+
+    def to_dict(self) -> Dict:
+        return {key: repr(value) if isinstance(value, Distribution) else value for key, value in ((key, getattr(self, key)) for key in self.FIELDS)}
+
+
+class _TokenBucket:
+    """按token限流，每秒补充rate个令牌，最多积累rate个(至少1个)"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, now: float):
+        self.tokens = None
+        self.updated = now
+
+    def take(self, rate: float, now: float) -> bool:
+        capacity = max(rate, 1.0)
+        if self.tokens is None:
+            self.tokens = capacity
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Account:
+    """一个token的积分和限流状态"""
+
+    __slots__ = ('credits', 'received_day', 'bucket')
+
+    def __init__(self, credits: int, now: float):
+        self.credits = credits
+        self.received_day = None
+        self.bucket = _TokenBucket(now)
+
+
+class _Generation:
+    """一次提交的生成，结果在提交时就已抽样决定"""
+
+    __slots__ = ('history_id', 'token', 'ready_at', 'status', 'fail_code')
+
+    def __init__(self, history_id: str, token: str, ready_at: float, status: int, fail_code: Optional[str]):
+        self.history_id = history_id
+        self.token = token
+        self.ready_at = ready_at
+        self.status = status
+        self.fail_code = fail_code
+
+
+class Simulator:
+    """模拟的上游状态: 各token的积分、进行中和已结束的生成、调用统计"""
+
+    def __init__(self, config: SimulatorConfig = None):
+        self.config = config or SimulatorConfig()
+        self._accounts: Dict[str, _Account] = {}
+        self._generations: Dict[str, _Generation] = {}
+        # (过期时间, history_id)，按提交顺序排列，过期时间大致递增，从头部清理即可
+        self._expiry = deque()
+        self._ids = itertools.count(int(time.time() * 1000) * 1000)
+        self._calls: Dict[str, int] = {}
+        self._errors = 0
+        self._rate_limited = 0
+        self._outcomes = {"submitted": 0, "succeeded": 0, "failed": 0, "filtered": 0, "insufficient_credit": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/commerce/v1/benefits/user_credit", self._endpoint("user_credit", self.user_credit))
+        app.router.add_post("/commerce/v1/benefits/credit_receive", self._endpoint("credit_receive", self.credit_receive))
+        app.router.add_post("/mweb/v1/aigc_draft/generate", self._endpoint("generate", self.generate))
+        app.router.add_post("/mweb/v1/get_history_by_ids", self._endpoint("get_history_by_ids", self.get_history_by_ids))
+        app.router.add_get("/simulator/images/{history_id}/{index}.webp", self.image)
+        app.router.add_get("/simulator/stats", self.stats_handler)
+        app.router.add_post("/simulator/config", self.config_handler)
+        return app
+
+    def _endpoint(self, name: str, handler):
+        # 所有上游接口共用的模拟: 响应耗时、随机错误、按token限流
+        async def wrapper(request: web.Request) -> web.StreamResponse:
+            self._calls[name] = self._calls.get(name, 0) + 1
+            delay = self.config.rtt.sample()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if random.random() < self.config.error_rate:
+                self._errors += 1
+                return web.Response(status=500, text="simulated upstream error")
+            token = _session_id(request)
+            account = self._account(token)
+            if self.config.rate_limit > 0 and not account.bucket.take(self.config.rate_limit, time.monotonic()):
+                self._rate_limited += 1
+                return web.json_response({"ret": RATE_LIMITED_RET, "errmsg": "请求过于频繁，请稍后再试"})
+            return await handler(request, token, account)
+        return wrapper
+
+    def _account(self, token: str) -> _Account:
+        account = self._accounts.get(token)
+        if account is None:
+            account = self._accounts[token] = _Account(self.config.credits, time.monotonic())
+        return account
+
+    async def user_credit(self, request: web.Request, token: str, account: _Account) -> web.Response:
+        return web.json_response({"ret": "0", "data": {"credit": {"gift_credit": account.credits, "purchase_credit": 0, "vip_credit": 0}}})
+
+    async def credit_receive(self, request: web.Request, token: str, account: _Account) -> web.Response:
+        today = time.strftime("%Y-%m-%d")
+        quota = 0
+        if account.received_day != today:
+            account.received_day = today
+            quota = self.config.receive_quota
+            account.credits += quota
+        return web.json_response({"ret": "0", "cur_total_credits": account.credits, "receive_quota": quota})
+
+    async def generate(self, request: web.Request, token: str, account: _Account) -> web.Response:
+        try:
+            body = await request.json()
+            json.loads(body["draft_content"])
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({"ret": "1000", "errmsg": "invalid draft_content"})
+        if account.credits < self.config.cost:
+            self._outcomes["insufficient_credit"] += 1
+            return web.json_response({"ret": INSUFFICIENT_CREDIT_RET, "errmsg": "credit not enough"})
+        account.credits -= self.config.cost
+
+        now = time.monotonic()
+        self._prune(now)
+        roll = random.random()
+        if roll < self.config.filter_rate:
+            status, fail_code, outcome = STATUS_FAILED, FILTERED_FAIL_CODE, "filtered"
+        elif roll < self.config.filter_rate + self.config.fail_rate:
+            status, fail_code, outcome = STATUS_FAILED, FAILED_FAIL_CODE, "failed"
+        else:
+            status, fail_code, outcome = STATUS_DONE, None, "succeeded"
+        history_id = str(next(self._ids))
+        generation = _Generation(history_id, token, now + self.config.latency.sample(), status, fail_code)
+        self._generations[history_id] = generation
+        self._expiry.append((generation.ready_at + HISTORY_TTL, history_id))
+        self._outcomes["submitted"] += 1
+        self._outcomes[outcome] += 1
+        return web.json_response({"ret": "0", "data": {"aigc_data": {"history_record_id": history_id}}})
+
+    async def get_history_by_ids(self, request: web.Request, token: str, account: _Account) -> web.Response:
+        try:
+            history_ids = (await request.json())["history_ids"]
+        except (ValueError, KeyError, TypeError):
+            return web.json_response({"ret": "1000", "errmsg": "invalid history_ids"})
+        now = time.monotonic()
+        image_base = f"{request.scheme}://{request.host}/simulator/images"
+        data = {}
+        for history_id in history_ids:
+            generation = self._generations.get(str(history_id))
+            # 与上游一致，不属于该token或不存在的记录不返回
+            if generation is None or generation.token != token:
+                continue
+            data[generation.history_id] = self._history_record(generation, now, image_base)
+        return web.json_response({"ret": "0", "data": data})
+
+    def _history_record(self, generation: _Generation, now: float, image_base: str) -> Dict:
+        if now < generation.ready_at:
+            return {"status": STATUS_GENERATING, "fail_code": None, "item_list": []}
+        if generation.status == STATUS_FAILED:
+            return {"status": STATUS_FAILED, "fail_code": generation.fail_code, "item_list": []}
+        return {
+            "status": STATUS_DONE,
+            "fail_code": None,
+            "item_list": [
+                {"image": {"large_images": [{"image_url": f"{image_base}/{generation.history_id}/{index}.webp"}]}}
+                for index in range(self.config.images)
+            ]
+        }
+
+    async def image(self, request: web.Request) -> web.Response:
+        # 内容随图片地址变化，使本地图片存储按内容去重时每张图片都是新文件
+        seed = f"{request.match_info['history_id']}/{request.match_info['index']}".encode()
+        size = max(self.config.image_bytes, 16)
+        body = b"RIFF" + (size - 8).to_bytes(4, "little") + b"WEBPVP8 " + (seed * (size // len(seed) + 1))[:size - 16]
+        self._calls["image"] = self._calls.get("image", 0) + 1
+        return web.Response(body=body, content_type="image/webp")
+
+    def _prune(self, now: float):
+        # 清理结束超过HISTORY_TTL的生成记录
+        while self._expiry and self._expiry[0][0] <= now:
+            _, history_id = self._expiry.popleft()
+            self._generations.pop(history_id, None)
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        pending = sum(1 for generation in self._generations.values() if now < generation.ready_at)
+        return {
+            "calls": dict(self._calls),
+            "errors": self._errors,
+            "rate_limited": self._rate_limited,
+            # succeeded、failed、filtered为提交时抽样决定的结果，包括尚未结束的生成
+            "generations": {**self._outcomes, "pending": pending},
+            "tokens": len(self._accounts),
+            "config": self.config.to_dict()
+        }
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def config_handler(self, request: web.Request) -> web.Response:
+        try:
+            values = await request.json()
+            if not isinstance(values, dict):
+                raise ValueError("请求体应为JSON对象")
+            self.config.update(values)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        return web.json_response(self.config.to_dict())
+
+
+def _session_id(request: web.Request) -> str:
+    # 与images.py生成的Cookie一致，按sessionid区分账号
+    return request.cookies.get("sessionid", "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="即梦上游模拟服务，用于离线压测")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY, help="从提交到生成结束的耗时分布")
+    parser.add_argument("--rtt", default=DEFAULT_RTT, help="每个接口调用的响应耗时分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="接口直接返回500的比例")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="生成失败的比例")
+    parser.add_argument("--filter-rate", type=float, default=0.0, help="内容被过滤(fail_code 2038)的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="每个token每秒允许的调用数，0为不限流")
+    parser.add_argument("--credits", type=int, default=100000, help="每个token的初始积分")
+    parser.add_argument("--images", type=int, default=4, help="每次生成返回的图片数量")
+    parser.add_argument("--image-bytes", type=int, default=200 * 1024, help="每张图片的大小(字节)")
+    args = parser.parse_args()
+
+    try:
+        config = SimulatorConfig(
+            latency=args.latency,
+            rtt=args.rtt,
+            error_rate=args.error_rate,
+            fail_rate=args.fail_rate,
+            filter_rate=args.filter_rate,
+            rate_limit=args.rate_limit,
+            credits=args.credits,
+            images=args.images,
+            image_bytes=args.image_bytes
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f"上游模拟服务: http://{args.host}:{args.port}，设置JIMENG_BASE_URL为该地址后启动服务即可离线压测")
+    web.run_app(Simulator(config).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 与运行服务时一致，以src/api为导入根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
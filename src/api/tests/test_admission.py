@@ -0,0 +1,162 @@
+import asyncio
+import time
+
+import pytest
+
+from controllers.admission import AdmissionRejected, AdmissionScheduler
+from controllers.tokens import TokenPool, MIN_OUTCOMES
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext, run_with_context
+
+
+def open_breaker(pool: TokenPool, token: str):
+    # 连续失败直到达到最少请求数，token的熔断器打开
+    for _ in range(MIN_OUTCOMES):
+        pool.release(pool.acquire([token]), False)
+
+
+def test_waiter_breaker_opens_while_queued():
+    async def scenario():
+        pool = TokenPool()
+        scheduler = AdmissionScheduler(pool, max_in_flight=1)
+        token = await scheduler.acquire(["a"])
+        waiter = asyncio.ensure_future(scheduler.acquire(["b"]))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 1
+
+        open_breaker(pool, "b")
+        # 归还名额时排队者的token全部熔断，只让排队者失败，不影响归还
+        scheduler.release(token, True)
+        with pytest.raises(CircuitOpenError):
+            await waiter
+        stats = scheduler.stats()
+        assert stats["queued"] == 0
+        assert stats["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_check_uses_explicit_context():
+    scheduler = AdmissionScheduler(TokenPool(), max_in_flight=1, max_wait=60)
+    # 没有完成样本时按默认生成耗时估算，排在第一位也要等待约20秒
+    scheduler.check(["a"], RequestContext(deadline=time.monotonic() + 60))
+    with pytest.raises(DeadlineExceeded):
+        scheduler.check(["a"], RequestContext(deadline=time.monotonic() + 5))
+
+
+def test_grant_and_release_without_queueing():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=2)
+        first = await scheduler.acquire(["a", "b"])
+        second = await scheduler.acquire(["a", "b"])
+        # 负载最低的token优先，两次分配到不同的token
+        assert {first, second} == {"a", "b"}
+        assert scheduler.stats()["in_flight"] == 2
+        scheduler.release(first, True)
+        scheduler.release(second, True)
+        assert scheduler.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_release_grants_queued_waiter_by_priority():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=1)
+        token = await scheduler.acquire(["a"])
+        low = asyncio.ensure_future(run_with_context(scheduler.acquire(["a"]), RequestContext("low", 0)))
+        high = asyncio.ensure_future(run_with_context(scheduler.acquire(["a"]), RequestContext("high", 5)))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 2
+
+        scheduler.release(token, True)
+        assert await high == "a"
+        assert not low.done()
+        scheduler.release("a", True)
+        assert await low == "a"
+
+    asyncio.run(scenario())
+
+
+def test_max_in_flight_per_token():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=4, max_in_flight_per_token=1)
+        assert await scheduler.acquire(["a", "b"]) != await scheduler.acquire(["a", "b"])
+        waiter = asyncio.ensure_future(scheduler.acquire(["a", "b"]))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 1
+        scheduler.release("b", True)
+        assert await waiter == "b"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=1)
+        token = await scheduler.acquire(["a"])
+        waiter = asyncio.ensure_future(scheduler.acquire(["a"]))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.stats()["queued"] == 0
+        # 名额没有分配给已取消的等待者
+        scheduler.release(token, True)
+        assert scheduler.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_rejects():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=1, max_wait=0.05)
+        # 排队上限很短，预计等待时间必然超过上限
+        await scheduler.acquire(["a"])
+        with pytest.raises(AdmissionRejected) as info:
+            await scheduler.acquire(["a"])
+        assert info.value.retry_after >= 1
+
+    asyncio.run(scenario())
+
+
+def test_acquire_fails_when_all_tokens_open():
+    async def scenario():
+        pool = TokenPool()
+        scheduler = AdmissionScheduler(pool)
+        open_breaker(pool, "a")
+        with pytest.raises(CircuitOpenError):
+            await scheduler.acquire(["a"])
+        assert scheduler.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_idle_token_not_blocked_by_waiter_on_busy_token():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=10, max_in_flight_per_token=1)
+        assert await scheduler.acquire(["a"]) == "a"
+        waiter = asyncio.ensure_future(scheduler.acquire(["a"]))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queued"] == 1
+        # a上有排队的请求，但b空闲，不应等待
+        assert await asyncio.wait_for(scheduler.acquire(["b"]), 1) == "b"
+        assert scheduler.stats()["in_flight"] == 2
+        assert not waiter.done()
+        scheduler.release("a", True)
+        assert await waiter == "a"
+
+    asyncio.run(scenario())
+
+
+def test_waiter_served_when_capacity_is_free():
+    async def scenario():
+        scheduler = AdmissionScheduler(TokenPool(), max_in_flight=10, max_in_flight_per_token=1)
+        await scheduler.acquire(["a"])
+        blocked = asyncio.ensure_future(scheduler.acquire(["a"]))
+        await asyncio.sleep(0)
+        # 与排队请求共用a，排在其后，但仍可立即分配到空闲的b
+        assert await asyncio.wait_for(scheduler.acquire(["a", "b"]), 1) == "b"
+        assert not blocked.done()
+        blocked.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+import pytest
+
+from lib import breaker as breaker_module
+from lib.breaker import CLOSED, HALF_OPEN, OPEN, BreakerRegistry, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(breaker_module, "time", clock)
+    return clock
+
+
+def make_breaker(**options) -> CircuitBreaker:
+    defaults = dict(window=10, window_seconds=60, min_calls=4, error_rate=0.5, slow_seconds=1.0, open_seconds=30)
+    return CircuitBreaker("test", **{**defaults, **options})
+
+
+def record(breaker: CircuitBreaker, success, latency: float = 0.1, times: int = 1):
+    for _ in range(times):
+        breaker.begin()
+        breaker.end(success, latency)
+
+
+def test_opens_after_error_rate(clock):
+    breaker = make_breaker()
+    record(breaker, False, times=3)
+    # 调用数不足时不熔断
+    assert breaker.state == CLOSED
+    record(breaker, True)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.begin()
+    assert info.value.retry_after == 30
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_slow_calls_open(clock):
+    breaker = make_breaker()
+    record(breaker, True, latency=5.0, times=4)
+    assert breaker.state == OPEN
+
+
+def test_unrelated_failures_are_not_counted(clock):
+    breaker = make_breaker()
+    record(breaker, None, times=10)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 0
+
+
+def test_old_calls_leave_window(clock):
+    breaker = make_breaker()
+    record(breaker, False, times=3)
+    clock.now += 61
+    record(breaker, False)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_success_closes(clock):
+    breaker = make_breaker()
+    record(breaker, False, times=4)
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    breaker.begin()
+    # 半开状态下只放行一个探测调用
+    assert not breaker.available()
+    with pytest.raises(CircuitOpenError):
+        breaker.begin()
+    breaker.end(True, 0.1)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_probe_failure_reopens(clock):
+    breaker = make_breaker()
+    record(breaker, False, times=4)
+    clock.now += 30
+    breaker.begin()
+    breaker.end(False)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 2
+
+
+def test_cancelled_probe_returns_slot(clock):
+    breaker = make_breaker()
+    record(breaker, False, times=4)
+    clock.now += 30
+    breaker.begin()
+    breaker.end(None)
+    assert breaker.state == HALF_OPEN
+    assert breaker.available()
+
+
+def test_registry_reuses_breakers():
+    registry = BreakerRegistry(min_calls=1)
+    assert registry.get("a") is registry.get("a")
+    assert set(registry.stats()) == {"a"}
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import pytest
+
+from controllers.poller import HistoryPoller, LatencyTracker, PollerStats
+from lib.breaker import CircuitOpenError
+from lib.context import DeadlineExceeded, RequestContext, run_with_context
+
+
+class FakeUpstream:
+    """按预设的状态序列返回get_history_by_ids的结果，记录每次请求的history_id"""
+
+    def __init__(self, statuses, fail_code=None, errors=()):
+        self.statuses = {history_id: list(sequence) for history_id, sequence in statuses.items()}
+        self.fail_code = fail_code
+        self.errors = list(errors)
+        self.requests = []
+
+    async def fetch(self, refresh_token, history_ids):
+        self.requests.append(list(history_ids))
+        if self.errors:
+            raise self.errors.pop(0)
+        data = {}
+        for history_id in history_ids:
+            sequence = self.statuses[history_id]
+            status = sequence.pop(0) if len(sequence) > 1 else sequence[0]
+            data[history_id] = {"status": status, "fail_code": self.fail_code, "item_list": []}
+        return {"ret": "0", "data": data}
+
+
+def make_poller(upstream: FakeUpstream) -> HistoryPoller:
+    return HistoryPoller(upstream.fetch, tracker=LatencyTracker(), stats=PollerStats())
+
+
+def test_waiters_are_batched():
+    async def scenario():
+        upstream = FakeUpstream({"1": [50], "2": [50]})
+        poller = make_poller(upstream)
+        results = await asyncio.gather(
+            poller.wait("token", "1", retry_interval=0.01),
+            poller.wait("token", "2", retry_interval=0.01)
+        )
+        assert [data["status"] for data, _ in results] == [50, 50]
+        assert upstream.requests == [["1", "2"]]
+        assert poller.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_polls_until_complete():
+    async def scenario():
+        upstream = FakeUpstream({"1": [20, 20, 50]})
+        poller = make_poller(upstream)
+        data, polls = await poller.wait("token", "1", retry_interval=0.01)
+        assert (data["status"], polls) == (50, 3)
+
+    asyncio.run(scenario())
+
+
+def test_filtered_generation_fails():
+    async def scenario():
+        poller = make_poller(FakeUpstream({"1": [30]}, fail_code="2038"))
+        with pytest.raises(Exception, match="内容被过滤"):
+            await poller.wait("token", "1", retry_interval=0.01)
+
+    asyncio.run(scenario())
+
+
+def test_gives_up_after_max_wait():
+    async def scenario():
+        poller = make_poller(FakeUpstream({"1": [20]}))
+        with pytest.raises(Exception, match="图片生成超时"):
+            await poller.wait("token", "1", max_retries=3, retry_interval=0.01)
+
+    asyncio.run(scenario())
+
+
+def test_open_circuit_defers_polling():
+    async def scenario():
+        upstream = FakeUpstream({"1": [50]}, errors=[CircuitOpenError("查询接口暂时不可用", 0)])
+        poller = make_poller(upstream)
+        data, polls = await poller.wait("token", "1", retry_interval=0.01)
+        # 熔断期间的轮询不计入轮询次数
+        assert (data["status"], polls) == (50, 1)
+        assert len(upstream.requests) == 2
+
+    asyncio.run(scenario())
+
+
+def test_deadline_bounds_wait():
+    async def scenario():
+        poller = make_poller(FakeUpstream({"1": [20]}))
+        context = RequestContext(deadline=time.monotonic() + 0.1)
+        with pytest.raises(DeadlineExceeded):
+            await run_with_context(poller.wait("token", "1", max_retries=100, retry_interval=1), context)
+        assert poller.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_affect_others():
+    async def scenario():
+        upstream = FakeUpstream({"1": [20, 20, 50], "2": [20, 20, 50]})
+        poller = make_poller(upstream)
+        cancelled = asyncio.ensure_future(poller.wait("token", "1", retry_interval=0.01))
+        other = asyncio.ensure_future(poller.wait("token", "2", retry_interval=0.01))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        data, _ = await other
+        assert data["status"] == 50
+        assert all(request == ["2"] for request in upstream.requests)
+
+    asyncio.run(scenario())
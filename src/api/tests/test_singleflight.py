@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from lib.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+        assert results == [1] * 5
+        stats = flight.stats()
+        assert (stats["calls"], stats["executed"], stats["collapsed"], stats["in_flight"]) == (5, 1, 4, 0)
+        # 执行结束后不再合并
+        assert await flight.do("key", work) == 2
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_execute_separately():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def work(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        assert await asyncio.gather(flight.do("a", lambda: work(1)), flight.do("b", lambda: work(2))) == [1, 2]
+        assert flight.stats()["executed"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_exception_is_shared():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError("上游错误")
+
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flight.stats()["executed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_hands_over_to_waiter():
+    async def scenario():
+        flight = SingleFlight()
+        started = []
+
+        async def work():
+            started.append(len(started))
+            await asyncio.sleep(0.05)
+            return "done"
+
+        leader = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # 等待者不受执行者取消的影响，重新执行一次
+        assert await follower == "done"
+        assert started == [0, 1]
+
+    asyncio.run(scenario())
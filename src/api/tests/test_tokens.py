@@ -0,0 +1,30 @@
+from controllers import tokens as tokens_module
+from controllers.tokens import TokenPool
+
+
+def in_flight(pool: TokenPool) -> dict:
+    return {item["token"]: item["in_flight"] for item in pool.stats()}
+
+
+def test_eviction_keeps_candidates_of_current_acquire(monkeypatch):
+    monkeypatch.setattr(tokens_module, "MAX_TRACKED_TOKENS", 2)
+    pool = TokenPool()
+    pool.release(pool.acquire(["old-1"]), True)
+    pool.release(pool.acquire(["old-2"]), True)
+
+    # 两个新token同时超出上限，先创建的一个不能在同一次acquire中被淘汰
+    token = pool.acquire(["new-1", "new-2"])
+    assert in_flight(pool)[f"***{token[-4:]}"] == 1
+    pool.release(token, True)
+    assert in_flight(pool)[f"***{token[-4:]}"] == 0
+
+
+def test_eviction_skips_tokens_in_flight(monkeypatch):
+    monkeypatch.setattr(tokens_module, "MAX_TRACKED_TOKENS", 1)
+    pool = TokenPool()
+    busy = pool.acquire(["busy"])
+    pool.release(pool.acquire(["other"]), True)
+
+    assert "***busy" in in_flight(pool)
+    pool.release(busy, True)
+    assert in_flight(pool)["***busy"] == 0